@@ -0,0 +1,160 @@
+"""Benchmark of DiFashion generation on CPU, with a tiny randomly initialized model (no checkpoint or download needed)"""
+
+import argparse
+import logging
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from models.difashion import DiFashion
+from models.cpu_inference import configure_cpu_threads, cpu_autocast, cpu_autocast_dtype
+from models.feature_cache import feature_cache_parity
+from models.tiny_model import save_tiny_bundle, random_batch
+
+logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_all_args():
+    parser = argparse.ArgumentParser(description="Benchmark DiFashion fashion_generation on CPU with a tiny model.")
+    parser.add_argument("--latent_size", type=int, default=16, help="Latent size of the tiny UNet (images are twice as large).")
+    parser.add_argument("--unet_channels", type=str, default="32,64", help="Comma-separated block channels of the tiny UNet.")
+    parser.add_argument("--cate_num", type=int, default=10, help="Number of categories.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Number of outfits per generation.")
+    parser.add_argument("--outfit_length", type=int, default=4, help="Number of items per outfit.")
+    parser.add_argument("--num_blanks", type=int, default=1, help="Number of generated items per outfit (1 for FITB).")
+    parser.add_argument("--num_inference_steps", type=int, default=10)
+    parser.add_argument("--num_runs", type=int, default=3, help="Number of timed runs, after one warm-up run.")
+    parser.add_argument("--dtypes", type=str, default="fp32,bf16", help="Comma-separated CPU autocast dtypes to compare.")
+    parser.add_argument("--channels_last", action="store_true", help="Run the convolutions in channels_last.")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["dynamic", "weight_only"],
+        help="Int8 linear layers of the mutual encoder and the UNet attention/feed-forward, see `DiFashion.quantize_linear_layers`.",
+    )
+    parser.add_argument(
+        "--feature_cache_interval",
+        type=int,
+        default=None,
+        help="Run the whole UNet every this many steps and reuse its deep features in between, see `DiFashion.enable_feature_cache`.",
+    )
+    parser.add_argument("--feature_cache_branch", type=int, default=1, help="Depth of the shallow UNet blocks run at every step.")
+    parser.add_argument(
+        "--check_parity",
+        action="store_true",
+        help="With `--feature_cache_interval`, first compare the feature cache steps with the UNet forward.",
+    )
+    parser.add_argument("--atol", type=float, default=1e-4, help="Tolerance of the parity check.")
+    parser.add_argument(
+        "--token_merging",
+        type=str,
+        default=None,
+        help="Comma-separated fractions of merged self-attention tokens per resolution level, see `DiFashion.enable_token_merging`.",
+    )
+    parser.add_argument("--cpu_threads", type=int, default=None, help="Number of intra-op threads.")
+    parser.add_argument("--cpu_interop_threads", type=int, default=None, help="Number of inter-op threads.")
+    parser.add_argument("--seed", type=int, default=123)
+    return parser.parse_args()
+
+
+def check_feature_cache_parity(args, unet):
+    generator = torch.Generator().manual_seed(args.seed)
+    bsz = args.batch_size * args.outfit_length
+    sample = torch.randn(bsz, unet.config.in_channels, args.latent_size, args.latent_size, generator=generator)
+    encoder_hidden_states = torch.randn(bsz, 77, unet.config.cross_attention_dim, generator=generator)
+    diffs = feature_cache_parity(unet, sample, 500, encoder_hidden_states, args.feature_cache_branch)
+    for name, diff in diffs.items():
+        logger.info(f"{name:>12}: max abs diff {diff:.2e} {'ok' if diff <= args.atol else 'MISMATCH'}")
+    if any(diff > args.atol for diff in diffs.values()):
+        raise SystemExit(f"The feature cache and the UNet forward differ by more than {args.atol}.")
+
+
+def benchmark(args, diffusion):
+    diffusion.eval()
+    diffusion.enable_sdpa_attention()
+    if args.channels_last:
+        diffusion.to_channels_last()
+    if args.quantize is not None:
+        diffusion.quantize_linear_layers(args.quantize)
+    if args.feature_cache_interval is not None:
+        diffusion.enable_feature_cache(args.feature_cache_interval, args.feature_cache_branch)
+        if args.check_parity:
+            check_feature_cache_parity(args, diffusion.unet)
+    if args.token_merging is not None:
+        diffusion.enable_token_merging([float(ratio) for ratio in args.token_merging.split(",")])
+
+    image_size = args.latent_size * diffusion.vae_scale_factor
+    batch = random_batch(args, image_size, diffusion.text_encoder.config.vocab_size)
+    history = {uid: {} for uid in batch["uids"].tolist()}
+    null_img = torch.ones(3, image_size, image_size)
+
+    def generate(step_times):
+        generator = torch.Generator().manual_seed(args.seed)
+        step_times.append(time.perf_counter())
+        diffusion.fashion_generation(
+            **batch,
+            history=history,
+            num_inference_steps=args.num_inference_steps,
+            null_img=null_img,
+            generator=generator,
+            return_dict=False,
+            callback=lambda i, t, latents: step_times.append(time.perf_counter()),
+        )
+        return time.perf_counter() - step_times[0]
+
+    results = {}
+    for dtype in args.dtypes.split(","):
+        if dtype == "bf16" and cpu_autocast_dtype(dtype) is None:
+            logger.info("Skip bf16, which this CPU does not support.")
+            continue
+        with cpu_autocast(dtype):
+            generate([])  # warm-up
+            totals, steps = [], []
+            for _ in range(args.num_runs):
+                step_times = []
+                totals.append(generate(step_times))
+                steps.append(np.diff(step_times[1:]).mean())  # from the first denoising step
+        results[dtype] = {
+            "s/step": float(np.mean(steps)),
+            "s/outfit": float(np.mean(totals)) / args.batch_size,
+            "s/generation": float(np.mean(totals)),
+        }
+
+    return results
+
+
+def report(args, results):
+    logger.info(
+        f"latent size {args.latent_size}, UNet channels {args.unet_channels}, {args.batch_size} outfits x"
+        f" {args.num_blanks} blanks, {args.num_inference_steps} steps, channels_last {args.channels_last},"
+        f" int8 {args.quantize}, feature cache {args.feature_cache_interval}, token merging {args.token_merging}"
+    )
+    logger.info(f"{'dtype':>6} {'s/step':>9} {'s/outfit':>9} {'s/generation':>13}")
+    for dtype, metrics in results.items():
+        logger.info(f"{dtype:>6} {metrics['s/step']:>9.4f} {metrics['s/outfit']:>9.4f} {metrics['s/generation']:>13.4f}")
+
+
+def main():
+    args = parse_all_args()
+    num_threads, num_interop_threads = configure_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+    logger.info(f"{num_threads} intra-op threads, {num_interop_threads} inter-op threads")
+
+    with tempfile.TemporaryDirectory() as bundle_dir:
+        save_tiny_bundle(bundle_dir, args)
+        model_args = SimpleNamespace(
+            pretrained_model_name_or_path=bundle_dir, revision=None, non_ema_revision=None, category_emb_size=8,
+            hid_dim=64, enable_xformers_memory_efficient_attention=False, eta=0.1, use_history=True,
+            use_mutual_guidance=True,
+        )
+        diffusion = DiFashion(model_args, logger, args.cate_num, "cpu", checkpoint_dir=bundle_dir)
+        results = benchmark(args, diffusion)
+        report(args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
+import collections
 import copy
+import glob
+import heapq
+import io
 import os
 import random
+import tarfile
 from fileinput import filename
 
 import numpy as np
@@ -82,28 +87,276 @@ class FashionFITBData(Dataset):
         return {"uids": uids, "oids": oids, "outfits": outfits, 
                 "input_ids": input_ids, "category": category}
 
+class LaionShardDataset(data.IterableDataset):
+    """
+    Streaming image-caption source over the webdataset tar shards written by `img2dataset`
+    (see `datasets/download_laion2B-en-aesthetic.py`).
+
+    Shards are read sequentially (no random access). Every epoch the shard order is shuffled with `seed + epoch`, the
+    shards are split across ranks and then across dataloader workers, and samples pass through a shuffle buffer of
+    `shuffle_buffer` samples. Every sample carries its `shard_pos` (index in the epoch's shard order) and `offset`
+    (index within the shard), and the position `resume_shard_pos`/`resume_offset` of the oldest sample its worker has
+    read but not yielded yet (still in the shuffle buffer), so the stream can be resumed with `set_position`.
+    `update_position` keeps that position for the last batch of every worker (`num_workers` must match the
+    dataloader), so resuming is at-least-once: no sample is lost, the samples read after the resume position (at most
+    a shuffle buffer per worker, and the samples of the other workers' shards) are seen twice.
+    """
+    IMAGE_EXTS = ["jpg", "jpeg", "png", "webp"]
+
+    def __init__(self, shards, tokenizer, trans=None, rank=0, world_size=1, seed=123, shuffle_shards=True,
+                 shuffle_buffer=1000, num_workers=0, do_normalize=True):
+        if isinstance(shards, str):
+            shards = sorted(glob.glob(os.path.join(shards, "*.tar"))) if os.path.isdir(shards) else sorted(glob.glob(shards))
+        if len(shards) == 0:
+            raise ValueError("No webdataset shards found.")
+        if len(shards) < world_size:
+            raise ValueError(f"{len(shards)} shards cannot be split across {world_size} ranks.")
+        self.shards = list(shards)
+        self.tokenizer = tokenizer
+        self.trans = trans
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.shuffle_shards = shuffle_shards
+        self.shuffle_buffer = shuffle_buffer
+        self.do_normalize = do_normalize
+
+        self.epoch = 0
+        self.start_shard_pos = 0
+        self.start_offset = 0
+        # dataloader batches come from the workers in turn, keep the last position of each worker
+        self.recent_positions = collections.deque(maxlen=max(1, num_workers))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_position(self, epoch, shard_pos=0, offset=0):
+        # skip all the shards before `shard_pos` and the first `offset` samples of shard `shard_pos`
+        self.epoch = epoch
+        self.start_shard_pos = shard_pos
+        self.start_offset = offset
+        self.recent_positions.clear()
+
+    def state_dict(self):
+        """
+        The positions of all the ranks, gathered (a collective call on all the ranks): `accelerator.save_state` only
+        writes the custom checkpoint objects from the main process.
+        """
+        position = {"epoch": self.epoch, "shard_pos": self.start_shard_pos, "offset": self.start_offset}
+        positions = [position]
+        if self.world_size > 1:
+            positions = [None] * self.world_size
+            torch.distributed.all_gather_object(positions, position)
+        return {"positions": positions}
+
+    def load_state_dict(self, state_dict):
+        positions = state_dict["positions"]
+        if len(positions) != self.world_size:
+            raise ValueError(
+                f"The shard stream was saved with {len(positions)} ranks, it cannot resume on {self.world_size}."
+            )
+        position = positions[self.rank]
+        self.set_position(position["epoch"], position["shard_pos"], position["offset"])
+
+    def update_position(self, batch):
+        """
+        Record the resume position after consuming `batch`.
+        """
+        # the resume positions of a worker only move forward, the last sample of the batch has the latest one
+        self.recent_positions.append(max(zip(batch["resume_shard_pos"].tolist(), batch["resume_offset"].tolist())))
+        self.start_shard_pos, self.start_offset = min(self.recent_positions)
+
+    def epoch_shards(self):
+        order = list(range(len(self.shards)))
+        if self.shuffle_shards:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return order
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        # split the shards by rank, then by worker
+        positions = list(enumerate(self.epoch_shards()))
+        positions = positions[self.rank::self.world_size][worker_id::num_workers]
+        positions = [(pos, shard) for pos, shard in positions if pos >= self.start_shard_pos]
+
+        rng = random.Random(self.seed + self.epoch * 1000 + self.rank * 100 + worker_id)
+        buffer = []
+        # positions of the samples read but not yielded yet (a heap, with lazy deletion of the yielded ones)
+        pending, yielded = [], set()
+
+        def with_resume_position(sample):
+            position = (sample["shard_pos"], sample["offset"])
+            yielded.add(position)
+            while pending and pending[0] in yielded:
+                yielded.remove(heapq.heappop(pending))
+            # the oldest pending sample, or right after this one if the buffer is drained
+            resume_position = pending[0] if pending else (position[0], position[1] + 1)
+            sample["resume_shard_pos"], sample["resume_offset"] = resume_position
+            return sample
+
+        for pos, shard in positions:
+            skip = self.start_offset if pos == self.start_shard_pos else 0
+            for offset, sample in enumerate(self.read_shard(self.shards[shard])):
+                if offset < skip:
+                    continue
+                sample = self.process_sample(sample)
+                if sample is None:
+                    continue
+                sample["shard_pos"] = pos
+                sample["offset"] = offset
+                heapq.heappush(pending, (pos, offset))
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                idx = rng.randrange(len(buffer))
+                buffer[idx], sample = sample, buffer[idx]
+                yield with_resume_position(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield with_resume_position(sample)
+
+    def read_shard(self, path):
+        # group the consecutive tar members sharing a key: {key}.jpg, {key}.txt, {key}.json, ...
+        sample = {}
+        with tarfile.open(path, mode="r|*") as stream:
+            for member in stream:
+                if not member.isfile():
+                    continue
+                key, ext = os.path.basename(member.name).split(".", 1)
+                if sample and sample["__key__"] != key:
+                    yield sample
+                    sample = {}
+                sample["__key__"] = key
+                sample[ext.lower()] = stream.extractfile(member).read()
+        if sample:
+            yield sample
+
+    def process_sample(self, sample):
+        image_ext = next((ext for ext in self.IMAGE_EXTS if ext in sample), None)
+        if image_ext is None or "txt" not in sample:
+            return None
+        try:
+            img = Image.open(io.BytesIO(sample[image_ext])).convert('RGB')
+        except Exception:
+            return None
+        if self.trans is not None:
+            img = self.trans(img)
+        if self.do_normalize:
+            img = 2 * img - 1
+        caption = sample["txt"].decode("utf-8", errors="ignore")
+        input_ids = self.tokenizer(
+            caption, max_length=self.tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+        ).input_ids[0]
+
+        return {"pixel_values": img.to(memory_format=torch.contiguous_format).float(), "input_ids": input_ids}
+
+class DedupItemBank:
+    """
+    Per-item view over a bank (latents or features) that only stores the unique images of the catalog, also used by
+    the evaluation (`Evaluation/eval_utils.py`).
+    `item_to_unique[iid]` is the row of item `iid` in `unique_values` (see `datasets/dedup_catalog.py`), and
+    `bank[iids]` returns the same values as the full per-item bank would.
+    """
+    def __init__(self, unique_values, item_to_unique):
+        self.unique_values = unique_values
+        self.item_to_unique = item_to_unique.to(unique_values.device)
+
+    def __len__(self):
+        return len(self.item_to_unique)
+
+    @property
+    def shape(self):
+        return (len(self.item_to_unique),) + tuple(self.unique_values.shape[1:])
+
+    def __getitem__(self, iids):
+        if isinstance(iids, torch.Tensor):
+            iids = iids.to(self.item_to_unique.device)
+        return self.unique_values[self.item_to_unique[iids]]
+
+    def to(self, *args, **kwargs):
+        return DedupItemBank(self.unique_values.to(*args, **kwargs), self.item_to_unique)
+
+def load_dedup_index(data_path):
+    """
+    Returns `(item_to_unique, unique_item_ids)` if the catalog was deduplicated, else `(None, None)`.
+    """
+    dedup_path = os.path.join(data_path, "item_to_unique.npy")
+    if not os.path.exists(dedup_path):
+        return None, None
+    item_to_unique = torch.tensor(np.load(dedup_path)).long()
+    unique_item_ids = torch.tensor(np.load(os.path.join(data_path, "unique_item_ids.npy"))).long()
+    return item_to_unique, unique_item_ids
+
+def load_item_features(feat_path):
+    """
+    Load the per-item features saved in `feat_path` (e.g. `cnn_features_clip.npy`). If the catalog was deduplicated,
+    the features of the unique images (`*_unique.npy`) are loaded as a `DedupItemBank` indexed by item id.
+    """
+    item_to_unique, _ = load_dedup_index(os.path.dirname(feat_path))
+    unique_path = feat_path[:-len(".npy")] + "_unique.npy"
+    if item_to_unique is not None and os.path.exists(unique_path):
+        return DedupItemBank(torch.tensor(np.load(unique_path, allow_pickle=True)), item_to_unique)
+    if not os.path.exists(feat_path):
+        raise ValueError(f"The item features {feat_path} do not exist.")
+    return torch.tensor(np.load(feat_path, allow_pickle=True))
+
+@torch.no_grad()
+def encode_item_latents(iids, img_dataset, vae, device, batch_size=64):
+    vae = vae.to(device)
+    all_latents = []
+    for start in tqdm(range(0, len(iids), batch_size)):
+        batch_imgs = []
+        for iid in iids[start:start + batch_size]:
+            batch_imgs.append(img_dataset[iid])
+        batch_imgs = torch.stack(batch_imgs, dim=0).to(memory_format=torch.contiguous_format).float().to(device)
+        batch_latents = vae.encode(batch_imgs).latent_dist.mode() * vae.config.scaling_factor
+        all_latents.append(batch_latents)
+    return torch.cat(all_latents, dim=0).cpu()
+
+def load_item_latents(data_path, img_dataset=None, vae=None, device=None):
+    """
+    Load (or encode and save) the VAE latents of all the items. If the catalog was deduplicated, only the unique
+    images are encoded and a `DedupItemBank` indexed by item id is returned.
+    """
+    item_to_unique, unique_item_ids = load_dedup_index(data_path)
+    if item_to_unique is None:
+        all_latents_path = os.path.join(data_path, "all_item_latents.npy")
+        iids = list(range(len(img_dataset))) if img_dataset is not None else None
+    else:
+        all_latents_path = os.path.join(data_path, "all_unique_item_latents.npy")
+        iids = unique_item_ids.tolist()
+
+    if os.path.exists(all_latents_path):
+        all_latents = torch.tensor(np.load(all_latents_path, allow_pickle=True))
+    else:
+        if img_dataset is None or vae is None:
+            raise ValueError(f"{all_latents_path} does not exist, an image dataset and a VAE are needed to encode it.")
+        all_latents = encode_item_latents(iids, img_dataset, vae, device)
+        np.save(all_latents_path, np.array(all_latents))
+
+    if item_to_unique is None:
+        return all_latents
+    return DedupItemBank(all_latents, item_to_unique)
+
 ##### Preprocessing the datasets.
 
-def preprocess_dataset(data, data_path, id_cate_dict, history, img_dataset, tokenizer, vae, device):
+def category_prompt(category):
+    # the text prompt of a category name
+    special_cates = ["pants", "earrings"]
+    if any(special_cate in category for special_cate in special_cates):
+        return "A photo of a pair of " + category + ", on white background, high quality"
+    return "A photo of a " + category + ", on white background, high quality"
 
-    def contains_any_special_cate(category, special_cates):
-        for special_cate in special_cates:
-            if special_cate in category:
-                return True
-        return False
+def preprocess_dataset(data, data_path, id_cate_dict, history, img_dataset, tokenizer, vae, device):
 
     # process text prompts
     def tokenize_category(data):
         data["input_ids"] = []
         for outfit_category in data["category"]:
-            category_prompts = []
-            for cid in outfit_category:
-                category = id_cate_dict[cid]
-                special_cates = ["pants", "earrings"]
-                if contains_any_special_cate(category, special_cates):
-                    category_prompts.append("A photo of a pair of " + category + ", on white background, high quality")
-                else:
-                    category_prompts.append("A photo of a " + category + ", on white background, high quality")
+            category_prompts = [category_prompt(id_cate_dict[cid]) for cid in outfit_category]
             inputs = tokenizer(
                 category_prompts, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
             )
@@ -112,28 +365,8 @@ def preprocess_dataset(data, data_path, id_cate_dict, history, img_dataset, toke
 
     data = tokenize_category(data)
 
-    all_latents_path = os.path.join(data_path, "all_item_latents.npy")
-    if os.path.exists(all_latents_path):
-        all_latents = np.load(all_latents_path, allow_pickle=True)
-        all_latents = torch.tensor(all_latents)
-    else:
-        vae = vae.to(device)
-        batch_size = 64
-        all_latents = []
-        start_iid_list = list(range(0, len(img_dataset), batch_size))
-        last_iid = len(img_dataset)
-        with torch.no_grad():
-            for start_iid in tqdm(start_iid_list):
-                end_iid = start_iid + batch_size if start_iid + batch_size < last_iid else last_iid
-                batch_imgs = []
-                for i in range(start_iid, end_iid):
-                    batch_imgs.append(img_dataset[i])
-                batch_imgs = torch.stack(batch_imgs, dim=0).to(memory_format=torch.contiguous_format).float().to(device)
-                batch_latents = vae.encode(batch_imgs).latent_dist.mode() * vae.config.scaling_factor
-                all_latents.append(batch_latents)
-            all_latents = torch.cat(all_latents, dim=0)
-            all_latents = all_latents.cpu()
-            np.save(all_latents_path, np.array(all_latents))
+    # only the unique images are encoded if the catalog was deduplicated (datasets/dedup_catalog.py)
+    all_latents = load_item_latents(data_path, img_dataset, vae, device)
 
     hist_latents = {}
     for uid in history:
@@ -0,0 +1,154 @@
+"""Distill the lightweight preview decoder of DiFashion from the VAE decoder, on the item latents of a dataset"""
+
+import argparse
+import logging
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from diffusers import AutoencoderKL
+from tqdm.auto import tqdm
+
+import data_utils
+from models.preview_decoder import PreviewDecoder
+
+logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_all_args():
+    parser = argparse.ArgumentParser(description="Distill a preview decoder from the VAE decoder of DiFashion.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default="stabilityai/stable-diffusion-2-base",
+        help="Path to pretrained model or model identifier from huggingface.co/models, for the VAE.",
+    )
+    parser.add_argument("--revision", type=str, default=None, help="Revision of the pretrained model.")
+    parser.add_argument("--data_path", type=str, default='/data/path/', help="Folder of the datasets.")
+    parser.add_argument(
+        "--dataset_name",
+        type=str,
+        default='',
+        help="Dataset whose item latent bank (`all_item_latents.npy`, written by the preprocessing) is distilled on.",
+    )
+    parser.add_argument("--output_dir", type=str, required=True, help="Folder of the distilled preview decoder.")
+    parser.add_argument("--channels", type=int, default=64, help="Width of the preview decoder.")
+    parser.add_argument("--num_blocks", type=int, default=3, help="Residual blocks per resolution.")
+    parser.add_argument(
+        "--num_upsamples",
+        type=int,
+        default=3,
+        help="Upsamplings of the preview decoder: 3 for the resolution of the VAE, 2 for half of it, ...",
+    )
+    parser.add_argument("--train_batch_size", type=int, default=16)
+    parser.add_argument("--max_train_steps", type=int, default=20000)
+    parser.add_argument("--learning_rate", type=float, default=2e-4)
+    parser.add_argument("--adam_weight_decay", type=float, default=0.0)
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "bf16"],
+        help="Autocast dtype of the student on CUDA; the VAE teacher runs in fp32.",
+    )
+    parser.add_argument("--num_validation", type=int, default=256, help="Held-out latents of the validation.")
+    parser.add_argument("--validation_steps", type=int, default=1000, help="Validate and save every this many steps.")
+    parser.add_argument("--seed", type=int, default=123)
+    return parser.parse_args()
+
+
+def load_latents(data_path):
+    # the latents of the unique images only, if the catalog was deduplicated
+    latents = data_utils.load_item_latents(data_path)
+    if isinstance(latents, data_utils.DedupItemBank):
+        return latents.unique_values
+    return latents
+
+
+@torch.no_grad()
+def teacher_decode(vae, latents, size):
+    # the VAE decoding of the scaled latents, at the resolution of the student
+    images = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0].clamp(-1.0, 1.0)
+    if images.shape[-2:] != size:
+        images = F.interpolate(images, size=size, mode="area")
+    return images
+
+
+@torch.no_grad()
+def validate(vae, decoder, val_latents, val_targets, args, device):
+    # PSNR of the student against the teacher, and the decoding time of both per image
+    psnrs, teacher_time, student_time = [], 0.0, 0.0
+    for start in range(0, len(val_latents), args.train_batch_size):
+        latents = val_latents[start:start + args.train_batch_size].to(device)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        tic = time.perf_counter()
+        teacher_decode(vae, latents, val_targets.shape[-2:])
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        toc = time.perf_counter()
+        with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.mixed_precision == "bf16"):
+            images = decoder(latents).float().clamp(-1.0, 1.0)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        teacher_time += toc - tic
+        student_time += time.perf_counter() - toc
+        mse = ((images - val_targets[start:start + args.train_batch_size].to(device)) / 2).pow(2).flatten(1).mean(1)
+        psnrs.append(-10 * torch.log10(mse.clamp(min=1e-10)))
+    return torch.cat(psnrs).mean().item(), teacher_time / len(val_latents), student_time / len(val_latents)
+
+
+def main():
+    args = parse_all_args()
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision)
+    vae.requires_grad_(False)
+    vae.to(device).eval()
+    decoder = PreviewDecoder(
+        latent_channels=vae.config.latent_channels, channels=args.channels, num_blocks=args.num_blocks,
+        num_upsamples=args.num_upsamples,
+    ).to(device)
+    optimizer = torch.optim.AdamW(decoder.parameters(), lr=args.learning_rate, weight_decay=args.adam_weight_decay)
+
+    latents = load_latents(os.path.join(args.data_path, args.dataset_name)).float()
+    permutation = torch.randperm(len(latents), generator=torch.Generator().manual_seed(args.seed))
+    val_latents = latents[permutation[:args.num_validation]]
+    train_latents = latents[permutation[args.num_validation:]]
+    size = tuple(s * 2 ** args.num_upsamples for s in latents.shape[-2:])
+    val_targets = torch.cat([
+        teacher_decode(vae, chunk.to(device), size).cpu() for chunk in val_latents.split(args.train_batch_size)
+    ])
+    logger.info(f"Distill on {len(train_latents)} latents, validate on {len(val_latents)}, images of {size}.")
+
+    progress_bar = tqdm(range(args.max_train_steps))
+    for step in progress_bar:
+        decoder.train()
+        idx = torch.randint(len(train_latents), (args.train_batch_size,))
+        batch_latents = train_latents[idx].to(device)
+        targets = teacher_decode(vae, batch_latents, size)
+        with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.mixed_precision == "bf16"):
+            images = decoder(batch_latents)
+        loss = F.l1_loss(images.float(), targets)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        progress_bar.set_postfix(loss=loss.item())
+
+        if (step + 1) % args.validation_steps == 0 or step + 1 == args.max_train_steps:
+            decoder.eval()
+            psnr, teacher_time, student_time = validate(vae, decoder, val_latents, val_targets, args, device)
+            logger.info(
+                f"step {step + 1}: PSNR {psnr:.2f}dB against the VAE decoder, {teacher_time * 1000:.1f}ms/image for"
+                f" the VAE, {student_time * 1000:.1f}ms/image for the preview decoder"
+            )
+            decoder.save_pretrained(args.output_dir)
+
+    logger.info(f"Saved the preview decoder to {args.output_dir}.")
+
+
+if __name__ == "__main__":
+    main()
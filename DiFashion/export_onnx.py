@@ -0,0 +1,170 @@
+"""Export DiFashion to ONNX for the ONNX Runtime backend of fashion_generation, and check the parity with PyTorch"""
+
+import argparse
+import logging
+import os
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+import data_utils
+from models.difashion import DiFashion
+from models.onnx_backend import OnnxBackend, export_onnx
+from models.tiny_model import save_tiny_bundle, random_batch
+
+logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_all_args():
+    parser = argparse.ArgumentParser(description="Export the DiFashion modules of fashion_generation to ONNX.")
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="Training checkpoint or inference bundle to export; required unless `--tiny`.",
+    )
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default="stabilityai/stable-diffusion-2-base",
+        help="Pretrained model of the components that are not in the checkpoint (text encoder, VAE, ...).",
+    )
+    parser.add_argument("--data_path", type=str, default='/data/path/', help="Folder of the datasets.")
+    parser.add_argument("--dataset_name", type=str, default='', help="Dataset whose category prompts are exported.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Folder of the ONNX models.")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version.")
+    parser.add_argument("--use_ema", action="store_true", help="Export the EMA UNet of a training checkpoint.")
+    parser.add_argument("--use_ema_fashion", action="store_true", help="Export the EMA mutual encoder of a training checkpoint.")
+    parser.add_argument("--eta", type=float, default=0.1, help="The weight of mutual guidance, for the parity check.")
+    parser.add_argument(
+        "--tiny",
+        action="store_true",
+        help="Export a tiny randomly initialized model instead of a checkpoint, to check the parity quickly.",
+    )
+    parser.add_argument("--check_parity", action="store_true", help="Compare ONNX Runtime with PyTorch after the export.")
+    parser.add_argument("--num_inference_steps", type=int, default=10, help="Denoising steps of the parity check.")
+    parser.add_argument("--atol", type=float, default=1e-3, help="Tolerance of the parity check.")
+    parser.add_argument("--seed", type=int, default=123)
+    return parser.parse_args()
+
+
+def category_input_ids(model, id_cate_dict):
+    # the prompts of all the categories, tokenized as in `data_utils.preprocess_dataset`, and the null prompt
+    prompts = [data_utils.category_prompt(category) for category in id_cate_dict.values()] + [""]
+    return model.tokenizer(
+        prompts, max_length=model.tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+    ).input_ids
+
+
+@torch.no_grad()
+def check_parity(model, backend, batch, history, null_img, num_inference_steps, seed):
+    """
+    Max absolute differences between PyTorch and ONNX Runtime, for every module on random inputs and for the
+    latents generated by `fashion_generation`.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    latent_size = model.unet.config.sample_size
+    latent_channels = model.vae.config.latent_channels
+    image_size = latent_size * model.vae_scale_factor
+    bsz = 3
+    inputs = {
+        "unet": (
+            torch.randn(bsz, model.unet.config.in_channels, latent_size, latent_size, generator=generator),
+            torch.tensor(321),
+            torch.randn(bsz, batch["input_ids"].shape[-1], model.text_encoder.config.hidden_size, generator=generator),
+        ),
+        "fashion_encoder": (torch.randn(bsz, latent_channels, latent_size, latent_size, generator=generator),),
+        "vae_encoder": (torch.rand(bsz, 3, image_size, image_size, generator=generator) * 2 - 1,),
+        "vae_decoder": (torch.randn(bsz, latent_channels, latent_size, latent_size, generator=generator),),
+    }
+    references = {
+        "unet": lambda sample, t, states: model.unet(sample, t, encoder_hidden_states=states, return_dict=False)[0],
+        "fashion_encoder": model.fashion_encoder,
+        "vae_encoder": lambda images: model.vae.encode(images).latent_dist.mode(),
+        "vae_decoder": lambda latents: model.vae.decode(latents, return_dict=False)[0],
+    }
+    diffs = {}
+    for name, module_inputs in inputs.items():
+        diffs[name] = (references[name](*module_inputs) - backend.run(name, *module_inputs)).abs().max().item()
+
+    input_ids = batch["input_ids"].flatten(0, 1)
+    diffs["text_embeddings"] = (model.text_encoder(input_ids)[0] - backend.encode_prompts(input_ids)).abs().max().item()
+
+    def generate():
+        results, _ = model.fashion_generation(
+            **batch,
+            history=history,
+            num_inference_steps=num_inference_steps,
+            null_img=null_img,
+            generator=torch.Generator().manual_seed(seed),
+            output_type="latent",
+            return_dict=False,
+        )
+        return torch.stack([img for uid in results for oid in results[uid] for img in results[uid][oid]["images"]])
+
+    model.set_onnx_backend(None)
+    torch_latents = generate()
+    model.set_onnx_backend(backend)
+    onnx_latents = generate()
+    model.set_onnx_backend(None)
+    diffs["generated_latents"] = (torch_latents - onnx_latents).abs().max().item()
+    return diffs
+
+
+def main():
+    args = parse_all_args()
+    if args.checkpoint_dir is None and not args.tiny:
+        raise ValueError("Pass a `--checkpoint_dir` to export, or `--tiny`.")
+
+    with tempfile.TemporaryDirectory() as tiny_dir:
+        model_args = SimpleNamespace(
+            pretrained_model_name_or_path=args.pretrained_model_name_or_path, revision=None, non_ema_revision=None,
+            category_emb_size=None, hid_dim=None, enable_xformers_memory_efficient_attention=False, eta=args.eta,
+            use_history=True, use_mutual_guidance=True,
+        )
+        if args.tiny:
+            tiny_args = SimpleNamespace(
+                latent_size=16, unet_channels="32,64", cate_num=10, batch_size=2, outfit_length=4, num_blanks=1,
+                seed=args.seed,
+            )
+            save_tiny_bundle(tiny_dir, tiny_args)
+            model_args.pretrained_model_name_or_path = tiny_dir
+            model = DiFashion(model_args, logger, tiny_args.cate_num, "cpu", checkpoint_dir=tiny_dir)
+            image_size = tiny_args.latent_size * model.vae_scale_factor
+            batch = random_batch(tiny_args, image_size, model.text_encoder.config.vocab_size)
+            prompt_input_ids = torch.cat([batch["input_ids"].flatten(0, 1), model.tokenizer(
+                [""], max_length=batch["input_ids"].shape[-1], padding="max_length", return_tensors="pt"
+            ).input_ids])
+        else:
+            data_path = os.path.join(args.data_path, args.dataset_name)
+            id_cate_dict = np.load(os.path.join(data_path, "id_cate_dict.npy"), allow_pickle=True).item()
+            model = DiFashion(model_args, logger, len(id_cate_dict), "cpu", checkpoint_dir=args.checkpoint_dir,
+                              use_ema=args.use_ema, use_ema_fashion=args.use_ema_fashion)
+            prompt_input_ids = category_input_ids(model, id_cate_dict)
+        model.eval()
+
+        export_onnx(model, args.output_dir, prompt_input_ids, args.opset)
+
+        if args.check_parity:
+            if not args.tiny:
+                tiny_args = SimpleNamespace(batch_size=2, outfit_length=4, num_blanks=1, cate_num=len(id_cate_dict),
+                                            seed=args.seed)
+                image_size = model.unet.config.sample_size * model.vae_scale_factor
+                batch = random_batch(tiny_args, image_size, model.text_encoder.config.vocab_size)
+                # real prompts, which are in the exported table
+                batch["input_ids"] = prompt_input_ids[batch["category"]]
+            history = {uid: {} for uid in batch["uids"].tolist()}
+            null_img = torch.ones(3, image_size, image_size)
+            backend = OnnxBackend(args.output_dir)
+            diffs = check_parity(model, backend, batch, history, null_img, args.num_inference_steps, args.seed)
+            for name, diff in diffs.items():
+                logger.info(f"{name:>18}: max abs diff {diff:.2e} {'ok' if diff <= args.atol else 'MISMATCH'}")
+            if any(diff > args.atol for diff in diffs.values()):
+                raise SystemExit(f"ONNX Runtime and PyTorch differ by more than {args.atol}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ import logging
 import math
 import os
 import shutil
+import time
 from pathlib import Path
 from tqdm import tqdm
 
@@ -50,7 +51,13 @@ from diffusers.training_utils import EMAModel
 from diffusers.utils import check_min_version, deprecate, is_wandb_available
 
 import data_utils
-from models.difashion import DiFashion, MutualEncoder
+from models.difashion import DiFashion, MutualEncoder, INFERENCE_SCHEDULERS, COMPILE_BUCKETS
+from models.guidance import GuidanceSchedule
+from models.cpu_inference import configure_cpu_threads, cpu_autocast_dtype
+from models.onnx_backend import OnnxBackend
+from inference_reports import (generation_autocast, inference_weight_dtype, token_merging_ratios, run_sampler_sweep,
+                               run_compile_report, run_quantization_report, run_feature_cache_report,
+                               run_token_merging_report)
 
 # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
 check_min_version("0.16.0")
@@ -171,6 +178,34 @@ def parse_all_args():
         type=int,
         default=50
     )
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="pndm",
+        choices=list(INFERENCE_SCHEDULERS.keys()),
+        help="The sampler (diffusers scheduler) used for generation.",
+    )
+    parser.add_argument(
+        "--sweep_samplers",
+        type=str,
+        default=None,
+        help=(
+            "Comma-separated samplers, e.g. `ddim,dpm++,unipc,euler`. If set, run a sampler x steps sweep on a fixed"
+            " FITB subset instead of the full inference, reporting latency, CLIP retrieval accuracy and CLIP score."
+        ),
+    )
+    parser.add_argument(
+        "--sweep_steps",
+        type=str,
+        default="10,15,20,25,50",
+        help="Comma-separated numbers of inference steps for `--sweep_samplers`.",
+    )
+    parser.add_argument(
+        "--sweep_num_batches",
+        type=int,
+        default=10,
+        help="Number of test batches (the first ones, in a fixed order) used by `--sweep_samplers`.",
+    )
     parser.add_argument(
         "--category_guidance_scale",
         type=float,
@@ -186,6 +221,27 @@ def parse_all_args():
         type=float,
         default=5.0
     )
+    parser.add_argument(
+        "--guidance_configs",
+        type=str,
+        default=None,
+        help=(
+            "Comma-separated `<category>:<mutual>:<hist>` guidance scales, e.g. `12:5:4,7.5:5:2`. All the"
+            " configurations are generated in one batched pass per test batch, with the same initial noise, and"
+            " saved to their own files. Defaults to the single configuration of the `--*_guidance_scale` args."
+        ),
+    )
+    for cond in ["category", "mutual", "hist"]:
+        parser.add_argument(
+            f"--{cond}_guidance_schedule",
+            type=str,
+            default=None,
+            help=(
+                f"Timestep schedule of the {cond} guidance, `<decay>` or `<decay>:<start>:<end>` with decay in"
+                " constant/linear/cosine and the active interval as fractions of the training timesteps, e.g."
+                " `constant:0.3:1.0`. Outside the interval the branch is dropped from the UNet batch."
+            ),
+        )
     parser.add_argument(
         "--mode",
         type=str,
@@ -254,6 +310,30 @@ def parse_all_args():
             " https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices"
         ),
     )
+    parser.add_argument(
+        "--lean_inference",
+        action="store_true",
+        help=(
+            "Load only the (EMA) UNet and mutual encoder weights of every checkpoint into one model, without the"
+            " train dataloader, optimizer, LR scheduler, EMA copies and `accelerator.load_state`."
+        ),
+    )
+    parser.add_argument(
+        "--inference_dtype",
+        type=str,
+        default=None,
+        choices=["fp32", "fp16", "bf16"],
+        help="Dtype the weights are cast to at load time with `--lean_inference`. Defaults to `--mixed_precision`.",
+    )
+    parser.add_argument(
+        "--export_bundle",
+        type=str,
+        default=None,
+        help=(
+            "Export the inference weights of every checkpoint as a compact bundle into `<export_bundle>/<checkpoint>`,"
+            " which `--lean_inference` can load in place of the checkpoint."
+        ),
+    )
     parser.add_argument("--use_ema", action="store_true", help="Whether to use EMA model.")
     parser.add_argument("--use_ema_fashion", action="store_true", help="Whether to use EMA model for fashion encoder.")
     parser.add_argument(
@@ -340,6 +420,186 @@ def parse_all_args():
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
     )
+    parser.add_argument(
+        "--cpu_dtype",
+        type=str,
+        default="bf16",
+        choices=["bf16", "fp32"],
+        help="Autocast dtype of inference on CPU; bf16 falls back to fp32 on CPUs without bf16 support.",
+    )
+    parser.add_argument(
+        "--cpu_threads", type=int, default=None, help="Number of intra-op threads on CPU, defaults to the torch setting."
+    )
+    parser.add_argument(
+        "--cpu_interop_threads", type=int, default=None, help="Number of inter-op threads on CPU, defaults to the torch setting."
+    )
+    parser.add_argument(
+        "--channels_last", action="store_true", help="Run the convolutions of the UNet and the VAE in channels_last."
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Run the UNet and the mutual encoder with torch.compile, on batches padded to `--compile_buckets`.",
+    )
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        default=None,
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="Mode of torch.compile.",
+    )
+    parser.add_argument(
+        "--compile_buckets",
+        type=str,
+        default=",".join(str(bucket) for bucket in COMPILE_BUCKETS),
+        help="Comma-separated UNet batch sizes (rows) that the CFG batches are padded to, one compiled graph each.",
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help="Folder of the compiled kernels and graphs, reused across processes.",
+    )
+    parser.add_argument(
+        "--compile_report",
+        action="store_true",
+        help=(
+            "Before the inference, time the first `--compile_report_batches` test batches eagerly and compiled, and"
+            " report the compile time against the steady-state speedup."
+        ),
+    )
+    parser.add_argument(
+        "--auto_batch_size",
+        action="store_true",
+        help=(
+            "Pick the test batch size from the peak CUDA memory of probe batches for the active guidance"
+            " configurations, instead of the fixed 15 (FITB) or 4 (GOR) outfits, and split the batches that still run"
+            " out of memory."
+        ),
+    )
+    parser.add_argument(
+        "--auto_batch_memory_fraction",
+        type=float,
+        default=0.9,
+        help="Fraction of the available CUDA memory that `--auto_batch_size` plans for.",
+    )
+    parser.add_argument(
+        "--max_test_batch_size", type=int, default=64, help="Largest test batch size of `--auto_batch_size`."
+    )
+    parser.add_argument(
+        "--compile_report_batches", type=int, default=5, help="Number of test batches of `--compile_report`."
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["dynamic", "weight_only"],
+        help=(
+            "Int8 linear layers of the mutual encoder and of the UNet attention and feed-forward blocks, with"
+            " `--lean_inference`: `dynamic` also quantizes the activations (CPU only), `weight_only` only the weights"
+            " (faster only on CPU with the int8 weight GEMM of recent PyTorch, otherwise a size-only option)."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_report",
+        action="store_true",
+        help=(
+            "Before the inference, generate the first `--quantize_report_batches` FITB test batches in fp32 and"
+            " quantized, and report the latency, the latent difference and the CLIP retrieval accuracy of both."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_report_batches", type=int, default=5, help="Number of test batches of `--quantize_report`."
+    )
+    parser.add_argument(
+        "--feature_cache_interval",
+        type=int,
+        default=None,
+        help=(
+            "Reuse the deep UNet features across denoising steps (DeepCache): run the whole UNet every this many"
+            " steps, and only its shallow blocks in between."
+        ),
+    )
+    parser.add_argument(
+        "--feature_cache_branch",
+        type=int,
+        default=1,
+        help="Number of shallow down and up blocks that `--feature_cache_interval` runs at every step.",
+    )
+    parser.add_argument(
+        "--feature_cache_report",
+        action="store_true",
+        help=(
+            "Before the inference, generate the first `--feature_cache_report_batches` FITB test batches with and"
+            " without the feature cache, and report the speedup, the latent difference and the CLIP retrieval accuracy."
+        ),
+    )
+    parser.add_argument(
+        "--feature_cache_report_batches", type=int, default=5, help="Number of test batches of `--feature_cache_report`."
+    )
+    parser.add_argument(
+        "--token_merging",
+        type=str,
+        default=None,
+        help=(
+            "Comma-separated fractions of the UNet self-attention tokens merged at every resolution level, from the"
+            " latent resolution, e.g. `0.5` or `0.5,0.25`; the other levels are not merged (token merging, ToMe)."
+        ),
+    )
+    parser.add_argument(
+        "--token_merging_threshold",
+        type=float,
+        default=None,
+        help="Only merge the tokens more similar (cosine) than this, at most `--token_merging` of them.",
+    )
+    parser.add_argument(
+        "--token_merging_report",
+        action="store_true",
+        help=(
+            "Before the inference, generate the first `--token_merging_report_batches` FITB test batches with and"
+            " without token merging, and report the speedup, the peak memory, the latent difference and the CLIP"
+            " retrieval accuracy."
+        ),
+    )
+    parser.add_argument(
+        "--token_merging_report_batches", type=int, default=5, help="Number of test batches of `--token_merging_report`."
+    )
+    parser.add_argument(
+        "--prompt_kv_cache",
+        type=str,
+        default=None,
+        choices=["call", "persistent"],
+        help=(
+            "Project the prompts to the cross-attention keys and values once per unique prompt, for every generation"
+            " call (`call`) or once per category prompt across calls (`persistent`), instead of at every step for"
+            " every row."
+        ),
+    )
+    parser.add_argument(
+        "--preview_decoder",
+        type=str,
+        default=None,
+        help=(
+            "Folder of a preview decoder distilled with `distill_preview_decoder.py`: decode the generated images with"
+            " it (`output_type='preview'`) instead of the VAE decoder, e.g. for quick grounding or thumbnails."
+        ),
+    )
+    parser.add_argument(
+        "--vae_decode_chunk_size",
+        type=int,
+        default=None,
+        help="Decode the generated latents with the VAE this many at a time, to bound the memory of large batches.",
+    )
+    parser.add_argument("--vae_tiling", action="store_true", help="Decode large latents with the VAE in tiles.")
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help=(
+            "Folder exported by `export_onnx.py`: run the UNet, the mutual encoder, the VAE and the text encoder with"
+            " ONNX Runtime instead of PyTorch. The exported weights replace those of the inferred checkpoints."
+        ),
+    )
     parser.add_argument("--noise_offset", type=float, default=0, help="The scale of noise offset.")
     parser.add_argument(
         "--tracker_project_name",
@@ -365,6 +625,66 @@ def parse_all_args():
 
     return args
 
+def parse_guidance_schedules(args):
+    # keyword arguments of `fashion_generation`
+    guidance_schedules = {}
+    for cond in ["category", "mutual", "hist"]:
+        spec = getattr(args, f"{cond}_guidance_schedule")
+        if spec is not None:
+            guidance_schedules[f"{cond}_guidance_schedule"] = GuidanceSchedule.from_string(spec)
+    return guidance_schedules
+
+def parse_guidance_configs(args):
+    # (category, mutual, hist) guidance scales of every configuration
+    if args.guidance_configs is None:
+        return [(args.category_guidance_scale, args.mutual_guidance_scale, args.hist_guidance_scale)]
+    configs = []
+    for spec in args.guidance_configs.split(","):
+        scales = spec.strip().split(":")
+        if len(scales) != 3:
+            raise ValueError(f"Guidance configuration `{spec}` is not `<category>:<mutual>:<hist>`.")
+        configs.append(tuple(float(scale) for scale in scales))
+    return configs
+
+def optimize_inference_model(args, diffusion, device):
+    # again after every `load_inference_weights`, which replaces the UNet
+    if args.compile and args.prompt_kv_cache is not None:
+        # the compiled UNet runs on batches padded to a bucket, whose rows have no cached keys and values
+        raise ValueError("`--prompt_kv_cache` does not work with `--compile`.")
+    if args.onnx_dir is not None and args.prompt_kv_cache is not None:
+        raise ValueError("`--prompt_kv_cache` does not work with `--onnx_dir`, which runs the exported UNet.")
+    if args.compile and args.feature_cache_interval is not None:
+        # the split UNet forward of the feature cache is not compiled
+        raise ValueError(
+            "`--feature_cache_interval` does not work with `--compile`, which would only cover the mutual encoder."
+        )
+    if device.type == "cpu":
+        diffusion.enable_sdpa_attention()
+    if args.channels_last:
+        diffusion.to_channels_last()
+    if args.quantize is not None and diffusion.quantization is None and not args.quantize_report:
+        # `load_inference_weights` quantizes the new modules itself; the report quantizes after its fp32 pass
+        diffusion.quantize_linear_layers(args.quantize)
+    if args.feature_cache_interval is not None and diffusion.feature_cache is None:
+        diffusion.enable_feature_cache(args.feature_cache_interval, args.feature_cache_branch)
+    if args.token_merging is not None and diffusion.token_merging is None:
+        # `load_inference_weights` hooks the new UNet itself
+        diffusion.enable_token_merging(token_merging_ratios(args), threshold=args.token_merging_threshold)
+    if args.prompt_kv_cache is not None:
+        # after the attention processors above
+        diffusion.enable_prompt_kv_cache(persistent=args.prompt_kv_cache == "persistent")
+    if args.preview_decoder is not None and diffusion.preview_decoder is None:
+        diffusion.load_preview_decoder(args.preview_decoder)
+    if args.vae_decode_chunk_size is not None:
+        diffusion.enable_vae_slicing(args.vae_decode_chunk_size)
+    if args.vae_tiling:
+        diffusion.enable_vae_tiling()
+    if args.compile and not diffusion.compiled_modules:
+        # `load_inference_weights` compiles the new modules itself
+        diffusion.enable_compiled_generation(
+            [int(bucket) for bucket in args.compile_buckets.split(",")], args.compile_mode, args.compile_cache_dir
+        )
+
 def main():
     args = parse_all_args()
 
@@ -395,6 +715,26 @@ def main():
         project_config=accelerator_project_config,
     )
     device = accelerator.device
+    if args.quantize is not None and not args.lean_inference:
+        # the training stack restores the checkpoints and the EMA weights into the float layers
+        raise ValueError("`--quantize` needs `--lean_inference`.")
+    if args.quantize_report and (args.quantize is None or args.compile):
+        raise ValueError("`--quantize_report` needs `--quantize`, without `--compile`.")
+    if args.feature_cache_report and args.feature_cache_interval is None:
+        raise ValueError("`--feature_cache_report` needs `--feature_cache_interval`.")
+    if args.token_merging_report and args.token_merging is None:
+        raise ValueError("`--token_merging_report` needs `--token_merging`.")
+    if args.auto_batch_size and not 0.0 < args.auto_batch_memory_fraction <= 1.0:
+        raise ValueError(f"`--auto_batch_memory_fraction` should be in (0, 1], but is {args.auto_batch_memory_fraction}.")
+    if device.type == "cpu":
+        num_threads, num_interop_threads = configure_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+        if cpu_autocast_dtype(args.cpu_dtype) is None and args.cpu_dtype != "fp32":
+            print("This CPU has no bf16 support, fall back to fp32.")
+            args.cpu_dtype = "fp32"
+        if args.enable_xformers_memory_efficient_attention:
+            # xformers kernels are CUDA-only, see `DiFashion.enable_sdpa_attention` for CPU
+            args.enable_xformers_memory_efficient_attention = False
+        print(f"CPU inference with {num_threads} intra-op and {num_interop_threads} inter-op threads, {args.cpu_dtype}.")
 
     generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)
     
@@ -428,8 +768,12 @@ def main():
     data_path = os.path.join(args.data_path, args.dataset_name)
 
     if args.data_processed:
-        train_dict = np.load(os.path.join(data_path, "processed", "train.npy"), allow_pickle=True).item()
-        train_history = np.load(os.path.join(data_path, "processed", "train_hist_latents.npy"), allow_pickle=True).item()
+        if args.lean_inference:
+            # the training data is only needed to build the training stack
+            train_dict, train_history = None, None
+        else:
+            train_dict = np.load(os.path.join(data_path, "processed", "train.npy"), allow_pickle=True).item()
+            train_history = np.load(os.path.join(data_path, "processed", "train_hist_latents.npy"), allow_pickle=True).item()
 
         if args.mode == "test":
             test_fitb_dict = np.load(os.path.join(data_path, "processed", "fitb_test.npy"), allow_pickle=True).item()
@@ -471,8 +815,24 @@ def main():
     elif accelerator.mixed_precision == "bf16":
         weight_dtype = torch.bfloat16
 
+    # inf_list = ["checkpoint-5000","checkpoint-6000","checkpoint-7000","checkpoint-8000","checkpoint-9000","checkpoint-10000","checkpoint-11000","checkpoint-12000","checkpoint-13000","checkpoint-14000","checkpoint-15000"]  # ,"checkpoint-16000","checkpoint-17000","checkpoint-18000","checkpoint-19000","checkpoint-20000"]
+    inf_list = ["checkpoint-15000"]
+
     logger.info("Build the diffusion model......")
-    diffusion = DiFashion(args, logger, len(new_id_cate_dict), device)
+    if args.lean_inference:
+        # built directly from the weights of the first checkpoint, without the pretrained UNet and the initialization
+        inference_dtype = inference_weight_dtype(args, accelerator)
+        loaded_checkpoint = inf_list[0]
+        diffusion = DiFashion(args, logger, len(new_id_cate_dict), device, os.path.join(args.output_dir, loaded_checkpoint),
+            args.use_ema, args.use_ema_fashion, inference_dtype)
+    else:
+        diffusion = DiFashion(args, logger, len(new_id_cate_dict), device)
+    diffusion.set_inference_scheduler(args.sampler)
+    optimize_inference_model(args, diffusion, device)
+    if args.onnx_dir is not None:
+        diffusion.set_onnx_backend(OnnxBackend(args.onnx_dir, num_threads=args.cpu_threads))
+    guidance_schedules = parse_guidance_schedules(args)
+    guidance_configs = parse_guidance_configs(args)
     logger.info("Completed.")
 
     with accelerator.main_process_first():
@@ -508,13 +868,14 @@ def main():
 
             logger.info(f"Successfully processed and saved the dataset for training, validation and test into {save_path}.")
 
-    train_dataset = data_utils.FashionDiffusionData(train_data_dict)
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        shuffle=True,
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
-    )
+    if not args.lean_inference:
+        train_dataset = data_utils.FashionDiffusionData(train_data_dict)
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            shuffle=True,
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+        )
 
     test_dataset = data_utils.FashionDiffusionData(test_data_dict)
     if args.task == "FITB":
@@ -528,143 +889,149 @@ def main():
         num_workers=args.dataloader_num_workers,
     )
     logger.info("dataloader built.")
+    # number of guidance configurations -> batch size, see `--auto_batch_size`
+    auto_batch_sizes = {}
 
-    # Create EMA for the unet.
-    if args.use_ema:
-        ema_unet = EMAModel(diffusion.unet.parameters(), model_cls=UNet2DConditionModel, model_config=diffusion.unet.config)
-    
-    if args.use_ema_fashion:
-        ema_encoder = EMAModel(diffusion.fashion_encoder.parameters(), model_cls=MutualEncoder, model_config=diffusion.fashion_encoder.config)
-
-    # `accelerate` 0.16.0 will have better support for customized saving
-    if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
-        # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
-        def save_model_hook(models, weights, output_dir):
-            if args.use_ema:
-                ema_unet.save_pretrained(os.path.join(output_dir, "unet_ema"))
-            if args.use_ema_fashion:
-                ema_encoder.save_pretrained(os.path.join(output_dir, "fashion_encoder_ema"))
-
-            for i, model in enumerate(models):
-                model.fashion_encoder.save_pretrained(os.path.join(output_dir, "fashion_encoder"))
-                model.unet.save_pretrained(os.path.join(output_dir, "unet"))
-
-                # make sure to pop weight so that corresponding model is not saved again
-                weights.pop()
-
-        def load_model_hook(models, input_dir):
-            if args.use_ema:
-                load_model = EMAModel.from_pretrained(os.path.join(input_dir, "unet_ema"), UNet2DConditionModel)
-                ema_unet.load_state_dict(load_model.state_dict())
-                ema_unet.to(device)
-                del load_model
-            
-            if args.use_ema_fashion:
-                load_model = EMAModel.from_pretrained(os.path.join(input_dir, "fashion_encoder_ema"), MutualEncoder)
-                ema_encoder.load_state_dict(load_model.state_dict())
-                ema_encoder.to(device)
-                del load_model
-
-            for i in range(len(models)):
-                # pop models so that they are not loaded again
-                model = models.pop()
-                load_model = UNet2DConditionModel.from_pretrained(input_dir, subfolder="unet")
-                model.unet.register_to_config(**load_model.config)
-                model.unet.load_state_dict(load_model.state_dict())
-                del load_model
-
-                # load mutual encoder into model
-                load_model = MutualEncoder.from_pretrained(input_dir, subfolder="fashion_encoder")
-                model.fashion_encoder.register_to_config(**load_model.config)
-                model.fashion_encoder.load_state_dict(load_model.state_dict())
-                del load_model
-
-        accelerator.register_save_state_pre_hook(save_model_hook)
-        accelerator.register_load_state_pre_hook(load_model_hook)
-
-    if args.gradient_checkpointing:
-        diffusion.unet.enable_gradient_checkpointing()
+    item_latents = None
+    if args.task == "FITB":
+        # the latents of the FITB context items, precomputed by the preprocessing
+        item_latents = data_utils.load_item_latents(data_path, img_dataset, diffusion.vae, device)
 
     # Enable TF32 for faster training on Ampere GPUs,
     # cf https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices
     if args.allow_tf32:
         torch.backends.cuda.matmul.allow_tf32 = True
 
-    if args.scale_lr:
-        args.learning_rate = (
-            args.learning_rate * args.gradient_accumulation_steps * args.train_batch_size * accelerator.num_processes
-        )
-
-    # Initialize the optimizer
-    if args.use_8bit_adam:
-        try:
-            import bitsandbytes as bnb
-        except ImportError:
-            raise ImportError(
-                "Please install bitsandbytes to use 8-bit Adam. You can do so by running `pip install bitsandbytes`"
-            )
-
-        optimizer_cls = bnb.optim.AdamW8bit
+    if args.lean_inference:
+        diffusion.to(device)
+        diffusion.eval()
     else:
-        optimizer_cls = torch.optim.AdamW
+        # Create EMA for the unet.
+        if args.use_ema:
+            ema_unet = EMAModel(diffusion.unet.parameters(), model_cls=UNet2DConditionModel, model_config=diffusion.unet.config)
+    
+        if args.use_ema_fashion:
+            ema_encoder = EMAModel(diffusion.fashion_encoder.parameters(), model_cls=MutualEncoder, model_config=diffusion.fashion_encoder.config)
+
+        # `accelerate` 0.16.0 will have better support for customized saving
+        if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
+            # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
+            def save_model_hook(models, weights, output_dir):
+                if args.use_ema:
+                    ema_unet.save_pretrained(os.path.join(output_dir, "unet_ema"))
+                if args.use_ema_fashion:
+                    ema_encoder.save_pretrained(os.path.join(output_dir, "fashion_encoder_ema"))
+
+                for i, model in enumerate(models):
+                    model.fashion_encoder.save_pretrained(os.path.join(output_dir, "fashion_encoder"))
+                    model.unet.save_pretrained(os.path.join(output_dir, "unet"))
+
+                    # make sure to pop weight so that corresponding model is not saved again
+                    weights.pop()
+
+            def load_model_hook(models, input_dir):
+                if args.use_ema:
+                    load_model = EMAModel.from_pretrained(os.path.join(input_dir, "unet_ema"), UNet2DConditionModel)
+                    ema_unet.load_state_dict(load_model.state_dict())
+                    ema_unet.to(device)
+                    del load_model
+            
+                if args.use_ema_fashion:
+                    load_model = EMAModel.from_pretrained(os.path.join(input_dir, "fashion_encoder_ema"), MutualEncoder)
+                    ema_encoder.load_state_dict(load_model.state_dict())
+                    ema_encoder.to(device)
+                    del load_model
+
+                for i in range(len(models)):
+                    # pop models so that they are not loaded again
+                    model = models.pop()
+                    load_model = UNet2DConditionModel.from_pretrained(input_dir, subfolder="unet")
+                    model.unet.register_to_config(**load_model.config)
+                    model.unet.load_state_dict(load_model.state_dict())
+                    del load_model
+
+                    # load mutual encoder into model
+                    load_model = MutualEncoder.from_pretrained(input_dir, subfolder="fashion_encoder")
+                    model.fashion_encoder.register_to_config(**load_model.config)
+                    model.fashion_encoder.load_state_dict(load_model.state_dict())
+                    del load_model
+
+            accelerator.register_save_state_pre_hook(save_model_hook)
+            accelerator.register_load_state_pre_hook(load_model_hook)
+
+        if args.gradient_checkpointing:
+            diffusion.unet.enable_gradient_checkpointing()
+
+        if args.scale_lr:
+            args.learning_rate = (
+                args.learning_rate * args.gradient_accumulation_steps * args.train_batch_size * accelerator.num_processes
+            )
 
-    logger.info("build the optimizer...")
-    train_params = list(diffusion.unet.parameters()) + list(diffusion.fashion_encoder.parameters())
-    optimizer = optimizer_cls(
-        train_params,
-        lr=args.learning_rate,
-        betas=(args.adam_beta1, args.adam_beta2),
-        weight_decay=args.adam_weight_decay,
-        eps=args.adam_epsilon,
-    )
+        # Initialize the optimizer
+        if args.use_8bit_adam:
+            try:
+                import bitsandbytes as bnb
+            except ImportError:
+                raise ImportError(
+                    "Please install bitsandbytes to use 8-bit Adam. You can do so by running `pip install bitsandbytes`"
+                )
 
-    # Scheduler and math around the number of training steps.
-    overrode_max_train_steps = False
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-    if args.max_train_steps is None:
-        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
-        overrode_max_train_steps = True
+            optimizer_cls = bnb.optim.AdamW8bit
+        else:
+            optimizer_cls = torch.optim.AdamW
+
+        logger.info("build the optimizer...")
+        train_params = list(diffusion.unet.parameters()) + list(diffusion.fashion_encoder.parameters())
+        optimizer = optimizer_cls(
+            train_params,
+            lr=args.learning_rate,
+            betas=(args.adam_beta1, args.adam_beta2),
+            weight_decay=args.adam_weight_decay,
+            eps=args.adam_epsilon,
+        )
 
-    lr_scheduler = get_scheduler(
-        args.lr_scheduler,
-        optimizer=optimizer,
-        num_warmup_steps=args.lr_warmup_steps * args.gradient_accumulation_steps,
-        num_training_steps=args.max_train_steps * args.gradient_accumulation_steps,
-    )
+        # Scheduler and math around the number of training steps.
+        overrode_max_train_steps = False
+        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+        if args.max_train_steps is None:
+            args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+            overrode_max_train_steps = True
+
+        lr_scheduler = get_scheduler(
+            args.lr_scheduler,
+            optimizer=optimizer,
+            num_warmup_steps=args.lr_warmup_steps * args.gradient_accumulation_steps,
+            num_training_steps=args.max_train_steps * args.gradient_accumulation_steps,
+        )
 
-    # Prepare everything with our `accelerator`.
-    logger.info("Prepare everything with our accelerator...")
-    diffusion, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        diffusion, optimizer, train_dataloader, lr_scheduler
-    )
+        # Prepare everything with our `accelerator`.
+        logger.info("Prepare everything with our accelerator...")
+        diffusion, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            diffusion, optimizer, train_dataloader, lr_scheduler
+        )
 
-    if args.use_ema:
-        ema_unet.to(device)
+        if args.use_ema:
+            ema_unet.to(device)
     
-    if args.use_ema_fashion:
-        ema_encoder.to(device)
-
-    # We need to recalculate our total training steps as the size of the training dataloader may have changed.
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-    if overrode_max_train_steps:
-        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
-    # Afterwards we recalculate our number of training epochs
-    args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
-
-    # We need to initialize the trackers we use, and also store our configuration.
-    # The trackers initializes automatically on the main process.
-    if accelerator.is_main_process:
-        tracker_config = dict(vars(args))
-        accelerator.init_trackers("difashion", config=tracker_config)
+        if args.use_ema_fashion:
+            ema_encoder.to(device)
+
+        # We need to recalculate our total training steps as the size of the training dataloader may have changed.
+        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+        if overrode_max_train_steps:
+            args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+        # Afterwards we recalculate our number of training epochs
+        args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
+
+        # We need to initialize the trackers we use, and also store our configuration.
+        # The trackers initializes automatically on the main process.
+        if accelerator.is_main_process:
+            tracker_config = dict(vars(args))
+            accelerator.init_trackers("difashion", config=tracker_config)
 
     # Inference phase
     global_step = 0
-    # inf_list = ["checkpoint-5000","checkpoint-6000","checkpoint-7000","checkpoint-8000","checkpoint-9000","checkpoint-10000","checkpoint-11000","checkpoint-12000","checkpoint-13000","checkpoint-14000","checkpoint-15000"]  # ,"checkpoint-16000","checkpoint-17000","checkpoint-18000","checkpoint-19000","checkpoint-20000"]
-    inf_list = ["checkpoint-15000"]
-    scale_list = [2.0]
-
     logger.info(f"inf list: {inf_list}")
-    logger.info(f"scale list: {scale_list}")
 
     if args.mode == "test":
         save_path = os.path.join(args.output_dir, "eval-test")
@@ -682,87 +1049,183 @@ def main():
             print(f"Groundtruth file already exists in {grd_save_path}.")
             save_grd = False
 
-        accelerator.print(f"Resuming from checkpoint {path}")
-        accelerator.load_state(os.path.join(args.output_dir, path))
+        if args.lean_inference:
+            if path != loaded_checkpoint:
+                if args.quantize_report:
+                    # the report of every checkpoint starts from its fp32 weights
+                    diffusion.quantization = None
+                accelerator.print(f"Loading the inference weights of checkpoint {path}")
+                diffusion.load_inference_weights(os.path.join(args.output_dir, path), args.use_ema,
+                    args.use_ema_fashion, inference_dtype, device)
+                optimize_inference_model(args, diffusion, device)
+                loaded_checkpoint = path
+            unwrapped_model = diffusion
+        else:
+            accelerator.print(f"Resuming from checkpoint {path}")
+            accelerator.load_state(os.path.join(args.output_dir, path))
         if accelerator.is_main_process:
-            diffusion.eval()
-            unwrapped_model = accelerator.unwrap_model(diffusion)
-            if args.use_ema:
-                # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
-                ema_unet.store(unwrapped_model.unet.parameters())
-                ema_unet.copy_to(unwrapped_model.unet.parameters())
-            if args.use_ema_fashion:
-                ema_encoder.store(unwrapped_model.fashion_encoder.parameters())
-                ema_encoder.copy_to(unwrapped_model.fashion_encoder.parameters())
+            if not args.lean_inference:
+                diffusion.eval()
+                unwrapped_model = accelerator.unwrap_model(diffusion)
+                if args.use_ema:
+                    # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
+                    ema_unet.store(unwrapped_model.unet.parameters())
+                    ema_unet.copy_to(unwrapped_model.unet.parameters())
+                if args.use_ema_fashion:
+                    ema_encoder.store(unwrapped_model.fashion_encoder.parameters())
+                    ema_encoder.copy_to(unwrapped_model.fashion_encoder.parameters())
+                if unwrapped_model.prompt_kv_cache is not None:
+                    # the weights were loaded in place
+                    unwrapped_model.prompt_kv_cache.clear()
+
+            if args.export_bundle is not None:
+                unwrapped_model.export_inference_bundle(os.path.join(args.export_bundle, path))
+
+            if args.compile_report:
+                run_compile_report(args, unwrapped_model, test_dataloader, img_dataset, item_latents,
+                    test_hist_latents, null_img, guidance_schedules, accelerator)
+
+            if args.quantize_report:
+                report_save_path = os.path.join(save_path, f"{args.task}-checkpoint-{global_step}-int8{args.quantize}-report.npy")
+                run_quantization_report(args, unwrapped_model, test_dataloader, img_dataset, item_latents,
+                    test_hist_latents, null_img, data_path, new_id_cate_dict, guidance_schedules, report_save_path,
+                    accelerator)
+
+            if args.feature_cache_report:
+                report_save_path = os.path.join(save_path, f"{args.task}-checkpoint-{global_step}-cache{args.feature_cache_interval}:{args.feature_cache_branch}-report.npy")
+                run_feature_cache_report(args, unwrapped_model, test_dataloader, img_dataset, item_latents,
+                    test_hist_latents, null_img, data_path, new_id_cate_dict, guidance_schedules, report_save_path,
+                    accelerator)
+
+            if args.token_merging_report:
+                report_save_path = os.path.join(save_path, f"{args.task}-checkpoint-{global_step}-tome{args.token_merging}-report.npy")
+                run_token_merging_report(args, unwrapped_model, test_dataloader, img_dataset, item_latents,
+                    test_hist_latents, null_img, data_path, new_id_cate_dict, guidance_schedules, report_save_path,
+                    accelerator)
+
+            if args.sweep_samplers is not None:
+                sweep_save_path = os.path.join(save_path, f"{args.task}-checkpoint-{global_step}-sampler-sweep.npy")
+                run_sampler_sweep(args, unwrapped_model, test_dataloader, img_dataset, item_latents,
+                    test_hist_latents, null_img, data_path, new_id_cate_dict, guidance_schedules, sweep_save_path,
+                    accelerator)
             
-            for scale in scale_list:
-                # You can change the conditional scales during inference
-                hist_guidance_scale = args.hist_guidance_scale
-                mutual_guidance_scale = args.mutual_guidance_scale
-                category_guidance_scale = args.category_guidance_scale
-
-                gen_save_path = os.path.join(save_path, f"{args.task}-checkpoint-{global_step}-cate{category_guidance_scale}-mutual{mutual_guidance_scale}-hist{hist_guidance_scale}")
-                if os.path.exists(gen_save_path):
-                    logger.info(f"{args.task}-checkpoint-{global_step}-cate{category_guidance_scale}-mutual{mutual_guidance_scale}-hist{hist_guidance_scale} has already been infered on Task {args.task}. Skip.")
-                    continue
-
-                logger.info(f"Running validation on {args.task}-checkpoint-{global_step}-cate{category_guidance_scale}-mutual{mutual_guidance_scale}-hist{hist_guidance_scale}...")
+            # You can change the conditional scales during inference
+            gen_save_paths = {}
+            if args.sweep_samplers is None:
+                # the sampler sweep replaces the inference over the guidance configurations
+                for category_guidance_scale, mutual_guidance_scale, hist_guidance_scale in guidance_configs:
+                    gen_save_path = os.path.join(save_path, f"{args.task}-checkpoint-{global_step}-cate{category_guidance_scale}-mutual{mutual_guidance_scale}-hist{hist_guidance_scale}")
+                    if args.sampler != "pndm":
+                        gen_save_path += f"-{args.sampler}{args.num_inference_steps}"
+                    if args.quantize is not None:
+                        gen_save_path += f"-int8{args.quantize}"
+                    if args.feature_cache_interval is not None:
+                        gen_save_path += f"-cache{args.feature_cache_interval}:{args.feature_cache_branch}"
+                    if args.preview_decoder is not None:
+                        gen_save_path += "-preview"
+                    if args.token_merging is not None:
+                        gen_save_path += f"-tome{args.token_merging}"
+                        if args.token_merging_threshold is not None:
+                            gen_save_path += f":{args.token_merging_threshold}"
+                    for name, schedule in guidance_schedules.items():
+                        gen_save_path += f"-{name.split('_')[0]}{schedule.decay}{schedule.interval[0]}:{schedule.interval[1]}"
+                    if os.path.exists(gen_save_path):
+                        logger.info(f"{gen_save_path} has already been infered on Task {args.task}. Skip.")
+                        continue
+                    gen_save_paths[(category_guidance_scale, mutual_guidance_scale, hist_guidance_scale)] = gen_save_path
+
+            if gen_save_paths:
+                configs = list(gen_save_paths.keys())
+
+                # [num_configs, 1] scales: every configuration denoises its own copy of the batch from the same noise
+                category_guidance_scale, mutual_guidance_scale, hist_guidance_scale = (
+                    torch.tensor(scales, dtype=torch.float64).unsqueeze(1) for scales in zip(*configs)
+                )
+
+                logger.info(f"Running validation on {args.task}-checkpoint-{global_step} with guidance configurations (cate, mutual, hist) {configs}...")
                 generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)  # refresh the generator with the same seed for another ckpt/guidance_scale
 
-                with torch.autocast(
-                    str(accelerator.device).replace(":0", ""), enabled=accelerator.mixed_precision == "fp16"
-                ):       
-                    outputs = {}
-                    all_grds = {}
-                    for i,batch in tqdm(enumerate(test_dataloader), total=len(test_dataloader)):
-                        uids = batch["uids"].to(device)
-                        oids = batch["oids"].to(device)
-                        input_ids = batch["input_ids"].to(device)
-                        category = batch["category"].to(device)
-                        olists = batch["outfits"].to(device)
-
-                        outfit_images = []
-                        if args.task == "FITB":
-                            for olist in olists:
-                                for iid in olist:
-                                    outfit_images.append(img_dataset[iid])
-                        else:
-                            for olist in olists:
-                                for iid in olist:
-                                    outfit_images.append(img_dataset[0])
-                            olists = torch.zeros_like(olists, dtype=int).to(device)
-                        outfit_images = torch.stack(outfit_images).to(device)
-                        batch_outputs, _ = unwrapped_model.fashion_generation(
+                def generate(batch, num_inference_steps, generator):
+                    uids = batch["uids"].to(device)
+                    oids = batch["oids"].to(device)
+                    input_ids = batch["input_ids"].to(device)
+                    category = batch["category"].to(device)
+                    olists = batch["outfits"].to(device)
+
+                    generation_kwargs = dict(
+                        num_inference_steps=num_inference_steps,
+                        category_guidance_scale=category_guidance_scale,
+                        hist_guidance_scale=hist_guidance_scale,
+                        mutual_guidance_scale=mutual_guidance_scale,
+                        **guidance_schedules,
+                        null_img=null_img,
+                        generator=generator,
+                        output_type="preview" if args.preview_decoder is not None else "pil",
+                        return_dict=False
+                    )
+                    if args.task == "FITB":
+                        # the latents of the context items are gathered from `item_latents`
+                        config_outputs, _ = unwrapped_model.fashion_generation(
                             uids,
                             oids,
                             input_ids,
                             olists,
-                            outfit_images,
+                            None,
                             category,
                             test_hist_latents,
-                            num_inference_steps=args.num_inference_steps,
-                            category_guidance_scale=category_guidance_scale,
-                            hist_guidance_scale=hist_guidance_scale,
-                            mutual_guidance_scale=mutual_guidance_scale,
-                            null_img=null_img,
-                            generator=generator,
-                            return_dict=False
+                            item_latents=item_latents,
+                            item_images=img_dataset,
+                            **generation_kwargs
+                        )
+                    else:
+                        config_outputs, _ = unwrapped_model.outfit_generation(
+                            uids, oids, input_ids, category, test_hist_latents, **generation_kwargs
                         )
-                        
-                        outputs, all_grds = save_batch_outputs(outputs, all_grds, batch_outputs, gen_save_path, args.task, 
-                                args.img_folder_path, all_image_paths, test_grd_dict, save_grd)
+                    return config_outputs
+
+                with generation_autocast(args, accelerator):
+                    dataloader = test_dataloader
+                    if args.auto_batch_size:
+                        if len(configs) not in auto_batch_sizes:
+                            auto_batch_sizes[len(configs)] = probe_test_batch_size(args, unwrapped_model, generate,
+                                test_dataset, test_batch_size, device)
+                        dataloader = torch.utils.data.DataLoader(
+                            test_dataset,
+                            shuffle=False,
+                            batch_size=auto_batch_sizes[len(configs)],
+                            num_workers=args.dataloader_num_workers,
+                        )
+
+                    outputs = {config: {} for config in configs}
+                    all_grds = {}
+                    def generate_batch(batch):
+                        return generate(batch, args.num_inference_steps, generator)
 
-                        np.save(gen_save_path, np.array(outputs))
+                    for i,batch in tqdm(enumerate(dataloader), total=len(dataloader)):
+                        # with `--auto_batch_size`, a batch that runs out of memory is generated in smaller parts
+                        if args.auto_batch_size:
+                            all_config_outputs = generate_with_backoff(generate_batch, batch)
+                        else:
+                            all_config_outputs = [generate_batch(batch)]
+
+                        for config_outputs in all_config_outputs:
+                            for config, batch_outputs in zip(configs, config_outputs):
+                                outputs[config], all_grds = save_batch_outputs(outputs[config], all_grds,
+                                    batch_outputs, gen_save_paths[config], args.task, args.img_folder_path,
+                                    all_image_paths, test_grd_dict, save_grd and config == configs[0])
+
+                        for config in configs:
+                            np.save(gen_save_paths[config], np.array(outputs[config]))
                         if save_grd:
                             np.save(grd_save_path, np.array(all_grds))
 
                         # if i > 2:
                         #     break
             
-            if args.use_ema:
+            if args.use_ema and not args.lean_inference:
                 # Switch back to the original UNet parameters.
                 ema_unet.restore(unwrapped_model.unet.parameters())
-            if args.use_ema_fashion:
+            if args.use_ema_fashion and not args.lean_inference:
                 ema_encoder.restore(unwrapped_model.fashion_encoder.parameters())
 
             torch.cuda.empty_cache()
@@ -770,6 +1233,96 @@ def main():
     logger.info(f"All the checkpoints in the inf_list have been inferenced for evaluation.")
     logger.info(f"inf list: {inf_list}")
 
+def split_batch(batch):
+    # the two halves of a test batch
+    half = (len(batch["uids"]) + 1) // 2
+    return [{key: value[:half] for key, value in batch.items()}, {key: value[half:] for key, value in batch.items()}]
+
+def generate_with_backoff(generate, batch):
+    """
+    The outputs of `generate` on `batch`, as a list: one output, or one per part if the batch ran out of CUDA
+    memory and was split in halves (recursively), so that the batch is retried instead of ending the run.
+    """
+    try:
+        return [generate(batch)]
+    except torch.cuda.OutOfMemoryError:
+        if len(batch["uids"]) == 1:
+            raise
+    # out of the `except` block, so that the memory held by the traceback is freed
+    torch.cuda.empty_cache()
+    logger.warning(f"Out of CUDA memory on a batch of {len(batch['uids'])} outfits, retry it in two halves.")
+    return [outputs for half in split_batch(batch) for outputs in generate_with_backoff(generate, half)]
+
+def probe_test_batch_size(args, model, generate, test_dataset, default_batch_size, device):
+    """
+    The largest test batch size (at most `args.max_test_batch_size`) whose generation fits in
+    `args.auto_batch_memory_fraction` of the CUDA memory available to it. The peak memory of
+    `generate(batch, num_inference_steps, generator)`, for the active guidance configurations, is measured on probe
+    batches of the 1 and 2 outfits with the most generated items (2 denoising steps, every step needs the same
+    memory) and extrapolated linearly. The probes run the eager UNet: with `--compile`, the UNet batches are then
+    padded to their bucket, which is accounted for with the UNet rows per outfit of the probes.
+    """
+    if device.type != "cuda":
+        logger.info(f"`--auto_batch_size` needs CUDA, keep the batch size {default_batch_size} on {device}.")
+        return default_batch_size
+    max_batch_size = min(args.max_test_batch_size, len(test_dataset))
+    if max_batch_size < 2:
+        return max_batch_size
+
+    # the worst case: the outfits with the most items to generate (every item for GOR)
+    order = list(range(len(test_dataset)))
+    if args.task == "FITB":
+        order.sort(key=lambda i: -int((torch.as_tensor(test_dataset[i]["outfits"]) == 0).sum()))
+    max_rows = [0]
+
+    def record_rows(module, inputs):
+        max_rows[0] = max(max_rows[0], inputs[0].shape[0])
+
+    def peak_memory(batch_size):
+        batch = torch.utils.data.default_collate([test_dataset[i] for i in order[:batch_size]])
+        max_rows[0] = 0
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        generate(batch, 2, torch.Generator(device=device).manual_seed(args.seed))
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+
+    # without the buckets of the compiled UNet, which would give both probes the same padded batch
+    compiled_modules = model.compiled_modules
+    model.disable_compiled_generation()
+    handle = model.unet.register_forward_pre_hook(record_rows)
+    try:
+        # warm up, so that the one-time allocations (kernels, workspaces) are not counted as per outfit
+        peak_memory(1)
+        one, two = peak_memory(1), peak_memory(2)
+        rows_per_outfit = max_rows[0] / 2
+    finally:
+        handle.remove()
+        model.compiled_modules = compiled_modules
+    per_outfit = max(two - one, 1)
+    fixed = max(one - per_outfit, 0)
+
+    def needed_memory(batch_size):
+        if "unet" not in compiled_modules or rows_per_outfit == 0:
+            return fixed + per_outfit * batch_size
+        # the padded rows of the bucket cost as much as real ones
+        rows = math.ceil(rows_per_outfit * batch_size)
+        return fixed + per_outfit * batch_size * model.bucket_size(rows) / rows
+
+    free, _ = torch.cuda.mem_get_info(device)
+    available = free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    budget = args.auto_batch_memory_fraction * available
+    batch_size = 1
+    while batch_size < max_batch_size and needed_memory(batch_size + 1) <= budget:
+        batch_size += 1
+    logger.info(
+        f"Auto batch size: {per_outfit / 2 ** 20:.0f}MiB per outfit and {fixed / 2 ** 20:.0f}MiB fixed, with"
+        f" {available / 2 ** 30:.1f}GiB available: batches of {batch_size} outfits."
+    )
+    return batch_size
+
 def save_batch_outputs(all_outputs, all_grds, outputs, gen_save_path, task, all_img_folder_path, all_image_paths, test_grd_dict, save_grd=True):
     for uid in outputs:
         for oid in outputs[uid]:
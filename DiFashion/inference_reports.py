@@ -0,0 +1,449 @@
+"""
+The benchmark reports of `inf4eval.py`: the sampler sweep and the compile, quantization, feature cache and token
+merging reports, with the CLIP evaluation of the generated FITB images they share.
+"""
+
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from accelerate.logging import get_logger
+from tqdm.auto import tqdm
+
+import data_utils
+from models.difashion import available_inference_schedulers
+from models.cpu_inference import cpu_autocast
+
+logger = get_logger(__name__, log_level="INFO")
+
+def inference_weight_dtype(args, accelerator):
+    precision = args.inference_dtype or accelerator.mixed_precision
+    return {"fp16": torch.float16, "bf16": torch.bfloat16}.get(precision, torch.float32)
+
+def generation_autocast(args, accelerator):
+    # fp16 mixed precision, or the dtype of the weights with `--lean_inference`; `--cpu_dtype` on CPU
+    device_type = str(accelerator.device).replace(":0", "")
+    if accelerator.device.type == "cpu":
+        return cpu_autocast(args.cpu_dtype)
+    if args.lean_inference:
+        dtype = inference_weight_dtype(args, accelerator)
+        return torch.autocast(device_type, dtype=dtype, enabled=dtype != torch.float32)
+    return torch.autocast(device_type, enabled=accelerator.mixed_precision == "fp16")
+
+def token_merging_ratios(args):
+    return [float(ratio) for ratio in args.token_merging.split(",")]
+
+SPECIAL_CATES = ["shoes", "pants", "sneakers", "boots", "earrings", "slippers", "sandals"]
+
+def cate_prompt(cid, id_cate_dict):
+    # the CLIP score prompt of `Evaluation/evaluate_fitb.py`
+    category = id_cate_dict[cid]
+    if any(special_cate in category for special_cate in SPECIAL_CATES):
+        return "A photo of a pair of " + category + ", on white background"
+    return "A photo of a " + category + ", on white background"
+
+class ClipEvaluator:
+    """
+    CLIP retrieval accuracy and CLIP score of generated FITB images, computed as in `Evaluation/evaluate_fitb.py`
+    (on the in-memory images): a generated image is correct if, among its retrieval candidates, it is the closest
+    to the ground-truth item.
+    """
+
+    def __init__(self, args, data_path, id_cate_dict, device):
+        try:
+            import open_clip
+        except ImportError:
+            raise ImportError("Please install open_clip to evaluate the generated images: `pip install open-clip-torch`")
+
+        self.id_cate_dict = id_cate_dict
+        self.device = device
+        self.retrieval_candidates = np.load(
+            os.path.join(data_path, f"fitb_{args.mode}_retrieval_candidates.npy"), allow_pickle=True
+        ).item()
+        self.cnn_features_clip = data_utils.load_item_features(os.path.join(data_path, "cnn_features_clip.npy"))
+        clip_model, _, self.clip_img_trans = open_clip.create_model_and_transforms('ViT-H-14', pretrained="laion2b-s32b-b79K")
+        self.clip_tokenizer = open_clip.get_tokenizer('ViT-H-14')
+        self.clip_model = clip_model.to(device).eval()
+
+    @torch.no_grad()
+    def __call__(self, batch_outputs):
+        # the number of correct retrievals and the CLIP scores of the images of a `fashion_generation` output
+        images, prompts, candidates = [], [], []
+        for uid in batch_outputs:
+            for oid in batch_outputs[uid]:
+                for img, cate in zip(batch_outputs[uid][oid]["images"], batch_outputs[uid][oid]["cates"]):
+                    images.append(self.clip_img_trans(img))
+                    prompts.append(cate_prompt(cate.item(), self.id_cate_dict))
+                    candidates.append(torch.tensor(self.retrieval_candidates[int(uid)][int(oid)]))
+
+        img_feats = self.clip_model.encode_image(torch.stack(images).to(self.device)).float()
+        img_feats = img_feats / img_feats.norm(p=2, dim=-1, keepdim=True)
+        txt_feats = self.clip_model.encode_text(self.clip_tokenizer(prompts).to(self.device)).float()
+        txt_feats = txt_feats / txt_feats.norm(p=2, dim=-1, keepdim=True)
+        clip_scores = 100 * F.cosine_similarity(img_feats, txt_feats)
+
+        candi_feats = self.cnn_features_clip[torch.stack(candidates)].to(self.device).float()
+        candi_feats = candi_feats / candi_feats.norm(p=2, dim=-1, keepdim=True)
+        sims = F.cosine_similarity(img_feats.unsqueeze(1), candi_feats, dim=-1)
+        corrects = torch.sum(torch.argmax(sims, dim=1) == 0).item()
+        return corrects, clip_scores
+
+def fitb_batches(test_dataloader, num_batches):
+    # the first `num_batches` FITB test batches, a fixed subset for the reports
+    batches = []
+    for i, batch in enumerate(test_dataloader):
+        if i == num_batches:
+            break
+        batches.append(batch)
+    return batches
+
+def run_sampler_sweep(args, model, test_dataloader, img_dataset, item_latents, test_hist_latents, null_img,
+                      data_path, id_cate_dict, guidance_schedules, sweep_save_path, accelerator):
+    """
+    Generate the first `args.sweep_num_batches` FITB test batches with every sampler x steps setting and report
+    the latency next to the CLIP retrieval accuracy and the CLIP score, computed as in `Evaluation/evaluate_fitb.py`
+    (on the in-memory images). The results are saved to `sweep_save_path`; finished settings are skipped on reruns.
+    """
+    if args.task != "FITB":
+        raise ValueError(f"The sampler sweep runs on FITB, but the task is {args.task}.")
+
+    device = accelerator.device
+    samplers = [sampler.strip() for sampler in args.sweep_samplers.split(",")]
+    available = available_inference_schedulers()
+    for sampler in samplers:
+        if sampler not in available:
+            raise ValueError(f"Unknown or unavailable sampler {sampler}, choose from {available}.")
+    steps_list = [int(steps) for steps in args.sweep_steps.split(",")]
+
+    clip_evaluator = ClipEvaluator(args, data_path, id_cate_dict, device)
+    batches = fitb_batches(test_dataloader, args.sweep_num_batches)
+
+    if os.path.exists(sweep_save_path):
+        results = np.load(sweep_save_path, allow_pickle=True).item()
+    else:
+        results = {}
+
+    def generate(batch, num_inference_steps, generator):
+        batch_outputs, _ = model.fashion_generation(
+            batch["uids"].to(device),
+            batch["oids"].to(device),
+            batch["input_ids"].to(device),
+            batch["outfits"].to(device),
+            None,
+            batch["category"].to(device),
+            test_hist_latents,
+            item_latents=item_latents,
+            item_images=img_dataset,
+            num_inference_steps=num_inference_steps,
+            category_guidance_scale=args.category_guidance_scale,
+            hist_guidance_scale=args.hist_guidance_scale,
+            mutual_guidance_scale=args.mutual_guidance_scale,
+            **guidance_schedules,
+            null_img=null_img,
+            generator=generator,
+            return_dict=False
+        )
+        return batch_outputs
+
+    with generation_autocast(args, accelerator):
+        # warm up the kernels, so that the first setting is not penalized
+        model.set_inference_scheduler(samplers[0])
+        generate(batches[0], steps_list[0], torch.Generator(device=device).manual_seed(args.seed))
+
+        for sampler in samplers:
+            model.set_inference_scheduler(sampler)
+            for num_inference_steps in steps_list:
+                if (sampler, num_inference_steps) in results:
+                    logger.info(f"Sampler {sampler} with {num_inference_steps} steps has already been swept. Skip.")
+                    continue
+
+                generator = torch.Generator(device=device).manual_seed(args.seed)
+                latency = 0.
+                num_images = 0
+                corrects = 0
+                clip_scores = []
+                for batch in tqdm(batches, desc=f"{sampler}-{num_inference_steps}"):
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    start = time.perf_counter()
+                    batch_outputs = generate(batch, num_inference_steps, generator)
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    latency += time.perf_counter() - start
+
+                    batch_corrects, batch_scores = clip_evaluator(batch_outputs)
+                    num_images += len(batch_scores)
+                    corrects += batch_corrects
+                    clip_scores.append(batch_scores)
+
+                results[(sampler, num_inference_steps)] = {
+                    "latency per batch": latency / len(batches),
+                    "latency per image": latency / num_images,
+                    "CLIP accuracy": corrects / num_images,
+                    "CLIP score": torch.cat(clip_scores).mean().item(),
+                }
+                np.save(sweep_save_path, np.array(results))
+
+    del clip_evaluator
+    torch.cuda.empty_cache()
+
+    logger.info(f"Sampler sweep on {len(batches)} batches ({sweep_save_path}):")
+    logger.info(f"{'sampler':>10} {'steps':>6} {'s/batch':>9} {'s/image':>9} {'CLIP acc':>9} {'CLIP score':>11}")
+    for (sampler, num_inference_steps), metrics in sorted(results.items()):
+        logger.info(
+            f"{sampler:>10} {num_inference_steps:>6} {metrics['latency per batch']:>9.3f} {metrics['latency per image']:>9.3f}"
+            f" {metrics['CLIP accuracy']:>9.4f} {metrics['CLIP score']:>11.2f}"
+        )
+
+    return results
+
+def run_acceleration_report(args, model, test_dataloader, img_dataset, item_latents, test_hist_latents, null_img,
+                            data_path, id_cate_dict, guidance_schedules, num_batches, name, accelerate,
+                            report_save_path, accelerator, measure=None):
+    """
+    Generate the first `num_batches` FITB test batches with the model as it is (the baseline), call `accelerate()`
+    and generate them again from the same noise. Reports the latency, the difference of the generated latents to
+    the baseline, the peak CUDA memory, and the CLIP retrieval accuracy and CLIP score of both. The dicts returned
+    by `accelerate` and by `measure` (called after the accelerated generation) are added to the results. The model
+    stays accelerated. The results are saved to `report_save_path`; if they already exist, only `accelerate` is
+    called.
+    """
+    if args.task != "FITB":
+        raise ValueError(f"The {name} report runs on FITB, but the task is {args.task}.")
+    if os.path.exists(report_save_path):
+        logger.info(f"The {name} report {report_save_path} already exists. Skip.")
+        accelerate()
+        return np.load(report_save_path, allow_pickle=True).item()
+
+    device = accelerator.device
+    clip_evaluator = ClipEvaluator(args, data_path, id_cate_dict, device)
+    batches = fitb_batches(test_dataloader, num_batches)
+
+    def run_pass(desc, evaluate=True):
+        # without `evaluate` (warm-up), only the generation runs
+        generator = torch.Generator(device=device).manual_seed(args.seed)
+        latency, corrects, clip_scores, all_latents = 0., 0, [], []
+        final = {}
+
+        def keep_latents(i, t, latents):
+            # the latents of the last step, before decoding
+            final["latents"] = latents
+
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        for batch in tqdm(batches, desc=desc):
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            batch_outputs, _ = model.fashion_generation(
+                batch["uids"].to(device),
+                batch["oids"].to(device),
+                batch["input_ids"].to(device),
+                batch["outfits"].to(device),
+                None,
+                batch["category"].to(device),
+                test_hist_latents,
+                item_latents=item_latents,
+                item_images=img_dataset,
+                num_inference_steps=args.num_inference_steps,
+                category_guidance_scale=args.category_guidance_scale,
+                hist_guidance_scale=args.hist_guidance_scale,
+                mutual_guidance_scale=args.mutual_guidance_scale,
+                **guidance_schedules,
+                null_img=null_img,
+                generator=generator,
+                return_dict=False,
+                callback=keep_latents,
+            )
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            latency += time.perf_counter() - start
+            if not evaluate:
+                continue
+            all_latents.append(final["latents"].float().cpu())
+
+            batch_corrects, batch_scores = clip_evaluator(batch_outputs)
+            corrects += batch_corrects
+            clip_scores.append(batch_scores)
+        if not evaluate:
+            return None
+        clip_scores = torch.cat(clip_scores)
+        return {
+            "latency per batch": latency / len(batches),
+            "peak memory": torch.cuda.max_memory_allocated(device) / 2 ** 30 if device.type == "cuda" else float("nan"),
+            "CLIP accuracy": corrects / len(clip_scores),
+            "CLIP score": clip_scores.mean().item(),
+        }, torch.cat(all_latents)
+
+    with generation_autocast(args, accelerator):
+        run_pass("warm-up", evaluate=False)
+        baseline_metrics, baseline_latents = run_pass("baseline")
+        extra_results = accelerate() or {}
+        run_pass("warm-up", evaluate=False)
+        metrics, latents = run_pass(name)
+    if measure is not None:
+        extra_results.update(measure())
+
+    diff = (latents - baseline_latents).flatten(1)
+    results = {
+        "baseline": baseline_metrics,
+        name: metrics,
+        "latent max abs diff": diff.abs().max().item(),
+        "latent mean abs diff": diff.abs().mean().item(),
+        "latent cosine similarity": F.cosine_similarity(latents.flatten(1), baseline_latents.flatten(1)).mean().item(),
+        **extra_results,
+    }
+    np.save(report_save_path, np.array(results))
+    del clip_evaluator
+    torch.cuda.empty_cache()
+
+    logger.info(f"{name} report on {len(batches)} FITB batches ({report_save_path}):")
+    logger.info(f"{'':>16} {'s/batch':>9} {'peak GB':>8} {'CLIP acc':>9} {'CLIP score':>11}")
+    for key in ["baseline", name]:
+        logger.info(
+            f"{key:>16} {results[key]['latency per batch']:>9.3f} {results[key]['peak memory']:>8.2f}"
+            f" {results[key]['CLIP accuracy']:>9.4f} {results[key]['CLIP score']:>11.2f}"
+        )
+    logger.info(
+        f"  speedup {baseline_metrics['latency per batch'] / metrics['latency per batch']:.2f}x; latents vs baseline:"
+        f" max abs diff {results['latent max abs diff']:.4f}, mean abs diff {results['latent mean abs diff']:.4f},"
+        f" cosine similarity {results['latent cosine similarity']:.4f}"
+    )
+
+    return results
+
+def run_quantization_report(args, model, test_dataloader, img_dataset, item_latents,
+                            test_hist_latents, null_img, data_path, id_cate_dict, guidance_schedules,
+                            report_save_path, accelerator):
+    """
+    The acceleration report (see `run_acceleration_report`) of `args.quantize`, against the fp32 model, on the first
+    `args.quantize_report_batches` FITB test batches, with the weight sizes of the quantized layers.
+    """
+    if model.quantization is not None:
+        raise ValueError("The quantization report needs the fp32 model.")
+    results = run_acceleration_report(args, model, test_dataloader, img_dataset, item_latents,
+        test_hist_latents, null_img, data_path, id_cate_dict, guidance_schedules, args.quantize_report_batches,
+        f"int8 {args.quantize}",
+        lambda: {"sizes": model.quantize_linear_layers(args.quantize)}, report_save_path, accelerator)
+    for name, (num_layers, float_bytes, int8_bytes) in results["sizes"].items():
+        logger.info(
+            f"  {name}: {num_layers} linear layers, {float_bytes / 2 ** 20:.1f}MB -> {int8_bytes / 2 ** 20:.1f}MB"
+            f" ({float_bytes / int8_bytes:.1f}x smaller)"
+        )
+    if args.quantize == "weight_only":
+        if accelerator.device.type == "cpu" and hasattr(torch.ops.aten, "_weight_int8pack_mm"):
+            logger.info("  weight_only runs the int8 weight GEMM of PyTorch.")
+        else:
+            logger.info(
+                "  weight_only is a size-only option here: without the int8 weight GEMM (CPU, recent PyTorch), the"
+                " weights are dequantized once and run as fast, and take as much memory, as the fp32 ones."
+            )
+    return results
+
+def run_feature_cache_report(args, model, test_dataloader, img_dataset, item_latents,
+                             test_hist_latents, null_img, data_path, id_cate_dict, guidance_schedules,
+                             report_save_path, accelerator):
+    """
+    The acceleration report (see `run_acceleration_report`) of the UNet feature cache, against the full UNet at
+    every step, on the first `args.feature_cache_report_batches` FITB test batches.
+    """
+    model.disable_feature_cache()
+    return run_acceleration_report(args, model, test_dataloader, img_dataset, item_latents, test_hist_latents,
+        null_img, data_path, id_cate_dict, guidance_schedules, args.feature_cache_report_batches,
+        f"feature cache {args.feature_cache_interval}/{args.feature_cache_branch}",
+        lambda: model.enable_feature_cache(args.feature_cache_interval, args.feature_cache_branch),
+        report_save_path, accelerator)
+
+def run_token_merging_report(args, model, test_dataloader, img_dataset, item_latents,
+                             test_hist_latents, null_img, data_path, id_cate_dict, guidance_schedules,
+                             report_save_path, accelerator):
+    """
+    The acceleration report (see `run_acceleration_report`) of token merging, against the full self-attention, on
+    the first `args.token_merging_report_batches` FITB test batches, with the fraction of merged tokens: catalog
+    images on white background merge more tokens with `--token_merging_threshold`.
+    """
+    model.disable_token_merging()
+    results = run_acceleration_report(args, model, test_dataloader, img_dataset, item_latents,
+        test_hist_latents, null_img, data_path, id_cate_dict, guidance_schedules, args.token_merging_report_batches,
+        f"token merging {args.token_merging}",
+        lambda: model.enable_token_merging(token_merging_ratios(args), threshold=args.token_merging_threshold),
+        report_save_path, accelerator,
+        measure=lambda: {"merged tokens": model.token_merging.num_merged / max(model.token_merging.num_tokens, 1)})
+    logger.info(f"  merged {results['merged tokens']:.1%} of the self-attention tokens")
+    return results
+
+def run_compile_report(args, model, test_dataloader, img_dataset, item_latents,
+                       test_hist_latents, null_img, guidance_schedules, accelerator):
+    """
+    Generate the first `args.compile_report_batches` test batches eagerly, then twice compiled: the first compiled
+    pass includes the compilation of every bucket (or its load from `--compile_cache_dir`), the second one is the
+    steady state. Logs the compile time of every bucket and the speedup.
+    """
+    if not model.compiled_modules:
+        raise ValueError("The compile report needs `--compile`.")
+    device = accelerator.device
+
+    batches = []
+    for i, batch in enumerate(test_dataloader):
+        if i == args.compile_report_batches:
+            break
+        batches.append(batch)
+
+    def run_pass():
+        generator = torch.Generator(device=device).manual_seed(args.seed)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for batch in batches:
+            generation_kwargs = dict(
+                num_inference_steps=args.num_inference_steps,
+                category_guidance_scale=args.category_guidance_scale,
+                hist_guidance_scale=args.hist_guidance_scale,
+                mutual_guidance_scale=args.mutual_guidance_scale,
+                **guidance_schedules,
+                null_img=null_img,
+                generator=generator,
+                return_dict=False
+            )
+            if args.task == "FITB":
+                model.fashion_generation(
+                    batch["uids"].to(device),
+                    batch["oids"].to(device),
+                    batch["input_ids"].to(device),
+                    batch["outfits"].to(device),
+                    None,
+                    batch["category"].to(device),
+                    test_hist_latents,
+                    item_latents=item_latents,
+                    item_images=img_dataset,
+                    **generation_kwargs
+                )
+            else:
+                model.outfit_generation(
+                    batch["uids"].to(device),
+                    batch["oids"].to(device),
+                    batch["input_ids"].to(device),
+                    batch["category"].to(device),
+                    test_hist_latents,
+                    **generation_kwargs
+                )
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return time.perf_counter() - start
+
+    with generation_autocast(args, accelerator):
+        compiled_modules = model.compiled_modules
+        model.disable_compiled_generation()
+        run_pass()  # warm up the eager kernels
+        eager = run_pass()
+        model.compiled_modules = compiled_modules
+        first = run_pass()
+        steady = run_pass()
+
+    logger.info(f"Compile report on {len(batches)} batches of {args.task}:")
+    for (name, bucket), seconds in sorted(model.compile_timings.items()):
+        logger.info(f"  compile {name} for {bucket} rows: {seconds:.2f}s")
+    logger.info(f"  eager: {eager:.2f}s, compiled first pass: {first:.2f}s, compiled steady state: {steady:.2f}s")
+    logger.info(f"  compile overhead: {first - steady:.2f}s, steady-state speedup: {eager / steady:.2f}x")
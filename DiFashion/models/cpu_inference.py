@@ -0,0 +1,37 @@
+import torch
+
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None):
+    """
+    Intra-op (`torch.set_num_threads`) and inter-op threads of CPU inference; `None` keeps the torch defaults. The
+    inter-op threads can only be set before the first parallel work of the process.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def cpu_bf16_supported():
+    # oneDNN bf16 kernels need AVX512-BF16/AMX (or at least AVX512) on x86
+    is_supported = getattr(torch.ops.mkldnn, "_is_mkldnn_bf16_supported", None)
+    return is_supported is not None and torch.backends.mkldnn.is_available() and is_supported()
+
+
+def cpu_autocast_dtype(dtype="bf16"):
+    """
+    The autocast dtype of CPU inference, `torch.bfloat16` for "bf16" if the CPU supports it, else `None` (fp32);
+    the callers report the fallback.
+    """
+    if dtype == "bf16":
+        if cpu_bf16_supported():
+            return torch.bfloat16
+    elif dtype != "fp32":
+        raise ValueError(f"Unknown CPU dtype {dtype}, choose from ['bf16', 'fp32'].")
+    return None
+
+
+def cpu_autocast(dtype="bf16"):
+    autocast_dtype = cpu_autocast_dtype(dtype)
+    return torch.autocast("cpu", dtype=autocast_dtype or torch.bfloat16, enabled=autocast_dtype is not None)
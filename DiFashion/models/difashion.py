@@ -1,4 +1,7 @@
+import os
+import time
 import inspect
+import contextlib
 import numpy as np
 import torch
 import torch.nn as nn
@@ -14,10 +17,45 @@ from diffusers.utils.import_utils import is_xformers_available, is_accelerate_av
 from diffusers.utils.torch_utils import randn_tensor
 from packaging import version
 from transformers import CLIPTextModel, CLIPTokenizer
+import diffusers
 
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.models.modeling_utils import ModelMixin
 
+from .guidance import (GuidanceSchedule, CFGWorkspace, row_guidance_scales, guidance_terms, guidance_branches,
+                       combine_guidance)
+from .quantization import quantize_linears
+from .feature_cache import UNetFeatureCache
+from .token_merging import TokenMerging
+from .preview_decoder import PreviewDecoder
+from .prompt_kv_cache import PromptKVCache, set_prompt_kv_processors, remove_prompt_kv_processors
+
+# Samplers for `DiFashion.fashion_generation`: name -> (scheduler class in `diffusers`, extra config)
+INFERENCE_SCHEDULERS = {
+    "pndm": ("PNDMScheduler", {}),
+    "ddim": ("DDIMScheduler", {}),
+    "dpm++": ("DPMSolverMultistepScheduler", {"algorithm_type": "dpmsolver++"}),
+    "unipc": ("UniPCMultistepScheduler", {}),
+    "deis": ("DEISMultistepScheduler", {}),
+    "euler": ("EulerDiscreteScheduler", {}),
+    "euler_a": ("EulerAncestralDiscreteScheduler", {}),
+    "heun": ("HeunDiscreteScheduler", {}),
+    "lms": ("LMSDiscreteScheduler", {}),
+}
+
+# Batch sizes (UNet rows) of `DiFashion.enable_compiled_generation`
+COMPILE_BUCKETS = (8, 16, 32, 48, 64, 96, 128)
+
+def pad_rows(x, num_rows):
+    # pad the first dimension up to `num_rows` by repeating the last row
+    if x.shape[0] >= num_rows:
+        return x
+    return torch.cat([x, x[-1:].expand(num_rows - x.shape[0], *x.shape[1:])])
+
+def available_inference_schedulers():
+    # the samplers shipped with the installed diffusers
+    return [name for name, (cls_name, _) in INFERENCE_SCHEDULERS.items() if hasattr(diffusers, cls_name)]
+
 class MutualEncoder(ModelMixin, ConfigMixin):
 
     _supports_gradient_checkpointing = True
@@ -54,52 +92,111 @@ class DiFashion(ModelMixin, ConfigMixin):
         args,
         logger,
         cate_num,
-        device
+        device,
+        checkpoint_dir=None,
+        use_ema=True,
+        use_ema_fashion=True,
+        dtype=None
     ):
+        """
+        With `checkpoint_dir` (a training checkpoint or an inference bundle, see `export_inference_bundle`), the
+        UNet and the mutual encoder are built directly from the checkpoint weights, skipping the pretrained UNet,
+        the `conv_in` extension and the initialization that the checkpoint overwrites anyway. All the modules are
+        then created on the meta device and materialized from the (memory-mapped) safetensors files, cast to
+        `dtype`. The load time of every component is kept in `self.load_timings`.
+        """
         super(DiFashion, self).__init__()
         self.args = args
         self.logger = logger
+        self.load_timings = {}
+        # see `enable_compiled_generation`
+        self.compiled_modules = {}
+        self.compile_timings = {}
+        # see `set_onnx_backend`
+        self.onnx_backend = None
+        # see `quantize_linear_layers`
+        self.quantization = None
+        # see `enable_feature_cache`
+        self.feature_cache = None
+        # see `enable_token_merging`
+        self.token_merging = None
+        # see `enable_prompt_kv_cache`
+        self.prompt_kv_cache = None
+        # see `load_preview_decoder` and `enable_vae_slicing`
+        self.preview_decoder = None
+        self.decode_chunk_size = None
+        # see `encode_null_latent`
+        self.null_latent = None
+
+        # components of an inference bundle are read from it, the others from the pretrained model
+        def source(subfolder):
+            if checkpoint_dir is not None and os.path.isdir(os.path.join(checkpoint_dir, subfolder)):
+                return checkpoint_dir
+            return args.pretrained_model_name_or_path
+
+        low_cpu_mem_usage = {"low_cpu_mem_usage": True, "torch_dtype": dtype} if checkpoint_dir is not None else {}
 
         logger.info("load PDNMScheduler...")
-        self.noise_scheduler = PNDMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+        with self.timed("scheduler"):
+            self.noise_scheduler = PNDMScheduler.from_pretrained(source("scheduler"), subfolder="scheduler")
+        # the sampler of `fashion_generation`, see `set_inference_scheduler`
+        self.inference_scheduler = self.noise_scheduler
         logger.info("load CLIPTokenizer...")
-        self.tokenizer = CLIPTokenizer.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision
-        )
+        with self.timed("tokenizer"):
+            self.tokenizer = CLIPTokenizer.from_pretrained(
+                source("tokenizer"), subfolder="tokenizer", revision=args.revision
+            )
         logger.info("load CLIPTextModel...")
-        self.text_encoder = CLIPTextModel.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision
-        )
+        with self.timed("text_encoder"):
+            self.text_encoder = CLIPTextModel.from_pretrained(
+                source("text_encoder"), subfolder="text_encoder", revision=args.revision, **low_cpu_mem_usage
+            )
         logger.info("load VAE...")
-        self.vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision)
+        with self.timed("vae"):
+            self.vae = AutoencoderKL.from_pretrained(
+                source("vae"), subfolder="vae", revision=args.revision, **low_cpu_mem_usage
+            )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
-        logger.info("load UNet...")
-        self.unet = UNet2DConditionModel.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="unet", revision=args.non_ema_revision,
-        )
 
-        self.logger.info("Initializing the DiFashion UNet from the pretrained UNet.")
-        # Extend the first convolutional layer of the pretrained UNet for history condition.
-        in_channels = 8  # [latents, history_latents]
-        out_channels = self.unet.conv_in.out_channels
-        self.unet.register_to_config(in_channels=in_channels)
-
-        with torch.no_grad():
-            new_conv_in = nn.Conv2d(
-                in_channels, out_channels, self.unet.conv_in.kernel_size, self.unet.conv_in.stride, self.unet.conv_in.padding
+        if checkpoint_dir is not None:
+            self.unet, self.fashion_encoder = self.load_checkpoint_modules(
+                checkpoint_dir, use_ema, use_ema_fashion, dtype
             )
-            new_conv_in.weight.zero_()
-            new_conv_in.weight[:, :4, :, :].copy_(self.unet.conv_in.weight)
-            self.unet.conv_in = new_conv_in
+            self.unet.requires_grad_(False)
+            self.fashion_encoder.requires_grad_(False)
+        else:
+            logger.info("load UNet...")
+            with self.timed("unet"):
+                self.unet = UNet2DConditionModel.from_pretrained(
+                    args.pretrained_model_name_or_path, subfolder="unet", revision=args.non_ema_revision,
+                )
+
+            self.logger.info("Initializing the DiFashion UNet from the pretrained UNet.")
+            # Extend the first convolutional layer of the pretrained UNet for history condition.
+            in_channels = 8  # [latents, history_latents]
+            out_channels = self.unet.conv_in.out_channels
+            self.unet.register_to_config(in_channels=in_channels)
+
+            with torch.no_grad():
+                new_conv_in = nn.Conv2d(
+                    in_channels, out_channels, self.unet.conv_in.kernel_size, self.unet.conv_in.stride, self.unet.conv_in.padding
+                )
+                new_conv_in.weight.zero_()
+                new_conv_in.weight[:, :4, :, :].copy_(self.unet.conv_in.weight)
+                self.unet.conv_in = new_conv_in
         
-        self.fashion_encoder = MutualEncoder(
-            cate_num=cate_num, 
-            cate_emb_size=args.category_emb_size,
-            latent_channels=self.vae.config.latent_channels,  # 4
-            latent_size=self.unet.config.sample_size,  # 64
-            hid_dim=args.hid_dim
+            self.fashion_encoder = MutualEncoder(
+                cate_num=cate_num, 
+                cate_emb_size=args.category_emb_size,
+                latent_channels=self.vae.config.latent_channels,  # 4
+                latent_size=self.unet.config.sample_size,  # 64
+                hid_dim=args.hid_dim
+            )
+            self.fashion_encoder.apply(xavier_normal_initialization)
+        logger.info(
+            "load timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.load_timings.items())
+            + f", total {sum(self.load_timings.values()):.2f}s"
         )
-        self.fashion_encoder.apply(xavier_normal_initialization)
 
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor)
 
@@ -119,7 +216,11 @@ class DiFashion(ModelMixin, ConfigMixin):
             else:
                 raise ValueError("xformers is not available. Make sure it is installed correctly")
         
-    def forward(self, batch, img_dataset, history, null_img, mask_ratio, coupling_mask_ratio, cate_mask_ratio, weight_dtype, generator):
+    def forward(self, batch, img_dataset, history, null_img, mask_ratio, coupling_mask_ratio, cate_mask_ratio, weight_dtype, generator, timestep_sampler=None):
+        if "pixel_values" in batch:
+            # image-caption batch from a streaming source, see `data_utils.LaionShardDataset`
+            return self.image_text_loss(batch, null_img, cate_mask_ratio, weight_dtype, generator, timestep_sampler)
+
         uids = batch["uids"]
         outfits = batch["outfits"]
         category = batch["category"]  ### outfit_category: [cate_1, cate_2, ..., cate_n]
@@ -151,8 +252,8 @@ class DiFashion(ModelMixin, ConfigMixin):
                 (latents.shape[0], latents.shape[1], 1, 1), device=latents.device
             )
         
-        timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (bsz,), device=self.device)
-        timesteps = timesteps.repeat_interleave(olen)  # outfit_length=4
+        outfit_timesteps, outfit_weights = self.sample_timesteps(bsz, timestep_sampler)
+        timesteps = outfit_timesteps.repeat_interleave(olen)  # outfit_length=4
         timesteps = timesteps.long()
 
         noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
@@ -252,19 +353,481 @@ class DiFashion(ModelMixin, ConfigMixin):
             encoder_hidden_states
         ).sample
         
-        if self.args.snr_gamma is None:
-            loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+        loss = self.diffusion_loss(model_pred, target, timesteps, olen, timestep_sampler, outfit_timesteps, outfit_weights)
+        
+        return loss
+
+    def image_text_loss(self, batch, null_img, cate_mask_ratio, weight_dtype, generator, timestep_sampler=None):
+        """
+        Denoising loss on plain image-caption pairs (e.g. LAION shards) for pre-adaptation. Without outfit context,
+        the mutual and history conditions are set to the null latent, as in the unconditional CFG branch.
+        """
+        null_img = null_img.unsqueeze(0)
+        null_latent = self.vae.encode(null_img.to(weight_dtype)).latent_dist.mode()[0]
+        null_latent = null_latent * self.vae.config.scaling_factor
+
+        pixel_values = batch["pixel_values"].to(self.device, dtype=weight_dtype)
+        latents = self.vae.encode(pixel_values).latent_dist.sample()
+        latents = latents * self.vae.config.scaling_factor
+        bsz = latents.shape[0]
+
+        noise = torch.randn_like(latents)
+        if self.args.noise_offset:
+            noise += self.args.noise_offset * torch.randn(
+                (latents.shape[0], latents.shape[1], 1, 1), device=latents.device
+            )
+
+        timesteps, timestep_weights = self.sample_timesteps(bsz, timestep_sampler)
+        noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+
+        null_latents = torch.stack([null_latent] * bsz).to(dtype=noisy_latents.dtype)
+        added_noisy_latents = (1 - self.args.eta) * noisy_latents + self.args.eta * null_latents
+        added_noisy_latents = torch.cat([added_noisy_latents, null_latents], dim=1)
+
+        encoder_hidden_states = self.text_encoder(batch["input_ids"].to(self.device))[0]
+        if cate_mask_ratio is not None:
+            null_input_ids = self.tokenizer(
+                [""],
+                padding="max_length",
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="pt",
+            ).input_ids.to(self.device)
+            null_prompt = self.text_encoder(null_input_ids)[0]
+            random_p = torch.rand(bsz, device=self.device, generator=generator)
+            prompt_mask = (random_p < cate_mask_ratio)
+            if prompt_mask.sum() > 0:
+                encoder_hidden_states[prompt_mask] = torch.cat([null_prompt] * prompt_mask.sum())
+
+        if self.noise_scheduler.config.prediction_type == "epsilon":
+            target = noise
+        elif self.noise_scheduler.config.prediction_type == "v_prediction":
+            target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
         else:
-            snr = self.compute_snr(timesteps)
-            loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+            raise ValueError(f"Unknown prediction type {self.noise_scheduler.config.prediction_type}")
 
+        model_pred = self.unet(
+            added_noisy_latents,
+            timesteps,
+            encoder_hidden_states
+        ).sample
+
+        return self.diffusion_loss(model_pred, target, timesteps, 1, timestep_sampler, timesteps, timestep_weights)
+
+    def sample_timesteps(self, bsz, timestep_sampler=None):
+        """
+        Returns `bsz` training timesteps and their importance weights (`None` for uniform sampling).
+        """
+        if timestep_sampler is None:
+            timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (bsz,), device=self.device)
+            return timesteps.long(), None
+        timesteps, weights = timestep_sampler.sample(bsz, self.device)
+        return timesteps.long(), weights
+
+    def diffusion_loss(self, model_pred, target, timesteps, group_size, timestep_sampler=None, sampled_timesteps=None, sampled_weights=None):
+        """
+        MSE loss with optional Min-SNR weighting. With a `timestep_sampler`, the losses of each group of `group_size`
+        samples sharing one sampled timestep are recorded in the sampler and reweighted by the importance weights.
+        """
+        if self.args.snr_gamma is None and timestep_sampler is None:
+            return F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+
+        loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+        loss = loss.mean(dim=list(range(1, len(loss.shape))))
+        if self.args.snr_gamma is not None:
+            snr = self.compute_snr(timesteps)
             mse_loss_weights = (
                 torch.stack([snr, self.args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
             )
-            loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
-            loss = loss.mean()
-        
-        return loss
+            loss = loss * mse_loss_weights
+
+        if timestep_sampler is not None:
+            group_loss = loss.view(-1, group_size).mean(dim=1)
+            timestep_sampler.update_with_losses(sampled_timesteps, group_loss)
+            loss = group_loss * sampled_weights
+
+        return loss.mean()
+
+    def set_inference_scheduler(self, scheduler="pndm", **scheduler_kwargs):
+        """
+        Select the sampler of `fashion_generation`, by name (see `INFERENCE_SCHEDULERS`) or as a scheduler instance.
+        Named samplers are built from the config of the training scheduler, so they share its noise schedule and
+        prediction type. Training keeps using `self.noise_scheduler`.
+        """
+        if isinstance(scheduler, str):
+            if scheduler not in INFERENCE_SCHEDULERS:
+                raise ValueError(f"Unknown sampler {scheduler}, choose from {list(INFERENCE_SCHEDULERS.keys())}.")
+            cls_name, config = INFERENCE_SCHEDULERS[scheduler]
+            if not hasattr(diffusers, cls_name):
+                raise ValueError(f"Sampler {scheduler} needs `{cls_name}`, which is not in diffusers {diffusers.__version__}.")
+            scheduler = getattr(diffusers, cls_name).from_config(self.noise_scheduler.config, **{**config, **scheduler_kwargs})
+        self.inference_scheduler = scheduler
+        return scheduler
+
+    def cfg_workspace(self, num_rows, max_branches, latent_shape, hist_channels, dtype):
+        # reuse the workspace of the previous call if the shapes match
+        workspace = getattr(self, "_cfg_workspace", None)
+        if workspace is None or not workspace.matches(num_rows, max_branches, latent_shape, hist_channels, dtype, self.device):
+            workspace = CFGWorkspace(num_rows, max_branches, latent_shape, hist_channels, dtype, self.device)
+            self._cfg_workspace = workspace
+        workspace.reset()
+        return workspace
+
+    def load_inference_weights(self, checkpoint_dir, use_ema=True, use_ema_fashion=True, dtype=None, device=None):
+        """
+        Load the UNet and the mutual encoder of a training checkpoint (or of an inference bundle, see
+        `export_inference_bundle`) for inference only. The EMA weights are read straight into this model, without
+        the optimizer state and the EMA copies restored by `accelerator.load_state`, and every module is cast to
+        `dtype` at load time and moved to `device` (by default, the device of the model).
+        """
+        device = device or self.device
+        # replace the modules instead of copying the state dicts, so that only one copy of the weights is alive
+        self.unet, self.fashion_encoder = self.load_checkpoint_modules(checkpoint_dir, use_ema, use_ema_fashion, dtype)
+        self.text_encoder.to(device, dtype=dtype)
+        self.vae.to(device, dtype=dtype)
+        self.null_latent = None
+        self.unet.to(device)
+        self.fashion_encoder.to(device)
+        if self.quantization is not None:
+            # quantize the new modules
+            self.quantize_linear_layers(self.quantization)
+        if self.token_merging is not None:
+            self.token_merging.apply(self.unet)
+        if self.compiled_modules:
+            # compile the new modules
+            self.enable_compiled_generation(**self.compile_config)
+
+        self.unet.requires_grad_(False)
+        self.fashion_encoder.requires_grad_(False)
+        if self.args.enable_xformers_memory_efficient_attention:
+            self.unet.enable_xformers_memory_efficient_attention()
+        if self.prompt_kv_cache is not None:
+            # the keys and values of the previous weights are stale
+            self.prompt_kv_cache.clear()
+            set_prompt_kv_processors(self.unet, self.prompt_kv_cache)
+        self.eval()
+        return self
+
+    def load_checkpoint_modules(self, checkpoint_dir, use_ema=True, use_ema_fashion=True, dtype=None):
+        """
+        The UNet and the mutual encoder of a checkpoint, built on the meta device and materialized from the
+        checkpoint weights (`low_cpu_mem_usage`), without any random initialization.
+        """
+        unet_folder = self._inference_subfolder(checkpoint_dir, "unet", use_ema)
+        encoder_folder = self._inference_subfolder(checkpoint_dir, "fashion_encoder", use_ema_fashion)
+
+        self.logger.info(f"load {unet_folder} and {encoder_folder} from {checkpoint_dir}...")
+        with self.timed("unet"):
+            unet = UNet2DConditionModel.from_pretrained(
+                checkpoint_dir, subfolder=unet_folder, torch_dtype=dtype, low_cpu_mem_usage=True
+            )
+        with self.timed("fashion_encoder"):
+            fashion_encoder = MutualEncoder.from_pretrained(
+                checkpoint_dir, subfolder=encoder_folder, torch_dtype=dtype, low_cpu_mem_usage=True
+            )
+        return unet, fashion_encoder
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        # wall-clock load time of a component, see `self.load_timings`
+        start = time.perf_counter()
+        yield
+        self.load_timings[name] = time.perf_counter() - start
+        self.logger.info(f"{name} loaded in {self.load_timings[name]:.2f}s")
+
+    def _inference_subfolder(self, checkpoint_dir, name, use_ema):
+        # inference bundles only have the plain folders, which already hold the EMA weights
+        if use_ema and os.path.isdir(os.path.join(checkpoint_dir, f"{name}_ema")):
+            return f"{name}_ema"
+        if use_ema and not os.path.isfile(os.path.join(checkpoint_dir, name, "config.json")):
+            raise ValueError(f"{checkpoint_dir} has neither {name}_ema nor {name}.")
+        if use_ema:
+            self.logger.info(f"{checkpoint_dir} has no {name}_ema, load {name} (non-EMA weights unless it is a bundle).")
+        return name
+
+    def export_inference_bundle(self, bundle_dir):
+        """
+        Save the model, in its current weights and dtype, as a compact inference bundle: the checkpoint layout
+        without the non-EMA weights, the optimizer and the random states, plus the frozen pretrained components, so
+        that `DiFashion(..., checkpoint_dir=bundle_dir)` reads every component from the bundle.
+        """
+        if self.quantization is not None:
+            raise ValueError("Export the inference bundle before `quantize_linear_layers`, bundles hold float weights.")
+        self.unet.save_pretrained(os.path.join(bundle_dir, "unet"), safe_serialization=True)
+        self.fashion_encoder.save_pretrained(os.path.join(bundle_dir, "fashion_encoder"), safe_serialization=True)
+        self.text_encoder.save_pretrained(os.path.join(bundle_dir, "text_encoder"), safe_serialization=True)
+        self.vae.save_pretrained(os.path.join(bundle_dir, "vae"), safe_serialization=True)
+        self.tokenizer.save_pretrained(os.path.join(bundle_dir, "tokenizer"))
+        self.noise_scheduler.save_pretrained(os.path.join(bundle_dir, "scheduler"))
+        self.logger.info(f"Saved the inference bundle to {bundle_dir}.")
+
+    def enable_sdpa_attention(self):
+        """
+        Memory-efficient attention without xformers (e.g. on CPU): `F.scaled_dot_product_attention` with torch 2,
+        else sliced attention, for the UNet and the VAE.
+        """
+        if hasattr(F, "scaled_dot_product_attention"):
+            from diffusers.models.attention_processor import AttnProcessor2_0
+
+            self.unet.set_attn_processor(AttnProcessor2_0())
+            self.vae.set_attn_processor(AttnProcessor2_0())
+        else:
+            self.logger.info("torch < 2.0 has no scaled_dot_product_attention, use sliced attention.")
+            self.unet.set_attention_slice("auto")
+
+    def load_preview_decoder(self, preview_decoder_path):
+        """
+        Load a `PreviewDecoder` distilled from the VAE decoder (see `distill_preview_decoder.py`), used by
+        `fashion_generation(output_type="preview")` to decode PIL previews (e.g. for CLIP grounding, reranking or
+        thumbnails) at a fraction of the cost of the VAE decoder.
+        """
+        self.preview_decoder = PreviewDecoder.from_pretrained(preview_decoder_path).to(self.device, dtype=self.vae.dtype)
+        self.preview_decoder.requires_grad_(False)
+        self.preview_decoder.eval()
+
+    def enable_vae_slicing(self, chunk_size=1):
+        # full VAE decoding of `chunk_size` latents at a time, to bound the memory of large batches
+        self.decode_chunk_size = chunk_size
+
+    def disable_vae_slicing(self):
+        self.decode_chunk_size = None
+
+    def enable_vae_tiling(self):
+        # full VAE decoding in overlapping tiles, for latents larger than the VAE sample size
+        self.vae.enable_tiling()
+
+    def to_channels_last(self):
+        # NHWC weights, so that the convolutions of the UNet and the VAE run in channels_last
+        self.unet.to(memory_format=torch.channels_last)
+        self.vae.to(memory_format=torch.channels_last)
+
+    def quantize_linear_layers(self, mode="dynamic"):
+        """
+        Replace the linear layers of the mutual encoder (its two large 16384 <-> hid_dim layers) and of the UNet
+        attention and feed-forward blocks by int8 layers for inference, see `models.quantization`: "dynamic" also
+        quantizes the activations and runs int8 GEMMs (CPU only), "weight_only" only stores the weights in int8. The
+        layers are replaced in place, so this comes after the weights are loaded and before `torch.compile`. Returns
+        the number of quantized layers and their weight bytes before and after, per module.
+        """
+        if mode == "dynamic" and self.device.type != "cpu":
+            raise ValueError(f"Dynamic int8 quantization runs on CPU, but the model is on {self.device}.")
+        sizes = {}
+        for name, module, include in [
+            ("unet", self.unet, ["transformer_blocks"]),
+            ("fashion_encoder", self.fashion_encoder, None),
+        ]:
+            num_layers, float_bytes, int8_bytes = quantize_linears(module, mode, include)
+            self.logger.info(
+                f"{mode} int8 quantization of {num_layers} linear layers of {name}:"
+                f" {float_bytes / 2 ** 20:.1f}MB -> {int8_bytes / 2 ** 20:.1f}MB"
+            )
+            sizes[name] = (num_layers, float_bytes, int8_bytes)
+        self.quantization = mode
+        if self.prompt_kv_cache is not None:
+            self.prompt_kv_cache.clear()
+        return sizes
+
+    def enable_feature_cache(self, interval=3, branch=1):
+        """
+        Reuse the deep UNet features across the denoising steps of `fashion_generation` (DeepCache): the whole UNet
+        only runs every `interval` steps, the steps in between run its first and last `branch` blocks, see
+        `models.feature_cache.UNetFeatureCache`. The feature cache runs the eager UNet, also with `torch.compile`.
+        """
+        self.feature_cache = UNetFeatureCache(self.unet, interval, branch)
+
+    def disable_feature_cache(self):
+        self.feature_cache = None
+
+    def enable_token_merging(self, ratios, stride=2, threshold=None):
+        """
+        Merge similar tokens before the self-attention of the UNet and unmerge them after it, see
+        `models.token_merging.TokenMerging`: `ratios[level]` is the fraction of merged tokens at the resolution level
+        `level` (0 for the latent resolution). With `threshold`, only the tokens with a cosine similarity above it
+        are merged, e.g. on the white background of the catalog images.
+        """
+        self.disable_token_merging()
+        self.token_merging = TokenMerging(ratios, stride, threshold)
+        self.token_merging.apply(self.unet)
+
+    def disable_token_merging(self):
+        if self.token_merging is not None:
+            self.token_merging.remove()
+        self.token_merging = None
+
+    def enable_prompt_kv_cache(self, persistent=False):
+        """
+        Project the prompt embeddings to the keys and values of every UNet cross-attention once per unique prompt,
+        instead of once per row of the CFG batch and per denoising step, see `models.prompt_kv_cache`. With
+        `persistent`, the keys and values of the category prompts are kept across calls, until the weights change
+        (`load_inference_weights`, `quantize_linear_layers`, or `self.prompt_kv_cache.clear()` after loading weights
+        in place). Call it again after changing the attention processors (e.g. `enable_sdpa_attention`).
+        """
+        if "unet" in self.compiled_modules:
+            raise ValueError("The prompt key/value cache does not work with the compiled UNet, whose batches are padded.")
+        if self.prompt_kv_cache is None or self.prompt_kv_cache.persistent != persistent:
+            self.prompt_kv_cache = PromptKVCache(persistent)
+        set_prompt_kv_processors(self.unet, self.prompt_kv_cache)
+
+    def disable_prompt_kv_cache(self):
+        if self.prompt_kv_cache is not None:
+            remove_prompt_kv_processors(self.unet)
+        self.prompt_kv_cache = None
+
+    def enable_compiled_generation(self, buckets=COMPILE_BUCKETS, mode=None, cache_dir=None):
+        """
+        Run the UNet and the mutual encoder of `fashion_generation` through `torch.compile`. Their batches are padded
+        up to the smallest of `buckets` (in rows), so that the varying numbers of generated items and guidance
+        branches compile one graph per bucket instead of one per batch. With `cache_dir`, the compiled kernels and
+        graphs are cached on disk for the next processes. The first call of every bucket, which compiles it, is
+        timed in `self.compile_timings`.
+        """
+        if not hasattr(torch, "compile"):
+            raise ValueError(f"torch.compile needs torch >= 2.0, but torch is {torch.__version__}.")
+        if self.prompt_kv_cache is not None:
+            raise ValueError("The prompt key/value cache does not work with the compiled UNet, whose batches are padded.")
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+            os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+            import torch._inductor.config
+
+            if hasattr(torch._inductor.config, "fx_graph_cache"):
+                torch._inductor.config.fx_graph_cache = True
+        self.compile_config = {"buckets": buckets, "mode": mode, "cache_dir": cache_dir}
+        self.compile_buckets = sorted(buckets)
+        self.compiled_modules = {
+            "unet": torch.compile(self.unet, mode=mode, dynamic=False),
+            "fashion_encoder": torch.compile(self.fashion_encoder, mode=mode, dynamic=False),
+        }
+
+    def disable_compiled_generation(self):
+        self.compiled_modules = {}
+
+    def bucket_size(self, num_rows):
+        # larger batches than the largest bucket are compiled for their own size
+        return next((bucket for bucket in self.compile_buckets if bucket >= num_rows), num_rows)
+
+    def run_compiled(self, name, num_rows, *inputs, **kwargs):
+        """
+        `self.compiled_modules[name]` on `inputs` padded to the bucket of `num_rows`: the padded rows repeat the last
+        row and are dropped from the output. The output is copied, since CUDA graphs reuse their output buffers.
+        """
+        bucket = self.bucket_size(num_rows)
+
+        def pad(x):
+            # batched tensors only, e.g. not the timestep
+            return pad_rows(x, bucket) if torch.is_tensor(x) and x.dim() > 0 and x.shape[0] == num_rows else x
+
+        inputs = [pad(x) for x in inputs]
+        kwargs = {k: pad(v) for k, v in kwargs.items()}
+        key = (name, bucket)
+        if key in self.compile_timings:
+            output = self.compiled_modules[name](*inputs, **kwargs)
+        else:
+            if inputs[0].is_cuda:
+                torch.cuda.synchronize(inputs[0].device)
+            start = time.perf_counter()
+            output = self.compiled_modules[name](*inputs, **kwargs)
+            if inputs[0].is_cuda:
+                torch.cuda.synchronize(inputs[0].device)
+            self.compile_timings[key] = time.perf_counter() - start
+            self.logger.info(f"compiled {name} for {bucket} rows in {self.compile_timings[key]:.2f}s")
+        if isinstance(output, tuple):
+            output = output[0]
+        return output[:num_rows].clone()
+
+    def set_onnx_backend(self, backend):
+        """
+        Run the UNet, the mutual encoder, the VAE and the text encoder of `fashion_generation` on the ONNX Runtime
+        sessions of `backend` (a `models.onnx_backend.OnnxBackend`, `None` for PyTorch). The guidance, the mutual
+        conditioning and the sampler stay the same PyTorch code.
+        """
+        self.onnx_backend = backend
+        self.null_latent = None
+
+    def encode_prompts(self, input_ids):
+        # text-encoder hidden states, from the exported text-embedding table with the ONNX backend
+        if self.onnx_backend is not None:
+            return self.onnx_backend.encode_prompts(input_ids).to(self.device)
+        return self.text_encoder(input_ids)[0]
+
+    def encode_images(self, images):
+        # the (unscaled) latent mode of the VAE posterior
+        if self.onnx_backend is not None:
+            return self.onnx_backend.run("vae_encoder", images).to(self.device)
+        return self.vae.encode(images).latent_dist.mode()
+
+    def encode_null_latent(self, null_img):
+        # the scaled latent of the null image, encoded once for all the calls with the same `null_img` (and autocast)
+        key = (null_img, torch.is_autocast_enabled(), torch.is_autocast_cpu_enabled())
+        if self.null_latent is None or any(a is not b for a, b in zip(self.null_latent[0], key)):
+            null_latent = self.encode_images(null_img.unsqueeze(0))[0] * self.vae.config.scaling_factor
+            self.null_latent = (key, null_latent)
+        return self.null_latent[1]
+
+    @torch.no_grad()
+    def gather_item_latents(self, olists, item_latents, item_images=None):
+        """
+        The scaled VAE latents of the outfit items `olists` (`[bsz, olen]` item ids, 0 for the slots to generate),
+        flattened to `[bsz * olen, ...]` like the encoded `outfit_images` of `fashion_generation`. They are gathered
+        from the latent bank `item_latents` (see `data_utils.load_item_latents`); only the items beyond the bank are
+        loaded from `item_images` and encoded. The slots to generate are zeros.
+        """
+        iids = olists.flatten().cpu()
+        known = iids != 0
+        in_bank = known & (iids < len(item_latents))
+        missing = known & ~in_bank
+        all_latents = torch.zeros(len(iids), *item_latents.shape[1:], device=self.device)
+        if in_bank.any():
+            all_latents[in_bank.to(self.device)] = item_latents[iids[in_bank]].to(self.device, all_latents.dtype)
+        if missing.any():
+            if item_images is None:
+                raise ValueError(
+                    f"The items {iids[missing].tolist()} are not in the latent bank of {len(item_latents)} items,"
+                    " `item_images` are needed to encode them."
+                )
+            images = torch.stack([item_images[iid] for iid in iids[missing].tolist()]).to(self.device)
+            images = images.to(memory_format=torch.contiguous_format, dtype=self.vae.dtype)
+            missing_latents = self.encode_images(images) * self.vae.config.scaling_factor
+            all_latents[missing.to(self.device)] = missing_latents.to(all_latents.dtype)
+        return all_latents
+
+    def decode_latents(self, latents):
+        if self.onnx_backend is not None:
+            return self.onnx_backend.run("vae_decoder", latents).to(self.device)
+        if self.decode_chunk_size is not None:
+            return torch.cat([
+                self.vae.decode(chunk, return_dict=False)[0] for chunk in latents.split(self.decode_chunk_size)
+            ])
+        return self.vae.decode(latents, return_dict=False)[0]
+
+    def decode_preview(self, latents):
+        # the fast preview of the scaled latents, see `load_preview_decoder`
+        if self.preview_decoder is None:
+            raise ValueError("`output_type='preview'` needs a preview decoder, see `load_preview_decoder`.")
+        dtype = next(self.preview_decoder.parameters()).dtype
+        return self.preview_decoder(latents.to(dtype))
+
+    def denoise(self, unet_input, timestep, encoder_hidden_states, layout=None):
+        # the noise prediction of the CFG batch in `fashion_generation`, whose branch layout is `layout`
+        if self.onnx_backend is not None:
+            return self.onnx_backend.run("unet", unet_input, timestep, encoder_hidden_states).to(self.device)
+        if self.feature_cache is not None:
+            return self.feature_cache(self.unet, unet_input, timestep, encoder_hidden_states, layout)
+        if "unet" not in self.compiled_modules:
+            return self.unet(unet_input, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+        return self.run_compiled(
+            "unet", unet_input.shape[0], unet_input, timestep, encoder_hidden_states=encoder_hidden_states,
+            return_dict=False
+        )
+
+    def encode_mutual(self, mutual_latents):
+        # the mutual condition of the generated items in `fashion_generation`
+        if self.onnx_backend is not None:
+            return self.onnx_backend.run("fashion_encoder", mutual_latents).to(self.device)
+        if "fashion_encoder" not in self.compiled_modules:
+            return self.fashion_encoder(mutual_latents)
+        return self.run_compiled("fashion_encoder", mutual_latents.shape[0], mutual_latents)
 
     def pred_ori_sample_given_epsilon(self, timestep, noisy_latent, epsilon):
         alphas_cumprod = self.noise_scheduler.alphas_cumprod.to(self.device)
@@ -274,6 +837,16 @@ class DiFashion(ModelMixin, ConfigMixin):
 
         return pred_ori_sample.clamp(-1., 1.)
     
+    def outfit_generation(self, uids, oids, input_ids, category, history, null_img, **kwargs):
+        """
+        Whole-outfit generation (GOR): every item of the outfits (`input_ids`, `[bsz, olen, 77]`, and `category`,
+        `[bsz, olen]`) is generated from its category, the history of its user and the other generated items, so
+        no outfit images or item ids are needed, nothing but the null image is VAE-encoded and the mutual guidance
+        gathers the generated items directly. The other arguments are those of `fashion_generation`.
+        """
+        olists = torch.zeros(category.shape[:2], dtype=torch.long, device=category.device)
+        return self.fashion_generation(uids, oids, input_ids, olists, None, category, history, null_img=null_img, **kwargs)
+
     @torch.no_grad()
     def fashion_generation(
         self,
@@ -291,39 +864,26 @@ class DiFashion(ModelMixin, ConfigMixin):
         ] = None,  # [bsz, 4, 3, 512, 512]
         category: List[int] = None,  # [bsz, 4]
         history: dict = None,
+        item_latents: torch.Tensor = None,  # [num_items, 4, 64, 64] or a `DedupItemBank`, see `gather_item_latents`
+        item_images=None,  # item id -> image, e.g. an `ImagePathDataset`
         height: Optional[int] = None,
         width: Optional[int] = None,
         num_inference_steps: int = 50,
-        category_guidance_scale: float = 7.5,
-        hist_guidance_scale: float = 7.5,
-        mutual_guidance_scale: float = 7.5,
+        category_guidance_scale: Union[float, torch.Tensor] = 7.5,  # a float, per-sample [bsz,] or per-config [num_configs, bsz] scales
+        hist_guidance_scale: Union[float, torch.Tensor] = 7.5,
+        mutual_guidance_scale: Union[float, torch.Tensor] = 7.5,
+        category_guidance_schedule: Optional[GuidanceSchedule] = None,
+        hist_guidance_schedule: Optional[GuidanceSchedule] = None,
+        mutual_guidance_schedule: Optional[GuidanceSchedule] = None,
         null_img: torch.FloatTensor = None,
         eta: float = 0.0,
         init_latents: torch.Tensor = None,
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
-        output_type: Optional[str] = "pil",
+        output_type: Optional[str] = "pil",  # "pil", "np", "pt", "latent", or "preview" (see `load_preview_decoder`)
         return_dict: bool = True,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: int = 1,
     ):
-        if self.args.use_history and hist_guidance_scale > 1.0:
-            do_classifier_free_guidance_hist = True
-        else:
-            do_classifier_free_guidance_hist = False
-        if self.args.use_mutual_guidance and mutual_guidance_scale > 1.0:
-            do_classifier_free_guidance_mutual = True
-        else:
-            do_classifier_free_guidance_mutual = False
-        if category_guidance_scale > 1.0:
-            do_classifier_free_guidance_category = True
-        else:
-            do_classifier_free_guidance_category = False
-
-        if do_classifier_free_guidance_hist and do_classifier_free_guidance_mutual and do_classifier_free_guidance_category:
-            do_classifier_free_guidance = True
-        else:
-            do_classifier_free_guidance = False
-
         height = height or self.unet.config.sample_size * self.vae_scale_factor
         width = width or self.unet.config.sample_size * self.vae_scale_factor
 
@@ -336,10 +896,36 @@ class DiFashion(ModelMixin, ConfigMixin):
         fill_oids = oids[fill_idx[:, 0]]
         full_cate = category[fill_idx[:, 0]]
 
+        # Scales of shape [num_configs, bsz] generate the batch once per guidance configuration, in one pass: the
+        # per-batch work (prompts, history, outfit latents, initial noise) is shared, and the generated rows are
+        # repeated config by config
+        config_scales = [
+            torch.as_tensor(scale) for scale in (category_guidance_scale, hist_guidance_scale, mutual_guidance_scale)
+        ]
+        num_configs = max([scale.shape[0] for scale in config_scales if scale.dim() == 2], default=None)
+        num_rows = fill_num * (num_configs or 1)
+
+        # Guidance scales and enabled guidance of every generated row
+        guidance_scales = {
+            "category": row_guidance_scales(category_guidance_scale, fill_idx[:, 0], num_configs or 1),
+            "mutual": row_guidance_scales(mutual_guidance_scale, fill_idx[:, 0], num_configs or 1),
+            "hist": row_guidance_scales(hist_guidance_scale, fill_idx[:, 0], num_configs or 1),
+        }
+        do_classifier_free_guidance = {
+            "category": guidance_scales["category"] > 1.0,
+            "mutual": (guidance_scales["mutual"] > 1.0) & bool(self.args.use_mutual_guidance),
+            "hist": (guidance_scales["hist"] > 1.0) & bool(self.args.use_history),
+        }
+        guidance_schedules = {
+            "category": category_guidance_schedule,
+            "mutual": mutual_guidance_schedule,
+            "hist": hist_guidance_schedule,
+        }
+
         fill_input_ids = input_ids[fill_idx[:, 0], fill_idx[:, 1]]
-        category_prompts = self.text_encoder(
+        category_prompts = self.encode_prompts(
             fill_input_ids.to(self.device),
-        )[0].to(dtype=self.text_encoder.dtype, device=self.device)
+        ).to(dtype=self.text_encoder.dtype, device=self.device)
 
         null_input_ids = self.tokenizer(
             [""],
@@ -349,12 +935,23 @@ class DiFashion(ModelMixin, ConfigMixin):
             return_tensors="pt",
         ).input_ids
         null_input_ids = null_input_ids.to(self.device)
-        null_prompt = self.text_encoder(null_input_ids)[0]
+        null_prompt = self.encode_prompts(null_input_ids)
         null_prompts = torch.cat([null_prompt] * category_prompts.shape[0], dim=0)
 
+        prompt_rows = None
+        if self.prompt_kv_cache is not None:
+            # rows of the prompts in the cross-attention cache
+            self.prompt_kv_cache.start_call()
+            prompt_rows = self.prompt_kv_cache.add_prompts(
+                fill_input_ids, category_prompts.to(dtype=self.text_encoder.dtype, device=self.device)
+            )
+            null_prompt_rows = self.prompt_kv_cache.add_prompts(
+                null_input_ids, null_prompt.to(dtype=self.text_encoder.dtype, device=self.device)
+            ).expand(fill_num)
+
         # Set timesteps
-        self.noise_scheduler.set_timesteps(num_inference_steps, device=self.device)
-        timesteps = self.noise_scheduler.timesteps
+        self.inference_scheduler.set_timesteps(num_inference_steps, device=self.device)
+        timesteps = self.inference_scheduler.timesteps
 
         # Prepare latent variables
         num_channels_latents = self.vae.config.latent_channels
@@ -372,8 +969,7 @@ class DiFashion(ModelMixin, ConfigMixin):
         else:
             latents = init_latents.clone()  # designated initial latents
 
-        null_img = null_img.unsqueeze(0)
-        null_latent = self.vae.encode(null_img).latent_dist.mode()[0] * self.vae.config.scaling_factor
+        null_latent = self.encode_null_latent(null_img)
 
         # Prepare history latents
         hist_latents = []
@@ -385,199 +981,164 @@ class DiFashion(ModelMixin, ConfigMixin):
                 hist_latents.append(null_latent)
         hist_latents = torch.stack(hist_latents).to(self.device)
         
-        if do_classifier_free_guidance:
-            null_hist_latents = torch.stack([null_latent] * hist_latents.shape[0])
-            hist_latents = torch.cat([hist_latents, null_hist_latents, null_hist_latents, null_hist_latents], dim=0)
-        elif do_classifier_free_guidance_category:
-            if do_classifier_free_guidance_hist:
-                null_hist_latents = torch.stack([null_latent] * hist_latents.shape[0])
-                hist_latents = torch.cat([hist_latents, null_hist_latents, null_hist_latents], dim=0)
-            elif do_classifier_free_guidance_mutual:
-                hist_latents = torch.cat([hist_latents] * 3, dim=0)
-            else:
-                hist_latents = torch.cat([hist_latents] * 2, dim=0)
-        else:
-            if do_classifier_free_guidance_hist:
-                null_hist_latents = torch.stack([null_latent] * hist_latents.shape[0])
-                hist_latents = torch.cat([hist_latents, null_hist_latents], dim=0)
-            elif do_classifier_free_guidance_mutual:
-                hist_latents = torch.cat([hist_latents] * 2, dim=0)
-            else:
-                pass
-        
-        if do_classifier_free_guidance:
-            encoder_hidden_states = torch.cat(
-                [category_prompts, category_prompts, category_prompts, null_prompts], dim=0
-            ).to(dtype=self.text_encoder.dtype, device=self.device)
-        elif do_classifier_free_guidance_category:
-            if do_classifier_free_guidance_hist or do_classifier_free_guidance_mutual:
-                encoder_hidden_states = torch.cat(
-                    [category_prompts, category_prompts, null_prompts], dim=0
-                ).to(dtype=self.text_encoder.dtype, device=self.device)
-            else:
-                encoder_hidden_states = torch.cat(
-                    [category_prompts, null_prompts], dim=0
-                ).to(dtype=self.text_encoder.dtype, device=self.device)
-        else:
-            if do_classifier_free_guidance_hist or do_classifier_free_guidance_mutual:
-                encoder_hidden_states = torch.cat(
-                    [category_prompts] * 2, dim=0
-                ).to(dtype=self.text_encoder.dtype, device=self.device)
-            else:
-                encoder_hidden_states = category_prompts
+        null_hist_latents = torch.stack([null_latent] * hist_latents.shape[0])
+        category_prompts = category_prompts.to(dtype=self.text_encoder.dtype, device=self.device)
+        null_prompts = null_prompts.to(dtype=self.text_encoder.dtype, device=self.device)
+        # text conditions of the UNet batch, and their rows in the cross-attention cache, per layout of the guidance
+        # branches
+        branch_prompts = {}
+        branch_prompt_rows = {}
         
         # Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
         # Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.noise_scheduler.order
-
-        all_latents = self.vae.encode(
-            outfit_images
-        ).latent_dist.mode() * self.vae.config.scaling_factor
+        num_warmup_steps = len(timesteps) - num_inference_steps * self.inference_scheduler.order
 
+        # Mutual guidance of a fill item is the sum of the other items of its outfit: known items from the outfit
+        # latents, generated ones from the current latents. The slots are gathered once here; the sums keep the item
+        # order so that the results do not depend on the vectorization.
         gen_masks = (olists == 0)
-        mutual_indicies = []
-        all_num = 0
-        for i,_ in enumerate(olists):
-            gen_mask = gen_masks[i]
-            gen_num = sum(gen_mask)
-            indicies = torch.arange(olen) + i * olen
-            indicies[gen_mask] = -torch.arange(all_num, all_num + gen_num) - 1
-            
-            mutual_indicies.append(indicies)
-            all_num += gen_num
-        mutual_indicies = torch.stack(mutual_indicies).to(self.device)
-        assert all_num == fill_idx.shape[0]
+        fill_rows = fill_idx[:, 0]
+        other_slots = torch.ones(fill_num, olen, dtype=torch.bool, device=olists.device)
+        other_slots[torch.arange(fill_num, device=olists.device), fill_idx[:, 1]] = False
+        if gen_masks.all():
+            # whole outfits (GOR): every other slot is generated, and the generated rows follow the outfit slots
+            gen_slots = other_slots.to(self.device)
+            gen_src = (fill_rows[:, None] * olen + torch.arange(olen, device=olists.device)[None]).to(self.device)
+            known_latents = torch.zeros(
+                fill_num, olen, *latents.shape[1:], dtype=null_latent.dtype, device=self.device
+            )
+        else:
+            if item_latents is not None:
+                # the precomputed latents of the outfit items, without loading and encoding their images
+                all_latents = self.gather_item_latents(olists, item_latents, item_images)
+            else:
+                all_latents = self.encode_images(
+                    outfit_images
+                ) * self.vae.config.scaling_factor
+
+            gen_positions = torch.zeros_like(olists)
+            gen_positions[gen_masks] = torch.arange(fill_num, device=olists.device)  # row of each generated item
+            gen_slots = (gen_masks[fill_rows] & other_slots).to(self.device)  # [fill_num, olen]
+            known_slots = (~gen_masks[fill_rows] & other_slots).to(self.device)
+            gen_src = gen_positions[fill_rows].to(self.device)
+            known_src = (fill_rows[:, None] * olen + torch.arange(olen, device=olists.device)[None]).to(self.device)
+            known_latents = all_latents[known_src].to(dtype=null_latent.dtype)
+            known_latents = torch.where(
+                known_slots[..., None, None, None], known_latents, torch.zeros_like(known_latents)
+            )
+
+        def mutual_sum(slot_latents):
+            summed = slot_latents[:, 0]
+            for k in range(1, olen):
+                summed = summed + slot_latents[:, k]
+            return summed
+
+        static_mutual_cond = None
+        if self.args.use_mutual_guidance and not self.fashion_encoder.training and not gen_slots.any():
+            # e.g. FITB with one blank per outfit: the mutual condition does not change over the denoising steps
+            static_mutual_cond = self.encode_mutual(mutual_sum(known_latents))
+
+        if num_configs is not None:
+            # fan the shared inputs out to the trajectory of every guidance configuration
+            def fan_out(x):
+                return torch.cat([x] * num_configs)
+
+            latents = fan_out(latents)
+            category_prompts, null_prompts = fan_out(category_prompts), fan_out(null_prompts)
+            if prompt_rows is not None:
+                prompt_rows, null_prompt_rows = fan_out(prompt_rows), fan_out(null_prompt_rows)
+            hist_latents, null_hist_latents = fan_out(hist_latents), fan_out(null_hist_latents)
+            gen_slots, known_latents = fan_out(gen_slots), fan_out(known_latents)
+            gen_src = torch.cat([gen_src + config * fill_num for config in range(num_configs)])
+            if static_mutual_cond is not None:
+                static_mutual_cond = fan_out(static_mutual_cond)
+            fill_uids, fill_oids = fan_out(fill_uids), fan_out(fill_oids)
+            fill_cate, full_cate = fan_out(fill_cate), fan_out(full_cate)
+
+        # Rows whose conditional input equals the null one do not need their own guidance branch
+        redundant = {
+            "category": (category_prompts == null_prompts).flatten(1).all(dim=1),
+            "hist": (hist_latents == null_hist_latents).flatten(1).all(dim=1),
+        }
+        if static_mutual_cond is not None:
+            redundant["mutual"] = (static_mutual_cond == null_latent.unsqueeze(0)).flatten(1).all(dim=1)
+        elif not self.args.use_mutual_guidance:
+            redundant["mutual"] = torch.ones(num_rows, dtype=torch.bool, device=self.device)
+
+        # Persistent UNet input of the CFG batch, sized for the branches of all the guidance terms
+        max_branches = sum(bool(enabled.any()) for enabled in do_classifier_free_guidance.values()) + 1
+        input_dtype = torch.promote_types(torch.promote_types(latents.dtype, null_latent.dtype), hist_latents.dtype)
+        workspace = self.cfg_workspace(num_rows, max_branches, latents.shape[1:], hist_latents.shape[1], input_dtype)
+        if self.feature_cache is not None:
+            self.feature_cache.reset()
+        workspace.eta_null = self.args.eta * null_latent.unsqueeze(0).expand(num_rows, *null_latent.shape)
+        if static_mutual_cond is not None:
+            workspace.eta_mutual = self.args.eta * static_mutual_cond
+        elif not self.args.use_mutual_guidance:
+            workspace.eta_mutual = workspace.eta_null
         
         prev_latents = latents.clone().to(dtype=null_latent.dtype)
 
         # with self.progress_bar(total=num_inference_steps) as progress_bar:
         for i, t in enumerate(timesteps):
-            # Expand the latents if we are doing classifier free guidance.
-            if do_classifier_free_guidance:
-                latent_model_input = torch.cat([latents] * 4)
-            elif do_classifier_free_guidance_category:
-                if do_classifier_free_guidance_mutual or do_classifier_free_guidance_hist:
-                    latent_model_input = torch.cat([latents] * 3)
-                else:
-                    latent_model_input = torch.cat([latents] * 2)
-            else:
-                if do_classifier_free_guidance_mutual or do_classifier_free_guidance_hist:
-                    latent_model_input = torch.cat([latents] * 2)
-                else:
-                    latent_model_input = latents
-
-            # concat latents, hist_latents
-            scaled_latent_model_input = self.noise_scheduler.scale_model_input(latent_model_input, t)
+            # The guidance terms active at this timestep, and the UNet branches they need
+            terms, inactive = guidance_terms(
+                t, self.noise_scheduler.config.num_train_timesteps, guidance_scales, do_classifier_free_guidance,
+                guidance_schedules
+            )
+            branches = guidance_branches(terms)
+            layout = workspace.set_branches(branches, inactive, hist_latents, null_hist_latents, redundant)
+            if layout not in branch_prompts:
+                branch_prompts[layout] = workspace.branch_batch("category", category_prompts, null_prompts)
+                if prompt_rows is not None:
+                    branch_prompt_rows[layout] = workspace.branch_batch(
+                        "category", prompt_rows.unsqueeze(1), null_prompt_rows.unsqueeze(1)
+                    ).squeeze(1)
+            encoder_hidden_states = branch_prompts[layout]
+            if prompt_rows is not None:
+                self.prompt_kv_cache.rows = branch_prompt_rows[layout]
+
+            scaled_latents = self.inference_scheduler.scale_model_input(latents, t)
 
             # Prepare mutual guidance
-            if self.args.use_mutual_guidance:
-                mutual_cond = []
-                for j,(o_idx, i_idx) in enumerate(fill_idx):
-                    weights = torch.ones(olen).to(self.device)
-                    weights[i_idx] = 0.
-
-                    mutual_latents = torch.zeros_like(null_latent).unsqueeze(0).repeat(olen, 1, 1, 1).to(self.device)
-                    gen_mask = gen_masks[o_idx]
-                    mutual_latents[~gen_mask] = all_latents[mutual_indicies[o_idx][~gen_mask]]
-                    mutual_latents[gen_mask] = prev_latents[-mutual_indicies[o_idx][gen_mask]-1]
-                    
-                    weighted_latents = sum([weight * emb for weight,emb in zip(weights, mutual_latents)])
-                    mutual_cond.append(weighted_latents)
-                
-                mutual_cond = torch.stack(mutual_cond).to(self.device)
-                mutual_cond = self.fashion_encoder(mutual_cond)
-            else:
-                mutual_cond = torch.stack([null_latent] * fill_num).to(self.device)
-
-            if do_classifier_free_guidance:
-                null_mutual_cond = torch.stack([null_latent] * mutual_cond.shape[0])
-                mutual_cond = torch.cat([mutual_cond, mutual_cond, null_mutual_cond, null_mutual_cond], dim=0)
-            elif do_classifier_free_guidance_category:
-                if do_classifier_free_guidance_mutual:
-                    null_mutual_cond = torch.stack([null_latent] * mutual_cond.shape[0])
-                    mutual_cond = torch.cat([mutual_cond, null_mutual_cond, null_mutual_cond], dim=0)
-                elif do_classifier_free_guidance_hist:
-                    mutual_cond = torch.cat([mutual_cond] * 3, dim=0)
-                else:
-                    mutual_cond = torch.cat([mutual_cond] * 2, dim=0)
-            else:
-                if do_classifier_free_guidance_mutual:
-                    null_mutual_cond = torch.stack([null_latent] * mutual_cond.shape[0])
-                    mutual_cond = torch.cat([mutual_cond, null_mutual_cond], dim=0)
-                elif do_classifier_free_guidance_hist:
-                    mutual_cond = torch.cat([mutual_cond] * 2, dim=0)
-                else:
-                    pass
-            
-            scaled_latent_model_input = (1 - self.args.eta) * scaled_latent_model_input + self.args.eta * mutual_cond
-            scaled_latent_model_input = torch.cat([scaled_latent_model_input, hist_latents], dim=1)
+            if static_mutual_cond is None and self.args.use_mutual_guidance:
+                slot_latents = torch.where(gen_slots[..., None, None, None], prev_latents[gen_src], known_latents)
+                mutual_cond = self.encode_mutual(mutual_sum(slot_latents))
+                if workspace.eta_mutual is None or workspace.eta_mutual.dtype != mutual_cond.dtype:
+                    workspace.eta_mutual = torch.empty_like(mutual_cond)
+                torch.mul(mutual_cond, self.args.eta, out=workspace.eta_mutual)
+
+            # (1 - eta) * latents + eta * mutual condition, concatenated with the history condition
+            workspace.set_latents(scaled_latents, self.args.eta, workspace.eta_mutual, workspace.eta_null)
 
             # predict the noise residual
-            noise_pred = self.unet(
-                scaled_latent_model_input,
-                t,
-                encoder_hidden_states=encoder_hidden_states,
-                return_dict=False
-            )[0]
-
-            if do_classifier_free_guidance:
-                noise_pred_allcond, noise_pred_cate_mutual, noise_pred_cate, noise_pred_uncond = noise_pred.chunk(4)
-                noise_pred = (
-                    noise_pred_uncond
-                    + hist_guidance_scale * (noise_pred_allcond - noise_pred_cate_mutual)
-                    + mutual_guidance_scale * (noise_pred_cate_mutual - noise_pred_cate)
-                    + category_guidance_scale * (noise_pred_cate - noise_pred_uncond)
-                )
-            elif do_classifier_free_guidance_category:
-                if do_classifier_free_guidance_hist:
-                    noise_pred_cate_hist, noise_pred_cate, noise_pred_uncond = noise_pred.chunk(3)
-                    noise_pred = (
-                        noise_pred_uncond
-                        + hist_guidance_scale * (noise_pred_cate_hist - noise_pred_cate)
-                        + category_guidance_scale * (noise_pred_cate - noise_pred_uncond)
-                    )
-                elif do_classifier_free_guidance_mutual:
-                    noise_pred_cate_mutual, noise_pred_cate, noise_pred_uncond = noise_pred.chunk(3)
-                    noise_pred = (
-                        noise_pred_uncond
-                        + mutual_guidance_scale * (noise_pred_cate_mutual - noise_pred_cate)
-                        + category_guidance_scale * (noise_pred_cate - noise_pred_uncond)
-                    )
-                else:
-                    noise_pred_cate, noise_pred_uncond = noise_pred.chunk(2)
-                    noise_pred = (
-                        noise_pred_uncond
-                        + category_guidance_scale * (noise_pred_cate - noise_pred_uncond)
-                    )
-            else:
-                if do_classifier_free_guidance_hist:
-                    noise_pred_hist, noise_pred_uncond = noise_pred.chunk(2)
-                    noise_pred = (
-                        noise_pred_uncond
-                        + hist_guidance_scale * (noise_pred_hist - noise_pred_uncond)
-                    )
-                elif do_classifier_free_guidance_mutual:
-                    noise_pred_mutual, noise_pred_uncond = noise_pred.chunk(2)
-                    noise_pred = (
-                        noise_pred_uncond
-                        + mutual_guidance_scale * (noise_pred_mutual - noise_pred_uncond)
-                    )
+            noise_pred = self.denoise(workspace.batch_input(), t, encoder_hidden_states, layout)
+
+            noise_pred = combine_guidance(workspace.expand(noise_pred), terms)
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = self.noise_scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
+            latents = self.inference_scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
 
             prev_latents = latents.to(dtype=null_latent.dtype)
 
             # call the callback, if provided
-            if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.noise_scheduler.order == 0):
+            if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.inference_scheduler.order == 0):
                 # progress_bar.update()
                 if callback is not None and i % callback_steps == 0:
                     callback(i, t, latents)
+
+        if self.prompt_kv_cache is not None:
+            self.prompt_kv_cache.rows = None
         
-        if not output_type == "latent":
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
+        if output_type == "preview":
+            # PIL images from the lightweight decoder
+            image = self.decode_preview(latents)
+            output_type = "pil"
+            has_nsfw_concept = None
+        elif not output_type == "latent":
+            image = self.decode_latents(latents / self.vae.config.scaling_factor)
             # image, has_nsfw_concept = self.run_safety_checker(image, device, category_prompts.dtype)
             has_nsfw_concept = None
         else:
@@ -596,22 +1157,28 @@ class DiFashion(ModelMixin, ConfigMixin):
             self.final_offload_hook.offload()
 
         if not return_dict:
-            all_results = {}
-            for i,uid in enumerate(fill_uids):
-                uid = uid.item()
-                oid = fill_oids[i].item()
-                if uid not in all_results:
-                    all_results[uid] = {}
-                if oid not in all_results[uid]:
-                    all_results[uid][oid] = {}
-                    all_results[uid][oid]["images"] = []
-                    all_results[uid][oid]["cates"] = []
-                    all_results[uid][oid]["full_cates"] = full_cate[i]
-                all_results[uid][oid]["images"].append(image[i])
-                all_results[uid][oid]["cates"].append(fill_cate[i])
-                all_results[uid][oid]["outfits"] = olists[fill_idx[i][0]]  
-            
-            return all_results, init_latents
+            # one result dict per guidance configuration
+            config_results = []
+            for config in range(num_configs or 1):
+                all_results = {}
+                for i in range(config * fill_num, (config + 1) * fill_num):
+                    uid = fill_uids[i].item()
+                    oid = fill_oids[i].item()
+                    if uid not in all_results:
+                        all_results[uid] = {}
+                    if oid not in all_results[uid]:
+                        all_results[uid][oid] = {}
+                        all_results[uid][oid]["images"] = []
+                        all_results[uid][oid]["cates"] = []
+                        all_results[uid][oid]["full_cates"] = full_cate[i]
+                    all_results[uid][oid]["images"].append(image[i])
+                    all_results[uid][oid]["cates"].append(fill_cate[i])
+                    all_results[uid][oid]["outfits"] = olists[fill_idx[i % fill_num][0]]
+                config_results.append(all_results)
+
+            if num_configs is None:
+                return config_results[0], init_latents
+            return config_results, init_latents
 
         return (StableDiffusionPipelineOutput(images=image, nsfw_content_detected=has_nsfw_concept), fill_uids, fill_oids, fill_cate, full_cate, init_latents)
     
@@ -629,7 +1196,7 @@ class DiFashion(ModelMixin, ConfigMixin):
             latents = latents.to(device)
 
         # scale the initial noise by the standard deviation required by the scheduler
-        latents = latents * self.noise_scheduler.init_noise_sigma
+        latents = latents * self.inference_scheduler.init_noise_sigma
         return latents
 
     def compute_snr(self, timesteps):
@@ -662,13 +1229,13 @@ class DiFashion(ModelMixin, ConfigMixin):
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
 
-        accepts_eta = "eta" in set(inspect.signature(self.noise_scheduler.step).parameters.keys())
+        accepts_eta = "eta" in set(inspect.signature(self.inference_scheduler.step).parameters.keys())
         extra_step_kwargs = {}
         if accepts_eta:
             extra_step_kwargs["eta"] = eta
 
         # check if the scheduler accepts generator
-        accepts_generator = "generator" in set(inspect.signature(self.noise_scheduler.step).parameters.keys())
+        accepts_generator = "generator" in set(inspect.signature(self.inference_scheduler.step).parameters.keys())
         if accepts_generator:
             extra_step_kwargs["generator"] = generator
         return extra_step_kwargs
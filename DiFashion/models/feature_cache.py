@@ -0,0 +1,150 @@
+import torch
+
+
+def check_unet_config(unet):
+    """
+    `unet_forward` only reimplements the parts of `UNet2DConditionModel.forward` that the DiFashion UNet uses; raise
+    for the options it would silently skip.
+    """
+    config = unet.config
+    unsupported = {
+        "center_input_sample": config.center_input_sample,
+        "class_embed_type": getattr(unet, "class_embedding", None) is not None,
+        "addition_embed_type": getattr(unet, "add_embedding", None) is not None,
+        "encoder_hid_dim_type": getattr(unet, "encoder_hid_proj", None) is not None,
+        "time_cond_proj_dim": config.get("time_cond_proj_dim") is not None,
+        "attention_type": config.get("attention_type", "default") != "default",
+    }
+    options = [name for name, is_set in unsupported.items() if is_set]
+    if options:
+        raise ValueError(f"The feature cache does not support UNets with {', '.join(options)}.")
+
+
+def unet_forward(unet, sample, timestep, encoder_hidden_states, branch=None, cached_features=None):
+    """
+    The forward pass of a `UNet2DConditionModel` (for the DiFashion configuration: no class, added or ControlNet
+    conditions), split at depth `branch`: the shallow part is `conv_in`, the first `branch` down blocks and the last
+    `branch` up blocks, the deep part is everything in between.
+
+    Without `cached_features`, runs the whole UNet and returns `(noise_pred, features)`, with `features` the output of
+    the deep part (the input of the shallow up blocks) if `branch` is set. With `cached_features`, only the shallow
+    part runs and the deep part is replaced by `cached_features`.
+    """
+    # time embedding
+    timesteps = timestep
+    if not torch.is_tensor(timesteps):
+        timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
+    elif timesteps.dim() == 0:
+        timesteps = timesteps[None].to(sample.device)
+    timesteps = timesteps.expand(sample.shape[0])
+    emb = unet.time_embedding(unet.time_proj(timesteps).to(dtype=sample.dtype))
+    if getattr(unet, "time_embed_act", None) is not None:
+        emb = unet.time_embed_act(emb)
+
+    # the upsampling sizes are only forwarded if the sample is not a multiple of the overall upsampling factor
+    forward_upsample_size = any(s % 2 ** unet.num_upsamplers != 0 for s in sample.shape[-2:])
+
+    def run_block(block, hidden_states, **kwargs):
+        if getattr(block, "has_cross_attention", False):
+            kwargs["encoder_hidden_states"] = encoder_hidden_states
+        return block(hidden_states=hidden_states, temb=emb, **kwargs)
+
+    sample = unet.conv_in(sample)
+    num_blocks = len(unet.down_blocks)
+    shallow = num_blocks if cached_features is None else branch
+    down_block_res_samples = (sample,)
+    for down_block in unet.down_blocks[:shallow]:
+        sample, res_samples = run_block(down_block, sample)
+        down_block_res_samples += res_samples
+
+    features = None
+    if cached_features is None:
+        if unet.mid_block is not None:
+            sample = unet.mid_block(sample, emb, encoder_hidden_states=encoder_hidden_states)
+        first_up = 0
+    else:
+        # the residuals of the shallow up blocks; the last downsampling only feeds the deep part
+        num_residuals = sum(len(up_block.resnets) for up_block in unet.up_blocks[num_blocks - branch:])
+        down_block_res_samples = down_block_res_samples[:num_residuals]
+        sample = cached_features
+        first_up = num_blocks - branch
+
+    for i in range(first_up, num_blocks):
+        if branch is not None and i == num_blocks - branch and cached_features is None:
+            features = sample
+        up_block = unet.up_blocks[i]
+        res_samples = down_block_res_samples[-len(up_block.resnets):]
+        down_block_res_samples = down_block_res_samples[:-len(up_block.resnets)]
+        upsample_size = None
+        if i < num_blocks - 1 and forward_upsample_size:
+            upsample_size = down_block_res_samples[-1].shape[2:]
+        sample = run_block(up_block, sample, res_hidden_states_tuple=res_samples, upsample_size=upsample_size)
+
+    if unet.conv_norm_out is not None:
+        sample = unet.conv_act(unet.conv_norm_out(sample))
+    return unet.conv_out(sample), features
+
+
+class UNetFeatureCache:
+    r"""
+    Cross-step reuse of the deep UNet features in `fashion_generation`, as in "DeepCache: Accelerating Diffusion
+    Models for Free", https://arxiv.org/abs/2312.00858.
+
+    Every `interval` steps, a full step runs the whole UNet and caches the output of its deep part (see
+    `unet_forward`, split at depth `branch`); the steps in between only run the shallow blocks on the new input
+    (including the 8-channel conditioned `conv_in`) and reuse the cached deep features. The cache is only reused for
+    the same CFG batch: a new `key` (the branch layout of the batch) forces a full step.
+    """
+
+    def __init__(self, unet, interval=3, branch=1):
+        check_unet_config(unet)
+        if interval < 1:
+            raise ValueError(f"The feature cache interval should be at least 1, but is {interval}.")
+        if not 1 <= branch < len(unet.down_blocks):
+            raise ValueError(f"The feature cache branch should be in [1, {len(unet.down_blocks) - 1}], but is {branch}.")
+        self.interval = interval
+        self.branch = branch
+        self.reset()
+
+    def reset(self):
+        # new call: the features of the previous call are stale
+        self.features = None
+        self.key = None
+        self.num_cached_steps = 0
+        self.num_full_steps = 0
+
+    def __call__(self, unet, sample, timestep, encoder_hidden_states, key=None):
+        full_step = (
+            self.features is None
+            or key != self.key
+            or self.features.shape[0] != sample.shape[0]
+            or self.num_cached_steps >= self.interval - 1
+        )
+        if full_step:
+            noise_pred, self.features = unet_forward(unet, sample, timestep, encoder_hidden_states, self.branch)
+            self.key = key
+            self.num_cached_steps = 0
+            self.num_full_steps += 1
+        else:
+            noise_pred, _ = unet_forward(
+                unet, sample, timestep, encoder_hidden_states, self.branch, cached_features=self.features
+            )
+            self.num_cached_steps += 1
+        return noise_pred
+
+
+@torch.no_grad()
+def feature_cache_parity(unet, sample, timestep, encoder_hidden_states, branch=1):
+    """
+    Max abs differences to `unet(...)` of a step of the feature cache with `interval=1` (the whole UNet through
+    `unet_forward`) and of a cached step on the same input, which reuses the deep features of that very input.
+    """
+    reference = unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+    full_step = UNetFeatureCache(unet, interval=1, branch=branch)(unet, sample, timestep, encoder_hidden_states)
+    feature_cache = UNetFeatureCache(unet, interval=2, branch=branch)
+    feature_cache(unet, sample, timestep, encoder_hidden_states)
+    cached_step = feature_cache(unet, sample, timestep, encoder_hidden_states)
+    return {
+        "full step": (full_step - reference).abs().max().item(),
+        "cached step": (cached_step - reference).abs().max().item(),
+    }
@@ -0,0 +1,316 @@
+import math
+
+import torch
+
+
+# The conditions of the nested classifier-free guidance, from the innermost to the outermost term:
+# eps = eps(uncond) + s_cate * (eps(cate) - eps(uncond)) + s_mutual * (eps(cate, mutual) - eps(cate))
+#       + s_hist * (eps(cate, mutual, hist) - eps(cate, mutual))
+GUIDANCE_CONDITIONS = ["category", "mutual", "hist"]
+
+
+class GuidanceSchedule:
+    r"""
+    Timestep schedule of one guidance term.
+
+    The term is only applied for timesteps `t` with `t / num_train_timesteps` in `interval`, outside of it the branch
+    is dropped from the UNet batch and the condition is kept in every branch (as for a disabled guidance). Inside the
+    interval, `decay` shapes the scale along the trajectory: "constant" keeps it, "linear" and "cosine" decay it from
+    `scale` at `t = T` towards 1 at `t = 0`. The term is dropped as well once its scale is not above 1.
+
+    See "Applying Guidance in a Limited Interval Improves Sample and Distribution Quality in Diffusion Models",
+    https://arxiv.org/abs/2404.07724.
+    """
+
+    DECAYS = ["constant", "linear", "cosine"]
+
+    def __init__(self, interval=(0.0, 1.0), decay="constant"):
+        if decay not in self.DECAYS:
+            raise ValueError(f"Unknown guidance decay {decay}, choose from {self.DECAYS}.")
+        if not 0.0 <= interval[0] <= interval[1] <= 1.0:
+            raise ValueError(f"The guidance interval should satisfy 0 <= start <= end <= 1, but is {interval}.")
+        self.interval = tuple(interval)
+        self.decay = decay
+
+    @classmethod
+    def from_string(cls, spec):
+        """
+        Parse `"<decay>"` or `"<decay>:<start>:<end>"`, e.g. `"linear"` or `"constant:0.3:1.0"`.
+        """
+        parts = spec.split(":")
+        if len(parts) == 1:
+            return cls(decay=parts[0])
+        if len(parts) == 3:
+            return cls(interval=(float(parts[1]), float(parts[2])), decay=parts[0])
+        raise ValueError(f"Cannot parse the guidance schedule {spec}, expected `<decay>` or `<decay>:<start>:<end>`.")
+
+    def __call__(self, scale, timestep, num_train_timesteps):
+        """
+        The guidance scale (a float or per-row tensor) at `timestep`, or `None` outside the active interval.
+        """
+        frac = float(timestep) / num_train_timesteps
+        if frac < self.interval[0] or frac > self.interval[1]:
+            return None
+        if self.decay == "linear":
+            weight = frac
+        elif self.decay == "cosine":
+            weight = (1 - math.cos(math.pi * frac)) / 2
+        else:
+            weight = 1.0
+        return 1.0 + (scale - 1.0) * weight
+
+    def __repr__(self):
+        return f"GuidanceSchedule(interval={self.interval}, decay={self.decay})"
+
+
+def row_guidance_scales(scale, sample_index, num_configs=1):
+    """
+    Guidance scales of the generated rows, as a float64 CPU tensor. `scale` is a float or a per-sample sequence
+    (tensor) of scales, and `sample_index` the sample of every row. With `num_configs` guidance configurations,
+    the rows are repeated config by config, and a `[num_configs, bsz]` (or `[num_configs, 1]`) tensor gives the
+    scales of every configuration.
+    """
+    scale = torch.as_tensor(scale, dtype=torch.float64).cpu()
+    if scale.dim() == 0:
+        return scale.repeat(num_configs * len(sample_index))
+    if scale.dim() == 1:
+        return scale[sample_index.cpu()].repeat(num_configs)
+    scale = scale.expand(num_configs, -1)
+    if scale.shape[1] == 1:
+        return scale[:, 0].repeat_interleave(len(sample_index))
+    return scale[:, sample_index.cpu()].flatten()
+
+
+def _term_scale(scale, rows):
+    # a float if all the rows of the term share the scale (the scalar case), else the per-row tensor
+    values = scale[rows]
+    if bool((values == values[0]).all()):
+        return float(values[0])
+    return scale
+
+
+def guidance_terms(timestep, num_train_timesteps, scales, enabled, schedules=None):
+    """
+    The guidance terms active at `timestep`, from the innermost one. `scales` and `enabled` are dicts over
+    `GUIDANCE_CONDITIONS` of per-row scales and masks (see `row_guidance_scales`); a missing schedule means a
+    constant scale over the whole trajectory.
+
+    Returns `(terms, inactive)`: `terms` is a list of `(conditions, scale)`, with `scale` a float or a per-row
+    tensor, and `inactive` maps a guided condition to the rows for which it is not guided at this timestep. As for
+    a disabled guidance, these rows keep the condition in every branch.
+    """
+    schedules = schedules or {}
+    active, step_scales = {}, {}
+    for cond in GUIDANCE_CONDITIONS:
+        schedule = schedules.get(cond)
+        scale = scales[cond] if schedule is None else schedule(scales[cond], timestep, num_train_timesteps)
+        if scale is None:
+            active[cond] = torch.zeros_like(enabled[cond])
+            scale = scales[cond]
+        else:
+            active[cond] = enabled[cond] & (scale > 1.0)
+        step_scales[cond] = scale
+
+    # without category guidance, history and mutual guidance are applied jointly with the history scale
+    joint = ~enabled["category"] & active["mutual"] & active["hist"]
+    if bool(joint.all()):
+        return [(("mutual", "hist"), _term_scale(step_scales["hist"], joint))], {}
+    # for some of the rows only: the same as separate terms with the history scale for mutual guidance
+    step_scales["mutual"] = torch.where(joint, step_scales["hist"], step_scales["mutual"])
+
+    terms, inactive = [], {}
+    for cond in GUIDANCE_CONDITIONS:
+        if bool(active[cond].any()):
+            terms.append(((cond,), _term_scale(step_scales[cond], active[cond])))
+            if not bool(active[cond].all()):
+                inactive[cond] = ~active[cond]
+    return terms, inactive
+
+
+def guidance_branches(terms):
+    """
+    The conditions of the UNet branches needed by `terms`, from the fully conditioned branch to the least
+    conditioned one. Conditions without an active term are kept in every branch.
+    """
+    guided = {cond for conds, _ in terms for cond in conds}
+    branch = frozenset(cond for cond in GUIDANCE_CONDITIONS if cond not in guided)
+    branches = [branch]
+    for conds, _ in terms:
+        branch = branch | frozenset(conds)
+        branches.append(branch)
+    return branches[::-1]
+
+
+def combine_guidance(noise_pred, terms):
+    """
+    Combine the UNet predictions of the `guidance_branches(terms)` batch (chunked along the batch dimension).
+    """
+    if len(terms) == 0:
+        return noise_pred
+    noise_preds = noise_pred.chunk(len(terms) + 1)
+    # noise_preds[-1] is the least conditioned branch, noise_preds[-(k + 2)] adds the conditions of terms[k]
+    guided = noise_preds[-1]
+    for k in reversed(range(len(terms))):
+        scale = terms[k][1]
+        if isinstance(scale, torch.Tensor):
+            scale = scale.to(device=noise_pred.device, dtype=torch.float32).view(-1, *[1] * (noise_pred.dim() - 1))
+        guided = guided + scale * (noise_preds[-(k + 2)] - noise_preds[-(k + 1)])
+    return guided
+
+
+class CFGWorkspace:
+    r"""
+    Persistent UNet input of the CFG batch of `fashion_generation`, allocated once for up to `max_branches` branches
+    of `num_rows` rows and reused over the denoising steps (and over calls with the same shapes).
+
+    Rows `[b * num_rows, (b + 1) * num_rows)` hold branch `b`. The history channels only depend on the branches, so
+    they are written when the branch layout changes; every step only writes the mixed latents of each branch in
+    place, so the loop does not allocate and its buffers have fixed addresses.
+
+    A row has the conditions of its branch plus the guided conditions that are `inactive` for it (see
+    `guidance_terms`). With `redundant` row masks (per condition, the rows whose conditional input equals the null
+    one, e.g. users without history for the fill category), a branch row that only differs from a less conditioned
+    branch in redundant or inactive conditions has the same UNet input. Such rows are left out of the UNet batch
+    (`batch_input`) and their predictions are aliased to the ones of the less conditioned branch (`expand`), so rows
+    needing 2, 3 or 4 branches share one UNet call without computing padding rows.
+    """
+
+    def __init__(self, num_rows, max_branches, latent_shape, hist_channels, dtype, device):
+        self.num_rows = num_rows
+        self.max_branches = max_branches
+        self.latent_channels = latent_shape[0]
+        self.unet_input = torch.empty(
+            (max_branches * num_rows, latent_shape[0] + hist_channels) + tuple(latent_shape[1:]), dtype=dtype, device=device
+        )
+        self.scaled = None
+        self.eta_rows = None
+        self.compact_input = None
+        self.reset()
+
+    def matches(self, num_rows, max_branches, latent_shape, hist_channels, dtype, device):
+        return (
+            self.num_rows == num_rows
+            and self.max_branches >= max_branches
+            and tuple(self.unet_input.shape[1:]) == (latent_shape[0] + hist_channels,) + tuple(latent_shape[1:])
+            and self.unet_input.dtype == dtype
+            and self.unet_input.device == torch.device(device)
+        )
+
+    def reset(self):
+        # new call: the conditions of the previous call are stale
+        self.eta_mutual = None
+        self.eta_null = None
+        self.branches = None
+        self.layout = None
+        self.members = None
+        self.keep = None
+        self.alias = None
+
+    def branch_rows(self, b):
+        return self.unet_input[b * self.num_rows:(b + 1) * self.num_rows]
+
+    def set_branches(self, branches, inactive, hist_latents, null_hist_latents, redundant=None):
+        """
+        Write the history channels of `branches` and find their redundant rows. Returns the layout key, which
+        changes with the branches or the inactive rows.
+        """
+        layout = (tuple(branches), tuple((cond, tuple(rows.tolist())) for cond, rows in sorted(inactive.items())))
+        if self.layout != layout:
+            device = self.unet_input.device
+            inactive = {cond: rows.to(device) for cond, rows in inactive.items()}
+            # members[b][cond]: True, False or the mask of the rows of branch b with the condition
+            self.members = [
+                {cond: True if cond in branch else inactive.get(cond, False) for cond in GUIDANCE_CONDITIONS}
+                for branch in branches
+            ]
+            for b in range(len(branches)):
+                self.branch_rows(b)[:, self.latent_channels:].copy_(
+                    self.select(self.members[b]["hist"], hist_latents, null_hist_latents)
+                )
+            self.branches = branches
+            self.layout = layout
+
+            redundant = dict(redundant or {})
+            for cond, rows in inactive.items():
+                redundant[cond] = redundant[cond] | rows if cond in redundant else rows
+            self.set_aliases(branches, redundant)
+        return self.layout
+
+    @staticmethod
+    def select(member, values, null_values):
+        if member is True:
+            return values
+        if member is False:
+            return null_values
+        return torch.where(member.view(-1, *[1] * (values.dim() - 1)), values, null_values)
+
+    def set_aliases(self, branches, redundant):
+        self.keep, self.alias = None, None
+        if not redundant or len(branches) == 1:
+            return
+        num_rows, device = self.num_rows, self.unet_input.device
+        no_rows = torch.zeros(num_rows, dtype=torch.bool, device=device)
+
+        # alias_branch[b, r]: the least conditioned branch with the same input as branch b for row r
+        alias_branch = torch.arange(len(branches), device=device).unsqueeze(1).repeat(1, num_rows)
+        for b in range(len(branches)):
+            for b_less in range(b + 1, len(branches)):
+                same = torch.ones(num_rows, dtype=torch.bool, device=device)
+                for cond in branches[b] - branches[b_less]:
+                    same = same & redundant.get(cond, no_rows)
+                alias_branch[b, same] = b_less
+
+        kept = (alias_branch == torch.arange(len(branches), device=device).unsqueeze(1)).flatten()
+        if kept.all():
+            return
+        self.keep = kept.nonzero().squeeze(1)
+        compact_positions = torch.full_like(kept, -1, dtype=torch.long)
+        compact_positions[self.keep] = torch.arange(len(self.keep), device=device)
+        self.alias = compact_positions[(alias_branch * num_rows + torch.arange(num_rows, device=device)).flatten()]
+
+    def branch_batch(self, cond, values, null_values):
+        """
+        The UNet batch of a per-row condition (e.g. the text conditions), without the redundant rows.
+        """
+        batch = torch.cat([self.select(members[cond], values, null_values) for members in self.members], dim=0)
+        return batch if self.keep is None else batch.index_select(0, self.keep)
+
+    def batch_input(self):
+        """
+        The UNet input of the current branches, without the redundant rows.
+        """
+        rows = self.unet_input[:len(self.branches) * self.num_rows]
+        if self.keep is None:
+            return rows
+        if self.compact_input is None:
+            self.compact_input = torch.empty_like(self.unet_input)
+        return torch.index_select(rows, 0, self.keep, out=self.compact_input[:len(self.keep)])
+
+    def expand(self, noise_pred):
+        """
+        The predictions of all the rows of the current branches, from the ones of `batch_input`.
+        """
+        return noise_pred if self.alias is None else noise_pred.index_select(0, self.alias)
+
+    def set_latents(self, scaled_latents, eta, eta_mutual, eta_null):
+        """
+        Write `(1 - eta) * scaled_latents + eta * mutual condition` into the latent channels of every branch,
+        with `eta_mutual` / `eta_null` the premultiplied mutual conditions of the conditioned / null rows.
+        """
+        if self.scaled is None or self.scaled.dtype != scaled_latents.dtype:
+            self.scaled = torch.empty_like(scaled_latents)
+        torch.mul(scaled_latents, 1 - eta, out=self.scaled)
+        for b, members in enumerate(self.members):
+            member = members["mutual"]
+            if member is True:
+                eta_cond = eta_mutual
+            elif member is False:
+                eta_cond = eta_null
+            else:
+                mask = member.view(-1, 1, 1, 1)
+                if self.eta_rows is None or self.eta_rows.dtype != torch.promote_types(eta_mutual.dtype, eta_null.dtype):
+                    self.eta_rows = torch.where(mask, eta_mutual, eta_null)
+                else:
+                    torch.where(mask, eta_mutual, eta_null, out=self.eta_rows)
+                eta_cond = self.eta_rows
+            torch.add(self.scaled, eta_cond, out=self.branch_rows(b)[:, :self.latent_channels])
@@ -0,0 +1,149 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Exported modules of `fashion_generation`: name -> (input names, output name); every input has a dynamic batch,
+# except the timestep
+ONNX_MODULES = {
+    "unet": (["sample", "timestep", "encoder_hidden_states"], "noise_pred"),
+    "fashion_encoder": (["mutual_latents"], "mutual_cond"),
+    "vae_encoder": (["images"], "latents"),
+    "vae_decoder": (["latents"], "images"),
+}
+TEXT_EMBEDDINGS = "text_embeddings.npz"
+
+
+class UNetExport(nn.Module):
+    # the 8-channel UNet with tensor in- and outputs
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+
+class VaeEncoderExport(nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, images):
+        return self.vae.encode(images).latent_dist.mode()
+
+
+class VaeDecoderExport(nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latents):
+        return self.vae.decode(latents, return_dict=False)[0]
+
+
+@torch.no_grad()
+def export_onnx(model, output_dir, prompt_input_ids, opset=17):
+    """
+    Export the modules of `model` (a `DiFashion` in fp32) used by `fashion_generation` to
+    `<output_dir>/<module>/model.onnx`, see `ONNX_MODULES`, and the text-encoder hidden states of `prompt_input_ids`
+    (the category prompts and the null prompt) as a lookup table to `<output_dir>/text_embeddings.npz`: the prompts
+    of DiFashion come from a fixed set, so the text encoder itself is not needed at inference.
+    """
+    from diffusers.models.attention_processor import AttnProcessor
+
+    model.eval()
+    # the plain attention processor exports on every opset, unlike xformers
+    model.unet.set_attn_processor(AttnProcessor())
+    model.vae.set_attn_processor(AttnProcessor())
+    device = model.device
+
+    latent_channels = model.vae.config.latent_channels
+    latent_size = model.unet.config.sample_size
+    image_size = latent_size * model.vae_scale_factor
+    seq_len = prompt_input_ids.shape[1]
+    dummy_inputs = {
+        "unet": (
+            torch.randn(2, model.unet.config.in_channels, latent_size, latent_size, device=device),
+            torch.tensor([500.0], device=device),
+            torch.randn(2, seq_len, model.text_encoder.config.hidden_size, device=device),
+        ),
+        "fashion_encoder": (torch.randn(2, latent_channels, latent_size, latent_size, device=device),),
+        "vae_encoder": (torch.randn(2, 3, image_size, image_size, device=device),),
+        "vae_decoder": (torch.randn(2, latent_channels, latent_size, latent_size, device=device),),
+    }
+    modules = {
+        "unet": UNetExport(model.unet),
+        "fashion_encoder": model.fashion_encoder,
+        "vae_encoder": VaeEncoderExport(model.vae),
+        "vae_decoder": VaeDecoderExport(model.vae),
+    }
+
+    for name, (input_names, output_name) in ONNX_MODULES.items():
+        os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+        dynamic_axes = {input_name: {0: "batch"} for input_name in input_names if input_name != "timestep"}
+        dynamic_axes[output_name] = {0: "batch"}
+        torch.onnx.export(
+            modules[name],
+            dummy_inputs[name],
+            os.path.join(output_dir, name, "model.onnx"),
+            input_names=input_names,
+            output_names=[output_name],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+        model.logger.info(f"Exported {name} to {os.path.join(output_dir, name, 'model.onnx')}.")
+
+    prompt_input_ids = torch.unique(prompt_input_ids.cpu(), dim=0)
+    embeddings = torch.cat([
+        model.text_encoder(input_ids.to(device))[0].float().cpu() for input_ids in prompt_input_ids.split(64)
+    ])
+    np.savez(
+        os.path.join(output_dir, TEXT_EMBEDDINGS), input_ids=prompt_input_ids.numpy(), embeddings=embeddings.numpy()
+    )
+    model.logger.info(f"Exported the text embeddings of {len(prompt_input_ids)} prompts.")
+
+
+class OnnxBackend:
+    """
+    ONNX Runtime sessions of the modules exported by `export_onnx`, see `DiFashion.set_onnx_backend`. The sessions
+    run in fp32; their outputs are returned as CPU tensors.
+    """
+
+    def __init__(self, onnx_dir, providers=("CPUExecutionProvider",), num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("Please install onnxruntime to use the ONNX backend: `pip install onnxruntime`")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.sessions = {
+            name: ort.InferenceSession(os.path.join(onnx_dir, name, "model.onnx"), options, providers=list(providers))
+            for name in ONNX_MODULES
+        }
+
+        table = np.load(os.path.join(onnx_dir, TEXT_EMBEDDINGS))
+        self.prompt_embeddings = torch.from_numpy(table["embeddings"])
+        self.prompt_index = {tuple(input_ids): i for i, input_ids in enumerate(table["input_ids"].tolist())}
+
+    def run(self, name, *inputs):
+        input_names, _ = ONNX_MODULES[name]
+        feed = {}
+        for input_name, x in zip(input_names, inputs):
+            if input_name == "timestep":
+                x = torch.as_tensor(x).reshape(1)
+            feed[input_name] = x.detach().float().cpu().numpy()
+        return torch.from_numpy(self.sessions[name].run(None, feed)[0])
+
+    def encode_prompts(self, input_ids):
+        rows = []
+        for ids in input_ids.tolist():
+            if tuple(ids) not in self.prompt_index:
+                raise ValueError("A prompt is not in the exported text-embedding table, export it with its prompt.")
+            rows.append(self.prompt_index[tuple(ids)])
+        return self.prompt_embeddings[rows]
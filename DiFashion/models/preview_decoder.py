@@ -0,0 +1,45 @@
+import torch
+import torch.nn as nn
+from diffusers.configuration_utils import ConfigMixin, register_to_config
+from diffusers.models.modeling_utils import ModelMixin
+
+
+class PreviewBlock(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv2d(channels, channels, 3, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(channels, channels, 3, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(channels, channels, 3, padding=1),
+        )
+        self.act = nn.ReLU()
+
+    def forward(self, x):
+        return self.act(self.conv(x) + x)
+
+
+class PreviewDecoder(ModelMixin, ConfigMixin):
+    r"""
+    A lightweight latent-to-image decoder for previews (in the spirit of TAESD), distilled from the VAE decoder with
+    `distill_preview_decoder.py`: plain 3x3 convolutions at `channels` width, `num_blocks` residual blocks per
+    resolution and `num_upsamples` nearest upsamplings (3 for the VAE resolution, 2 for half of it, ...). It takes
+    the scaled latents of the UNet (`vae.encode(x).latent_dist.mode() * scaling_factor`) and returns images on the
+    [-1, 1] scale of `vae.decode`.
+    """
+
+    @register_to_config
+    def __init__(self, latent_channels=4, channels=64, num_blocks=3, num_upsamples=3):
+        super().__init__()
+        layers = [nn.Conv2d(latent_channels, channels, 3, padding=1), nn.ReLU()]
+        for _ in range(num_upsamples):
+            layers += [PreviewBlock(channels) for _ in range(num_blocks)]
+            layers += [nn.Upsample(scale_factor=2), nn.Conv2d(channels, channels, 3, padding=1, bias=False)]
+        layers += [PreviewBlock(channels), nn.Conv2d(channels, 3, 3, padding=1)]
+        self.decoder = nn.Sequential(*layers)
+
+    def forward(self, latents):
+        # soft clamp of the latents, so that out-of-range latents of early or guided samples stay stable
+        latents = torch.tanh(latents / 3) * 3
+        return self.decoder(latents)
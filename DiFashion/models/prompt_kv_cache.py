@@ -0,0 +1,134 @@
+import torch
+import torch.nn.functional as F
+
+
+class PromptKVCache:
+    r"""
+    Keys and values of the UNet cross-attention for the prompts of `fashion_generation`. The prompt embeddings are
+    constant over the denoising loop and shared by many rows of the CFG batch (the same category or null prompt for
+    several items and guidance branches), so every cross-attention layer projects each unique prompt once and the
+    rows gather their keys and values at every step, see `CachedCrossAttnProcessor`.
+
+    Prompts are identified by their token ids. The cache is emptied at every call, unless `persistent`: then the
+    keys and values of a category prompt are computed once across calls, until `clear` (e.g. for new weights).
+    """
+
+    def __init__(self, persistent=False):
+        self.persistent = persistent
+        self.clear()
+
+    def clear(self):
+        # prompt token ids -> row of `embeddings`
+        self.index = {}
+        self.embeddings = None
+        # attention processor name -> keys and values of the first rows of `embeddings`, [P, heads, L, head_dim]
+        self.key_values = {}
+        # row of every sample of the current UNet batch, set by `fashion_generation`
+        self.rows = None
+
+    def start_call(self):
+        if not self.persistent:
+            self.clear()
+        self.rows = None
+
+    def add_prompts(self, input_ids, embeddings):
+        """
+        Rows of the prompts `input_ids` (`[n, L]`, with their `embeddings`), added to the cache if needed.
+        """
+        rows, new_embeddings = [], []
+        for ids, embedding in zip(input_ids.tolist(), embeddings):
+            key = tuple(ids)
+            if key not in self.index:
+                self.index[key] = len(self.index)
+                new_embeddings.append(embedding)
+            rows.append(self.index[key])
+        if new_embeddings:
+            new_embeddings = torch.stack(new_embeddings)
+            self.embeddings = new_embeddings if self.embeddings is None else torch.cat([self.embeddings, new_embeddings])
+        return torch.tensor(rows, dtype=torch.long, device=embeddings.device)
+
+    def key_value(self, name, attn):
+        # the keys and values of all the cached prompts for the attention `name`, projecting the new prompts
+        keys, values = self.key_values.get(name, (None, None))
+        num_projected = 0 if keys is None else keys.shape[0]
+        if num_projected < self.embeddings.shape[0]:
+            new_prompts = self.embeddings[num_projected:]
+
+            def heads(x):
+                return x.view(x.shape[0], -1, attn.heads, x.shape[-1] // attn.heads).transpose(1, 2).contiguous()
+
+            new_keys, new_values = heads(attn.to_k(new_prompts)), heads(attn.to_v(new_prompts))
+            keys = new_keys if keys is None else torch.cat([keys, new_keys])
+            values = new_values if values is None else torch.cat([values, new_values])
+            self.key_values[name] = (keys, values)
+        return keys, values
+
+
+class CachedCrossAttnProcessor:
+    r"""
+    Cross-attention with the keys and values of `PromptKVCache` instead of the projections of
+    `encoder_hidden_states`. Calls without cached rows for the batch (e.g. training, or attention masks) fall back to
+    `processor`, the previous processor of the layer.
+    """
+
+    def __init__(self, name, cache, processor):
+        self.name = name
+        self.cache = cache
+        self.processor = processor
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        rows = self.cache.rows
+        if (
+            encoder_hidden_states is None
+            or rows is None
+            or rows.shape[0] != hidden_states.shape[0]
+            or attention_mask is not None
+            or hidden_states.dim() != 3
+            or getattr(attn, "spatial_norm", None) is not None
+            or getattr(attn, "group_norm", None) is not None
+            or getattr(attn, "norm_cross", None)
+        ):
+            return self.processor(attn, hidden_states, encoder_hidden_states, attention_mask, temb, *args, **kwargs)
+
+        residual = hidden_states
+        batch_size = hidden_states.shape[0]
+        query = attn.to_q(hidden_states)
+        keys, values = self.cache.key_value(self.name, attn)
+        key = keys.index_select(0, rows).to(query.dtype)
+        value = values.index_select(0, rows).to(query.dtype)
+        head_dim = key.shape[-1]
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if hasattr(F, "scaled_dot_product_attention"):
+            hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+        else:
+            attention_probs = (query @ key.transpose(-1, -2) * attn.scale).float().softmax(dim=-1).to(query.dtype)
+            hidden_states = attention_probs @ value
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+
+        # linear proj and dropout
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def set_prompt_kv_processors(unet, cache):
+    """
+    Use `CachedCrossAttnProcessor` for the cross-attention layers (`attn2`) of `unet`, around their current
+    processors.
+    """
+    processors = {}
+    for name, processor in unet.attn_processors.items():
+        if isinstance(processor, CachedCrossAttnProcessor):
+            processor = processor.processor
+        processors[name] = CachedCrossAttnProcessor(name, cache, processor) if "attn2" in name else processor
+    unet.set_attn_processor(processors)
+
+
+def remove_prompt_kv_processors(unet):
+    unet.set_attn_processor({
+        name: processor.processor if isinstance(processor, CachedCrossAttnProcessor) else processor
+        for name, processor in unet.attn_processors.items()
+    })
@@ -0,0 +1,102 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANTIZATION_MODES = ("dynamic", "weight_only")
+
+
+class WeightOnlyInt8Linear(nn.Module):
+    """
+    A linear layer with int8 weights and one scale per output channel (symmetric). On CPU, with the int8 weight GEMM
+    of recent PyTorch (`aten._weight_int8pack_mm`), the int8 weights are used directly. Otherwise the weights are
+    dequantized once per dtype and device and cached, so the layer runs as fast as the float one, but then only its
+    stored weights are 4x smaller, not its memory at run time.
+    """
+
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        self.register_buffer("weight_int8", torch.round(weight / scale).clamp(-127, 127).to(torch.int8))
+        self.register_buffer("weight_scale", scale.to(linear.weight.dtype))
+        self.register_buffer("bias", None if linear.bias is None else linear.bias.detach().clone())
+        # (dtype, device, dequantized weight) of the last call without the int8 kernel
+        self.dequantized = None
+
+    def uses_int8_kernel(self, x):
+        return (
+            x.device.type == "cpu"
+            and x.dtype in (torch.float32, torch.bfloat16, torch.float16)
+            and hasattr(torch.ops.aten, "_weight_int8pack_mm")
+        )
+
+    def forward(self, x, *args, **kwargs):
+        # extra arguments, e.g. the LoRA `scale` of older diffusers, are ignored
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        if self.uses_int8_kernel(x):
+            output = torch.ops.aten._weight_int8pack_mm(
+                x.reshape(-1, self.in_features).contiguous(), self.weight_int8, self.weight_scale.view(-1).to(x.dtype)
+            ).view(*x.shape[:-1], self.out_features)
+            return output if bias is None else output + bias
+
+        if self.dequantized is None or self.dequantized[:2] != (x.dtype, x.device):
+            weight = self.weight_int8.to(x.dtype) * self.weight_scale.to(x.dtype)
+            self.dequantized = (x.dtype, x.device, weight)
+        return F.linear(x, self.dequantized[2], bias)
+
+
+class DynamicInt8Linear(nn.Module):
+    """
+    `torch.ao.nn.quantized.dynamic.Linear`: int8 weights (per output channel) and activations quantized on the fly,
+    with int8 GEMMs (fbgemm/qnnpack). CPU only; computes in fp32, whatever the autocast dtype.
+    """
+
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        float_linear = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        float_linear.weight = nn.Parameter(linear.weight.detach().float().cpu())
+        if linear.bias is not None:
+            float_linear.bias = nn.Parameter(linear.bias.detach().float().cpu())
+        float_linear.qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+        self.linear = torch.ao.nn.quantized.dynamic.Linear.from_float(float_linear)
+
+    def forward(self, x, *args, **kwargs):
+        return self.linear(x.float()).to(x.dtype)
+
+
+def target_linears(module, include=None):
+    """
+    The `nn.Linear` layers of `module` whose qualified names contain one of `include` (all of them for `None`), as
+    `(parent, attribute name, layer)`.
+    """
+    targets = []
+    for parent_name, parent in module.named_modules():
+        for name, child in parent.named_children():
+            qualified_name = f"{parent_name}.{name}" if parent_name else name
+            if isinstance(child, nn.Linear) and (include is None or any(key in qualified_name for key in include)):
+                targets.append((parent, name, child))
+    return targets
+
+
+def quantize_linears(module, mode="dynamic", include=None):
+    """
+    Replace the target linear layers of `module` (see `target_linears`) by their int8 version, in place. Returns the
+    number of replaced layers and the bytes of their weights before and after.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode}, choose from {list(QUANTIZATION_MODES)}.")
+    quantized_class = DynamicInt8Linear if mode == "dynamic" else WeightOnlyInt8Linear
+    targets = target_linears(module, include)
+    float_bytes, int8_bytes = 0, 0
+    for parent, name, linear in targets:
+        float_bytes += linear.weight.numel() * linear.weight.element_size()
+        int8_bytes += linear.weight.numel() + linear.out_features * 4  # int8 weights and per-channel scales
+        quantized = quantized_class(linear)
+        if mode == "weight_only":
+            quantized.to(linear.weight.device)
+        setattr(parent, name, quantized)
+    return len(targets), float_bytes, int8_bytes
@@ -0,0 +1,108 @@
+import torch
+
+
+class LossAwareTimestepSampler:
+    r"""
+    Importance sampler over diffusion timesteps driven by a running per-bucket loss history.
+
+    The `num_train_timesteps` timesteps are split into `num_buckets` contiguous buckets. For every bucket we keep the
+    last `history_per_bucket` training losses and sample a bucket with probability proportional to the root mean
+    squared loss of that bucket, which is the proposal that minimizes the variance of the importance-weighted loss
+    estimator (see "Improved Denoising Diffusion Probabilistic Models", https://arxiv.org/abs/2102.09672, Sec. 3.3).
+    A timestep is then drawn uniformly inside the chosen bucket. The returned weights `1 / (T * p(t))` keep the
+    objective an unbiased estimate of the uniform-timestep objective.
+
+    Until every bucket has a full history, timesteps are sampled uniformly (all weights equal to 1).
+
+    In distributed training, the losses of all the ranks are gathered in `update_with_losses`, so every rank keeps
+    the same history and the state saved by the main process is the state of all the ranks. The sampler exposes
+    `state_dict` / `load_state_dict`, so it can be registered with `accelerator.register_for_checkpointing` and
+    resumed together with the model.
+    """
+
+    def __init__(self, num_train_timesteps, num_buckets=100, history_per_bucket=10, uniform_prob=0.001):
+        if num_buckets < 1 or num_buckets > num_train_timesteps:
+            raise ValueError(
+                f"`num_buckets` should be in [1, {num_train_timesteps}], but is {num_buckets}."
+            )
+        self.num_train_timesteps = num_train_timesteps
+        self.num_buckets = num_buckets
+        self.history_per_bucket = history_per_bucket
+        self.uniform_prob = uniform_prob
+
+        # bucket b covers the timesteps [boundaries[b], boundaries[b + 1])
+        self.boundaries = torch.linspace(0, num_train_timesteps, num_buckets + 1).round().long()
+        self.bucket_sizes = self.boundaries[1:] - self.boundaries[:-1]
+        self.timestep_to_bucket = torch.repeat_interleave(torch.arange(num_buckets), self.bucket_sizes)
+
+        self.loss_history = torch.zeros(num_buckets, history_per_bucket, dtype=torch.float64)
+        self.loss_counts = torch.zeros(num_buckets, dtype=torch.long)
+
+    def warmed_up(self):
+        return bool((self.loss_counts == self.history_per_bucket).all())
+
+    def bucket_probs(self):
+        if not self.warmed_up():
+            return self.bucket_sizes.double() / self.num_train_timesteps
+        probs = torch.sqrt(torch.mean(self.loss_history ** 2, dim=-1))
+        probs = probs / probs.sum()
+        probs = probs * (1 - self.uniform_prob) + self.uniform_prob * self.bucket_sizes.double() / self.num_train_timesteps
+        return probs
+
+    def sample(self, batch_size, device):
+        """
+        Returns `(timesteps, weights)`, both of shape [batch_size], where `weights` are the importance weights to
+        multiply the per-sample losses with.
+        """
+        probs = self.bucket_probs()
+        buckets = torch.multinomial(probs, batch_size, replacement=True)
+        offsets = (torch.rand(batch_size) * self.bucket_sizes[buckets]).long()
+        timesteps = self.boundaries[buckets] + offsets
+
+        # p(t) = p(bucket) / |bucket|  =>  w(t) = 1 / (T * p(t))
+        weights = self.bucket_sizes[buckets].double() / (self.num_train_timesteps * probs[buckets])
+
+        return timesteps.to(device), weights.float().to(device)
+
+    def update_with_losses(self, timesteps, losses):
+        """
+        Record the (unweighted by importance) per-sample losses for the sampled timesteps, of all the ranks (a
+        collective call on all the ranks in distributed training).
+        """
+        timesteps = timesteps.detach().cpu().long().tolist()
+        losses = losses.detach().float().cpu().double().tolist()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            # the batches of the ranks may differ in size, e.g. the last one of an epoch
+            gathered = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(gathered, (timesteps, losses))
+            timesteps = [t for rank_timesteps, _ in gathered for t in rank_timesteps]
+            losses = [loss for _, rank_losses in gathered for loss in rank_losses]
+        buckets = self.timestep_to_bucket[torch.tensor(timesteps, dtype=torch.long)]
+        for bucket, loss in zip(buckets.tolist(), losses):
+            if self.loss_counts[bucket] == self.history_per_bucket:
+                # drop the oldest loss
+                self.loss_history[bucket, :-1] = self.loss_history[bucket, 1:].clone()
+                self.loss_history[bucket, -1] = loss
+            else:
+                self.loss_history[bucket, self.loss_counts[bucket]] = loss
+                self.loss_counts[bucket] += 1
+
+    def state_dict(self):
+        return {
+            "num_train_timesteps": self.num_train_timesteps,
+            "num_buckets": self.num_buckets,
+            "history_per_bucket": self.history_per_bucket,
+            "uniform_prob": self.uniform_prob,
+            "loss_history": self.loss_history,
+            "loss_counts": self.loss_counts,
+        }
+
+    def load_state_dict(self, state_dict):
+        for key in ["num_train_timesteps", "num_buckets", "history_per_bucket"]:
+            if state_dict[key] != getattr(self, key):
+                raise ValueError(
+                    f"Cannot load the timestep sampler state: `{key}` is {state_dict[key]} in the checkpoint but "
+                    f"{getattr(self, key)} in the current run."
+                )
+        self.loss_history = state_dict["loss_history"].clone().double()
+        self.loss_counts = state_dict["loss_counts"].clone().long()
@@ -0,0 +1,76 @@
+import os
+import json
+
+import torch
+from diffusers import AutoencoderKL, PNDMScheduler, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+from .difashion import MutualEncoder
+
+
+def save_tiny_bundle(bundle_dir, args):
+    """
+    A randomly initialized DiFashion in the inference bundle layout, see `DiFashion.export_inference_bundle`.
+    """
+    block_out_channels = tuple(int(c) for c in args.unet_channels.split(","))
+    num_blocks = len(block_out_channels)
+    UNet2DConditionModel(
+        sample_size=args.latent_size,
+        in_channels=8,  # [latents, history_latents]
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=block_out_channels,
+        down_block_types=("CrossAttnDownBlock2D",) * (num_blocks - 1) + ("DownBlock2D",),
+        up_block_types=("UpBlock2D",) + ("CrossAttnUpBlock2D",) * (num_blocks - 1),
+        cross_attention_dim=32,
+        attention_head_dim=4,
+    ).save_pretrained(os.path.join(bundle_dir, "unet"))
+    AutoencoderKL(
+        down_block_types=("DownEncoderBlock2D",) * 2,
+        up_block_types=("UpDecoderBlock2D",) * 2,
+        block_out_channels=(32, 64),
+        latent_channels=4,
+        sample_size=args.latent_size * 2,
+    ).save_pretrained(os.path.join(bundle_dir, "vae"))
+    MutualEncoder(
+        cate_num=args.cate_num, cate_emb_size=8, latent_channels=4, latent_size=args.latent_size, hid_dim=64
+    ).save_pretrained(os.path.join(bundle_dir, "fashion_encoder"))
+
+    text_config = CLIPTextConfig(
+        vocab_size=1000, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4,
+        max_position_embeddings=77, bos_token_id=0, eos_token_id=1, pad_token_id=1,
+    )
+    CLIPTextModel(text_config).save_pretrained(os.path.join(bundle_dir, "text_encoder"))
+
+    # only the special tokens: the prompts of `random_batch` are random token ids
+    os.makedirs(os.path.join(bundle_dir, "tokenizer"), exist_ok=True)
+    vocab_file = os.path.join(bundle_dir, "tokenizer", "vocab.json")
+    merges_file = os.path.join(bundle_dir, "tokenizer", "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump({"<|startoftext|>": 0, "<|endoftext|>": 1}, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    CLIPTokenizer(vocab_file, merges_file, model_max_length=77).save_pretrained(os.path.join(bundle_dir, "tokenizer"))
+
+    PNDMScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", skip_prk_steps=True,
+        set_alpha_to_one=False, steps_offset=1,
+    ).save_pretrained(os.path.join(bundle_dir, "scheduler"))
+
+
+def random_batch(args, image_size, vocab_size):
+    """
+    A random FITB-style batch of `fashion_generation`, whose first `args.num_blanks` items per outfit are generated.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    bsz, olen = args.batch_size, args.outfit_length
+    olists = torch.randint(1, 1000, (bsz, olen), generator=generator)
+    olists[:, :args.num_blanks] = 0  # the generated items
+    return {
+        "uids": torch.arange(bsz),
+        "oids": torch.arange(bsz),
+        "input_ids": torch.randint(2, vocab_size, (bsz, olen, 77), generator=generator),
+        "olists": olists,
+        "outfit_images": torch.rand(bsz * olen, 3, image_size, image_size, generator=generator) * 2 - 1,
+        "category": torch.randint(1, args.cate_num, (bsz, olen), generator=generator),
+    }
@@ -0,0 +1,144 @@
+import math
+
+import torch
+
+
+def do_nothing(x):
+    return x
+
+
+def bipartite_soft_matching_2d(metric, h, w, stride, r, threshold=None):
+    """
+    The merge and unmerge functions of the bipartite soft matching of ToMe on a `h x w` token grid: the first token
+    of every `stride x stride` tile is a destination, every other (source) token is matched to its most similar
+    destination (cosine similarity of `metric`, `[B, N, C]`), and the `r` best matched sources are averaged into
+    their destinations. With `threshold`, only the sources more similar than `threshold` are merged (at most `r`,
+    and as many for all the rows of the batch), so uniform regions such as white backgrounds merge more tokens.
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing, 0
+
+    with torch.no_grad():
+        hs, ws = h // stride, w // stride
+        # -1 for the destinations, 0 for the sources; tokens outside of the full tiles are sources
+        idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+        idx_buffer[:hs * stride:stride, :ws * stride:stride] = -1
+        order = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        num_dst = hs * ws
+        src_order, dst_order = order[:, num_dst:, :], order[:, :num_dst, :]
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=src_order.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=dst_order.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        r = min(a.shape[1], r)
+        if threshold is not None:
+            r = min(r, int((node_max > threshold).sum(dim=-1).min()))
+            if r <= 0:
+                return do_nothing, do_nothing, 0
+
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # unmerged sources
+        src_idx = edge_idx[..., :r, :]  # merged sources
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        n, t, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = unm.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        src_positions = src_order.expand(B, N - num_dst, 1)
+        out.scatter_(dim=-2, index=dst_order.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(src_positions, dim=1, index=unm_idx).expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(src_positions, dim=1, index=src_idx).expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge, r
+
+
+class TokenMerging:
+    r"""
+    Token merging (ToMe) for the self-attention of the UNet transformer blocks, as in "Token Merging for Fast Stable
+    Diffusion", https://arxiv.org/abs/2303.17604: similar tokens are merged before every self-attention and
+    unmerged after it. The cross-attention and the feed-forward layers see all the tokens.
+
+    `ratios[level]` is the fraction of the tokens merged at resolution level `level` (0 for the latent resolution,
+    1 for half of it, ...); levels without a ratio are not merged. The merging is done by forward hooks on the
+    attention modules, so it works with any attention processor (xformers, SDPA, ...) and leaves the weights as they
+    are. `self.num_tokens` and `self.num_merged` count the self-attention tokens and the merged ones.
+    """
+
+    def __init__(self, ratios, stride=2, threshold=None):
+        if any(not 0.0 <= ratio < 1.0 for ratio in ratios):
+            raise ValueError(f"The token merging ratios should be in [0, 1), but are {ratios}.")
+        self.ratios = list(ratios)
+        self.stride = stride
+        self.threshold = threshold
+        self.handles = []
+        self.latent_size = None
+        self.num_tokens = 0
+        self.num_merged = 0
+
+    def apply(self, unet):
+        self.remove()
+
+        def record_latent_size(module, args):
+            self.latent_size = args[0].shape[-2:]
+
+        # `conv_in` also runs on the cached steps of `models.feature_cache`, which skip `unet.forward`
+        self.handles.append(unet.conv_in.register_forward_pre_hook(record_latent_size))
+        for module in unet.modules():
+            # the transformer blocks
+            if not hasattr(module, "attn1"):
+                continue
+            self.handles.append(module.attn1.register_forward_pre_hook(self.merge_hook, with_kwargs=True))
+            self.handles.append(module.attn1.register_forward_hook(self.unmerge_hook))
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def merge_hook(self, module, args, kwargs):
+        hidden_states = args[0] if args else kwargs["hidden_states"]
+        module._tome_unmerge = do_nothing
+        if hidden_states.dim() != 3 or kwargs.get("encoder_hidden_states") is not None:
+            return None
+        height, width = self.latent_size
+        num_tokens = hidden_states.shape[1]
+        downsample = 2 ** round(math.log2(math.sqrt(height * width / num_tokens)))
+        level = int(math.log2(downsample))
+        h, w = math.ceil(height / downsample), math.ceil(width / downsample)
+        if level >= len(self.ratios) or h * w != num_tokens:
+            return None
+
+        merge, unmerge, r = bipartite_soft_matching_2d(
+            hidden_states, h, w, self.stride, int(num_tokens * self.ratios[level]), self.threshold
+        )
+        self.num_tokens += num_tokens
+        self.num_merged += r
+        module._tome_unmerge = unmerge
+        if args:
+            return (merge(hidden_states),) + tuple(args[1:]), kwargs
+        return args, {**kwargs, "hidden_states": merge(hidden_states)}
+
+    def unmerge_hook(self, module, args, output):
+        unmerge = module._tome_unmerge
+        module._tome_unmerge = do_nothing
+        return unmerge(output)
@@ -0,0 +1,434 @@
+"""Script to pre-adapt the DiFashion UNet on streamed LAION image-caption shards before outfit fine-tuning"""
+
+import argparse
+import logging
+import math
+import os
+
+import accelerate
+import datasets
+import torch
+import torch.utils.checkpoint
+from torchvision import transforms
+import transformers
+from accelerate import Accelerator
+from accelerate.logging import get_logger
+from accelerate.utils import ProjectConfiguration, set_seed
+from packaging import version
+from tqdm.auto import tqdm
+
+import diffusers
+from diffusers import UNet2DConditionModel
+from diffusers.optimization import get_scheduler
+from diffusers.training_utils import EMAModel
+from diffusers.utils import check_min_version
+
+import data_utils
+from models.difashion import DiFashion, MutualEncoder
+from models.timestep_sampler import LossAwareTimestepSampler
+
+# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+check_min_version("0.16.0")
+
+logger = get_logger(__name__, log_level="INFO")
+
+def parse_all_args():
+    parser = argparse.ArgumentParser(description="Pre-adapt DiFashion on streamed webdataset shards.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default="stabilityai/stable-diffusion-2-base",
+        required=False,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        required=False,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--non_ema_revision",
+        type=str,
+        default=None,
+        required=False,
+        help="Revision of pretrained non-ema model identifier.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=str,
+        default="../datasets/laion2B-en-aesthetic/data",
+        help="A folder of webdataset `.tar` shards written by img2dataset, or a glob pattern of shards.",
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        type=int,
+        default=1000,
+        help="Number of samples in the shuffle buffer of every dataloader worker.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="/output/path/",
+        help=(
+            "The output directory where the checkpoints will be written. The checkpoints have the same layout as the"
+            " ones of `train.py`, so outfit fine-tuning can resume from them."
+        ),
+    )
+    parser.add_argument("--run_name", type=str, default='', help="Run name")
+    parser.add_argument("--seed", type=int, default=123, help="A seed for reproducible training.")
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument(
+        "--random_flip",
+        default=False,
+        action="store_true",
+        help="whether to randomly flip images horizontally",
+    )
+    parser.add_argument("--use_mutual_guidance", type=bool, default=True)
+    parser.add_argument("--use_history", type=bool, default=True)
+    parser.add_argument(
+        "--cate_conditioning_dropout_prob",
+        type=float,
+        default=0.1,
+        help="Probability of replacing the caption with the null prompt, for classifier-free guidance.",
+    )
+    parser.add_argument("--category_emb_size", type=int, default=64, help="Fashion item category embedding size.")
+    parser.add_argument("--cate_num", type=int, default=50, help="Number of categories of the fashion encoder.")
+    parser.add_argument("--hid_dim", type=int, default=256, help="Fashion encoder hidden dim.")
+    parser.add_argument("--eta", type=float, default=0.1, help="The weight of mutual guidance.")
+    parser.add_argument("--train_batch_size", type=int, default=8, help="Batch size (per device).")
+    parser.add_argument("--num_train_epochs", type=int, default=1, help="Number of passes over all the shards.")
+    parser.add_argument(
+        "--max_train_steps",
+        type=int,
+        default=None,
+        help="Total number of training steps to perform. If provided, stops before the end of `num_train_epochs`.",
+    )
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    parser.add_argument("--gradient_checkpointing", action="store_true")
+    parser.add_argument("--learning_rate", type=float, default=1e-5)
+    parser.add_argument("--lr_scheduler", type=str, default="constant")
+    parser.add_argument("--lr_warmup_steps", type=int, default=500)
+    parser.add_argument("--snr_gamma", type=float, default=None)
+    parser.add_argument("--timestep_sampler", type=str, default="uniform", choices=["uniform", "loss-aware"])
+    parser.add_argument("--timestep_sampler_buckets", type=int, default=100)
+    parser.add_argument("--timestep_sampler_history", type=int, default=10)
+    parser.add_argument("--timestep_sampler_uniform_prob", type=float, default=0.001)
+    parser.add_argument("--use_ema", action="store_true", help="Whether to use EMA model.")
+    parser.add_argument("--use_ema_fashion", action="store_true", help="Whether to use EMA model for fashion encoder.")
+    parser.add_argument("--dataloader_num_workers", type=int, default=4)
+    parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_beta2", type=float, default=0.999, help="The beta2 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_weight_decay", type=float, default=1e-2, help="Weight decay to use.")
+    parser.add_argument("--adam_epsilon", type=float, default=1e-08, help="Epsilon value for the Adam optimizer")
+    parser.add_argument("--max_grad_norm", default=1.0, type=float, help="Max gradient norm.")
+    parser.add_argument("--allow_tf32", action="store_true")
+    parser.add_argument("--logging_dir", type=str, default="./logs")
+    parser.add_argument("--mixed_precision", type=str, default="no", choices=["no", "fp16", "bf16"])
+    parser.add_argument("--report_to", type=str, default="tensorboard")
+    parser.add_argument("--checkpointing_steps", type=int, default=1000)
+    parser.add_argument("--checkpoints_total_limit", type=int, default=None)
+    parser.add_argument(
+        "--resume_from_checkpoint",
+        type=str,
+        default="latest",
+        help=(
+            "Whether training should be resumed from a previous checkpoint, including the position in the shard"
+            ' stream. Use a path saved by `--checkpointing_steps`, or `"latest"`.'
+        ),
+    )
+    parser.add_argument(
+        "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
+    )
+    parser.add_argument("--noise_offset", type=float, default=0, help="The scale of noise offset.")
+
+    args = parser.parse_args()
+    args.output_dir = os.path.join(args.output_dir, args.run_name)
+
+    if args.non_ema_revision is None:
+        args.non_ema_revision = args.revision
+
+    return args
+
+def main():
+    args = parse_all_args()
+
+    accelerator_project_config = ProjectConfiguration(total_limit=args.checkpoints_total_limit, logging_dir=args.logging_dir)
+    accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        mixed_precision=args.mixed_precision,
+        log_with=args.report_to,
+        project_config=accelerator_project_config,
+    )
+    device = accelerator.device
+
+    generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info(accelerator.state, main_process_only=False)
+    if accelerator.is_local_main_process:
+        datasets.utils.logging.set_verbosity_warning()
+        transformers.utils.logging.set_verbosity_warning()
+        diffusers.utils.logging.set_verbosity_info()
+    else:
+        datasets.utils.logging.set_verbosity_error()
+        transformers.utils.logging.set_verbosity_error()
+        diffusers.utils.logging.set_verbosity_error()
+
+    if args.seed is not None:
+        set_seed(args.seed)
+
+    if accelerator.is_main_process:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    logger.info("Build the diffusion model......")
+    diffusion = DiFashion(args, logger, args.cate_num, device)
+    logger.info("Completed.")
+
+    # a pure white image, same as `empty_image.png` of the outfit datasets
+    null_img = torch.ones(3, args.resolution, args.resolution, device=device)
+
+    img_trans = transforms.Compose(
+        [
+            transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
+            transforms.CenterCrop(args.resolution),
+            transforms.RandomHorizontalFlip() if args.random_flip else transforms.Lambda(lambda x: x),
+            transforms.ToTensor()
+        ]
+    )
+    train_dataset = data_utils.LaionShardDataset(
+        args.shards,
+        diffusion.tokenizer,
+        img_trans,
+        rank=accelerator.process_index,
+        world_size=accelerator.num_processes,
+        seed=args.seed,
+        shuffle_buffer=args.shuffle_buffer,
+        num_workers=args.dataloader_num_workers,
+    )
+    # the dataset splits the shards across ranks itself, so the dataloader is not prepared by the accelerator (see the
+    # end of the epoch in the training loop)
+    train_dataloader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_size=args.train_batch_size,
+        num_workers=args.dataloader_num_workers,
+    )
+    logger.info(f"Streaming {len(train_dataset.shards)} shards from {args.shards}.")
+
+    if args.use_ema:
+        ema_unet = EMAModel(diffusion.unet.parameters(), model_cls=UNet2DConditionModel, model_config=diffusion.unet.config)
+    if args.use_ema_fashion:
+        ema_encoder = EMAModel(diffusion.fashion_encoder.parameters(), model_cls=MutualEncoder, model_config=diffusion.fashion_encoder.config)
+
+    if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
+        # same checkpoint layout as train.py
+        def save_model_hook(models, weights, output_dir):
+            # `save_state` runs on all the ranks (for their stream positions and RNG states), the weights are only
+            # written by the main process
+            if args.use_ema and accelerator.is_main_process:
+                ema_unet.save_pretrained(os.path.join(output_dir, "unet_ema"))
+            if args.use_ema_fashion and accelerator.is_main_process:
+                ema_encoder.save_pretrained(os.path.join(output_dir, "fashion_encoder_ema"))
+
+            for i, model in enumerate(models):
+                if accelerator.is_main_process:
+                    model.fashion_encoder.save_pretrained(os.path.join(output_dir, "fashion_encoder"))
+                    model.unet.save_pretrained(os.path.join(output_dir, "unet"))
+
+                # make sure to pop weight so that corresponding model is not saved again
+                weights.pop()
+
+        def load_model_hook(models, input_dir):
+            if args.use_ema:
+                load_model = EMAModel.from_pretrained(os.path.join(input_dir, "unet_ema"), UNet2DConditionModel)
+                ema_unet.load_state_dict(load_model.state_dict())
+                ema_unet.to(device)
+                del load_model
+
+            if args.use_ema_fashion:
+                load_model = EMAModel.from_pretrained(os.path.join(input_dir, "fashion_encoder_ema"), MutualEncoder)
+                ema_encoder.load_state_dict(load_model.state_dict())
+                ema_encoder.to(device)
+                del load_model
+
+            for i in range(len(models)):
+                # pop models so that they are not loaded again
+                model = models.pop()
+                load_model = UNet2DConditionModel.from_pretrained(input_dir, subfolder="unet")
+                model.unet.register_to_config(**load_model.config)
+                model.unet.load_state_dict(load_model.state_dict())
+                del load_model
+
+                load_model = MutualEncoder.from_pretrained(input_dir, subfolder="fashion_encoder")
+                model.fashion_encoder.register_to_config(**load_model.config)
+                model.fashion_encoder.load_state_dict(load_model.state_dict())
+                del load_model
+
+        accelerator.register_save_state_pre_hook(save_model_hook)
+        accelerator.register_load_state_pre_hook(load_model_hook)
+
+    # the stream positions of all the ranks are saved and restored together with the model
+    accelerator.register_for_checkpointing(train_dataset)
+
+    timestep_sampler = None
+    if args.timestep_sampler == "loss-aware":
+        timestep_sampler = LossAwareTimestepSampler(
+            diffusion.noise_scheduler.config.num_train_timesteps,
+            num_buckets=args.timestep_sampler_buckets,
+            history_per_bucket=args.timestep_sampler_history,
+            uniform_prob=args.timestep_sampler_uniform_prob,
+        )
+        accelerator.register_for_checkpointing(timestep_sampler)
+
+    if args.gradient_checkpointing:
+        diffusion.unet.enable_gradient_checkpointing()
+
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    # the fashion encoder gets no outfit context here, freeze it so that DDP does not expect gradients for it
+    diffusion.fashion_encoder.requires_grad_(False)
+
+    # same parameter list as train.py, so that the optimizer state can be resumed by the outfit fine-tuning
+    train_params = list(diffusion.unet.parameters()) + list(diffusion.fashion_encoder.parameters())
+    optimizer = torch.optim.AdamW(
+        train_params,
+        lr=args.learning_rate,
+        betas=(args.adam_beta1, args.adam_beta2),
+        weight_decay=args.adam_weight_decay,
+        eps=args.adam_epsilon,
+    )
+
+    # the length of the stream is unknown, the lr schedule is defined over `max_train_steps`
+    if args.max_train_steps is None:
+        args.max_train_steps = math.inf
+    lr_scheduler = get_scheduler(
+        args.lr_scheduler,
+        optimizer=optimizer,
+        num_warmup_steps=args.lr_warmup_steps * args.gradient_accumulation_steps,
+        num_training_steps=None if math.isinf(args.max_train_steps) else args.max_train_steps * args.gradient_accumulation_steps,
+    )
+
+    diffusion, optimizer, lr_scheduler = accelerator.prepare(diffusion, optimizer, lr_scheduler)
+
+    if args.use_ema:
+        ema_unet.to(device)
+    if args.use_ema_fashion:
+        ema_encoder.to(device)
+
+    if accelerator.is_main_process:
+        tracker_config = {k: v for k, v in vars(args).items() if not (isinstance(v, float) and math.isinf(v))}
+        accelerator.init_trackers("difashion-pretrain", config=tracker_config)
+
+    global_step = 0
+    if args.resume_from_checkpoint:
+        if args.resume_from_checkpoint != "latest":
+            path = os.path.basename(args.resume_from_checkpoint)
+        else:
+            dirs = os.listdir(args.output_dir)
+            dirs = [d for d in dirs if d.startswith("checkpoint")]
+            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
+            path = dirs[-1] if len(dirs) > 0 else None
+
+        if path is None:
+            accelerator.print(
+                f"Checkpoint '{args.resume_from_checkpoint}' does not exist. Starting a new training run."
+            )
+        else:
+            accelerator.print(f"Resuming from checkpoint {path}")
+            accelerator.load_state(os.path.join(args.output_dir, path))
+            global_step = int(path.split("-")[1])
+            logger.info(
+                f"Resuming the shard stream at epoch {train_dataset.epoch}, shard {train_dataset.start_shard_pos},"
+                f" offset {train_dataset.start_offset}",
+                main_process_only=False,
+            )
+
+    logger.info("***** Running pre-adaptation *****")
+    logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
+    logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
+    logger.info(f"  Total optimization steps = {args.max_train_steps}")
+
+    progress_bar = tqdm(
+        initial=global_step,
+        total=None if math.isinf(args.max_train_steps) else args.max_train_steps,
+        disable=not accelerator.is_local_main_process,
+    )
+    progress_bar.set_description("Steps")
+
+    first_epoch = train_dataset.epoch
+    for epoch in range(first_epoch, args.num_train_epochs):
+        if epoch != first_epoch:
+            train_dataset.set_position(epoch)
+        diffusion.train()
+        train_loss = 0.0
+
+        # the ranks stream different shards of different lengths: all of them stop at the end of the shortest stream,
+        # otherwise the ranks that still have batches wait forever in the next collective
+        batches = iter(train_dataloader)
+        while True:
+            batch = next(batches, None)
+            exhausted = torch.tensor([batch is None], device=device)
+            if accelerator.gather(exhausted).any():
+                break
+            with accelerator.accumulate(diffusion):
+                loss = diffusion(batch, None, None, null_img, None, None, args.cate_conditioning_dropout_prob, weight_dtype, generator,
+                                 timestep_sampler=timestep_sampler)
+
+                avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
+                train_loss += avg_loss.item() / args.gradient_accumulation_steps
+
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(diffusion.parameters(), args.max_grad_norm)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad()
+
+            train_dataset.update_position(batch)
+
+            if accelerator.sync_gradients:
+                if args.use_ema:
+                    ema_unet.step(accelerator.unwrap_model(diffusion).unet.parameters())
+                if args.use_ema_fashion:
+                    ema_encoder.step(accelerator.unwrap_model(diffusion).fashion_encoder.parameters())
+
+                progress_bar.update(1)
+                global_step += 1
+                accelerator.log({"train_loss": train_loss}, step=global_step)
+                train_loss = 0.0
+
+                if global_step % args.checkpointing_steps == 0:
+                    # on all the ranks, see `LaionShardDataset.state_dict`
+                    save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                    accelerator.save_state(save_path)
+                    logger.info(f"Saved state to {save_path}")
+
+            logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
+            progress_bar.set_postfix(**logs)
+
+            if global_step >= args.max_train_steps:
+                break
+
+        if global_step >= args.max_train_steps:
+            break
+
+    accelerator.wait_for_everyone()
+    save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+    accelerator.save_state(save_path)
+    logger.info(f"Saved state to {save_path}")
+    accelerator.end_training()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Unit tests of the loss-aware timestep sampler of `train.py --timestep_sampler loss-aware`.
+
+    cd DiFashion && python -m unittest test_timestep_sampler.py
+"""
+import unittest
+
+import torch
+
+from models.timestep_sampler import LossAwareTimestepSampler
+
+
+def warmed_up_sampler(bucket_losses, uniform_prob=0.0, num_train_timesteps=1000, history_per_bucket=4):
+    # every bucket gets a full history of its constant loss
+    sampler = LossAwareTimestepSampler(
+        num_train_timesteps, num_buckets=len(bucket_losses), history_per_bucket=history_per_bucket,
+        uniform_prob=uniform_prob,
+    )
+    for _ in range(history_per_bucket):
+        sampler.update_with_losses(sampler.boundaries[:-1], torch.tensor(bucket_losses))
+    return sampler
+
+
+class LossAwareTimestepSamplerTest(unittest.TestCase):
+    def test_uniform_during_warm_up(self):
+        sampler = LossAwareTimestepSampler(1000, num_buckets=10, history_per_bucket=4)
+        sampler.update_with_losses(torch.tensor([0, 150]), torch.tensor([1.0, 2.0]))
+        self.assertFalse(sampler.warmed_up())
+        _, weights = sampler.sample(64, "cpu")
+        self.assertTrue(torch.allclose(weights, torch.ones(64)))
+
+    def test_bucket_probs_proportional_to_rms_loss(self):
+        sampler = LossAwareTimestepSampler(1000, num_buckets=4, history_per_bucket=2, uniform_prob=0.0)
+        # bucket b gets the losses [b + 1, 2 * (b + 1)], whose RMS is sqrt(2.5) * (b + 1)
+        for scale in [1.0, 2.0]:
+            sampler.update_with_losses(sampler.boundaries[:-1], scale * torch.arange(1.0, 5.0))
+        self.assertTrue(sampler.warmed_up())
+        expected = torch.arange(1.0, 5.0, dtype=torch.float64) / 10
+        self.assertTrue(torch.allclose(sampler.bucket_probs(), expected))
+
+    def test_importance_weights_have_unit_mean(self):
+        torch.manual_seed(0)
+        sampler = warmed_up_sampler([1.0, 2.0, 3.0, 4.0, 5.0], uniform_prob=0.01)
+        probs = sampler.bucket_probs()
+        timesteps, weights = sampler.sample(4096, "cpu")
+
+        # w(t) = 1 / (T * p(t)) per bucket, so E_p[w] = sum_b p(b) * |b| / (T * p(b)) = 1 exactly
+        buckets = sampler.timestep_to_bucket[timesteps]
+        bucket_weights = torch.zeros(sampler.num_buckets, dtype=torch.float64)
+        bucket_weights[buckets] = weights.double()
+        expected = sampler.bucket_sizes.double() / (sampler.num_train_timesteps * probs)
+        self.assertTrue(torch.allclose(bucket_weights, expected, rtol=1e-5))
+        self.assertAlmostEqual((probs * expected).sum().item(), 1.0, places=6)
+
+        # and the Monte Carlo estimate
+        _, weights = sampler.sample(200000, "cpu")
+        self.assertAlmostEqual(weights.double().mean().item(), 1.0, delta=0.02)
+
+    def test_state_dict_round_trip(self):
+        sampler = warmed_up_sampler([1.0, 3.0, 2.0])
+        sampler.update_with_losses(torch.tensor([999]), torch.tensor([7.0]))
+
+        resumed = LossAwareTimestepSampler(1000, num_buckets=3, history_per_bucket=4, uniform_prob=0.0)
+        resumed.load_state_dict(sampler.state_dict())
+        self.assertTrue(torch.equal(resumed.loss_history, sampler.loss_history))
+        self.assertTrue(torch.equal(resumed.loss_counts, sampler.loss_counts))
+        self.assertTrue(torch.allclose(resumed.bucket_probs(), sampler.bucket_probs()))
+
+        other = LossAwareTimestepSampler(1000, num_buckets=5, history_per_bucket=4)
+        with self.assertRaises(ValueError):
+            other.load_state_dict(sampler.state_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,6 +16,7 @@ import torch.utils.checkpoint
 from torchvision import transforms
 import transformers
 from accelerate import Accelerator
+from accelerate.checkpointing import load_custom_state
 from accelerate.logging import get_logger
 from accelerate.utils import ProjectConfiguration, set_seed
 from packaging import version
@@ -30,6 +31,7 @@ from diffusers.utils.import_utils import is_xformers_available
 
 import data_utils
 from models.difashion import DiFashion, MutualEncoder
+from models.timestep_sampler import LossAwareTimestepSampler
 
 # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
 check_min_version("0.16.0")
@@ -230,6 +232,35 @@ def parse_all_args():
         help="SNR weighting gamma to be used if rebalancing the loss. Recommended value is 5.0. "
         "More details here: https://arxiv.org/abs/2303.09556.",
     )
+    parser.add_argument(
+        "--timestep_sampler",
+        type=str,
+        default="uniform",
+        choices=["uniform", "loss-aware"],
+        help=(
+            "How to sample the diffusion timesteps during training. `loss-aware` keeps a running loss history per"
+            " timestep bucket, samples timesteps in proportion to the RMS loss of their bucket and reweights the"
+            " loss so that the objective stays unbiased. The losses of all the processes are gathered into one history."
+        ),
+    )
+    parser.add_argument(
+        "--timestep_sampler_buckets",
+        type=int,
+        default=100,
+        help="Number of timestep buckets used by the loss-aware timestep sampler.",
+    )
+    parser.add_argument(
+        "--timestep_sampler_history",
+        type=int,
+        default=10,
+        help="Number of recent losses kept per timestep bucket by the loss-aware timestep sampler.",
+    )
+    parser.add_argument(
+        "--timestep_sampler_uniform_prob",
+        type=float,
+        default=0.001,
+        help="Probability mass mixed uniformly into the loss-aware timestep distribution.",
+    )
     parser.add_argument(
         "--use_8bit_adam", action="store_true", help="Whether or not to use 8-bit Adam from bitsandbytes."
     )
@@ -556,6 +587,15 @@ def main():
         accelerator.register_save_state_pre_hook(save_model_hook)
         accelerator.register_load_state_pre_hook(load_model_hook)
 
+    timestep_sampler = None
+    if args.timestep_sampler == "loss-aware":
+        timestep_sampler = LossAwareTimestepSampler(
+            diffusion.noise_scheduler.config.num_train_timesteps,
+            num_buckets=args.timestep_sampler_buckets,
+            history_per_bucket=args.timestep_sampler_history,
+            uniform_prob=args.timestep_sampler_uniform_prob,
+        )
+
     if args.gradient_checkpointing:
         diffusion.unet.enable_gradient_checkpointing()
 
@@ -663,12 +703,24 @@ def main():
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
             accelerator.load_state(os.path.join(args.output_dir, path))
+            if timestep_sampler is not None:
+                # the only custom checkpoint object of `save_state`, see below
+                sampler_state = os.path.join(args.output_dir, path, "custom_checkpoint_0.pkl")
+                if os.path.exists(sampler_state):
+                    load_custom_state(timestep_sampler, os.path.join(args.output_dir, path), 0)
+                else:
+                    logger.info(f"{path} has no timestep sampler state, the loss-aware sampler starts with its warm-up.")
             global_step = int(path.split("-")[1])
 
             resume_global_step = global_step * args.gradient_accumulation_steps
             first_epoch = global_step // num_update_steps_per_epoch
             resume_step = resume_global_step % (num_update_steps_per_epoch * args.gradient_accumulation_steps)
         
+    if timestep_sampler is not None:
+        # the loss history is saved together with the model in `accelerator.save_state`; registered after the resume,
+        # so that the checkpoints from before `--timestep_sampler loss-aware` can be loaded
+        accelerator.register_for_checkpointing(timestep_sampler)
+
     # Only show the progress bar once on each machine.
     progress_bar = tqdm(range(global_step, args.max_train_steps), disable=not accelerator.is_local_main_process)
     progress_bar.set_description("Steps")
@@ -689,7 +741,8 @@ def main():
             cate_mask_ratio = args.cate_conditioning_dropout_prob
 
             with accelerator.accumulate(diffusion):
-                loss = diffusion(batch, img_dataset, train_hist_latents, null_img, mask_ratio, coupling_mask_ratio, cate_mask_ratio, weight_dtype, generator)
+                loss = diffusion(batch, img_dataset, train_hist_latents, null_img, mask_ratio, coupling_mask_ratio, cate_mask_ratio, weight_dtype, generator,
+                                 timestep_sampler=timestep_sampler)
 
                 # Gather the losses across all processes for logging (if we use distributed training).
                 avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
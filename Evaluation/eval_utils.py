@@ -1,4 +1,5 @@
 import os
+import sys
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -14,6 +15,10 @@ import open_clip
 
 from compatibility_evaluator.compatibility_net import FashionEvaluator
 
+# the per-item view of the deduplicated feature banks is shared with the DiFashion code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DiFashion"))
+import data_utils
+
 class InceptionV3(nn.Module):
     def __init__(self, model_path, num_classes):
         super(InceptionV3, self).__init__()
@@ -88,6 +93,10 @@ class InceptionV3(nn.Module):
         # N x 2048
         return x
 
+def load_cnn_features(cnn_feat_path):
+    # the features of the unique images (`*_unique.npy`) are used if the catalog was deduplicated
+    return data_utils.load_item_features(cnn_feat_path)
+
 class CLIPScore:
     def __init__(self, device='cuda' if torch.cuda.is_available() else 'cpu'):
         self.model, _, _ = open_clip.create_model_and_transforms('ViT-H-14', pretrained="laion2b-s32b-b79K")
@@ -593,12 +602,8 @@ def evaluate_compatibility_given_data(outfits, grd_outfits, gen4eval, cnn_feat_p
     # gen4eval: generated images
     model = CompatibilityEvaluator(ckpt_path, device)
 
-    if not os.path.exists(cnn_feat_path):
-        raise ValueError(f"Cnn features does not exist in {cnn_feat_path}!")
-    else:
-        cnn_feats = np.load(cnn_feat_path, allow_pickle=True)  # [img_num, 1024]
-        cnn_feats = torch.tensor(cnn_feats).to(device)
-        print(f"Successfully load cnn features of fashion images from {cnn_feat_path}")
+    cnn_feats = load_cnn_features(cnn_feat_path).to(device)  # [img_num, 1024]
+    print(f"Successfully load cnn features of fashion images from {cnn_feat_path}")
     
     if gen4eval is None:
         cnn_feats_gen = None
@@ -160,8 +160,7 @@ def main():
 
     id_cate_dict = np.load(os.path.join(args.data_path, "new_id_cate_dict.npy"), allow_pickle=True).item()
     cid_to_label = np.load('./finetuned_inception/cid_to_label.npy', allow_pickle=True).item() # map cid to inception predicted label
-    cnn_features_clip = np.load(os.path.join(args.data_path, "cnn_features_clip.npy"), allow_pickle=True)
-    cnn_features_clip = torch.tensor(cnn_features_clip)
+    cnn_features_clip = eval_utils.load_cnn_features(os.path.join(args.data_path, "cnn_features_clip.npy"))
 
     all_image_paths = np.load(os.path.join(args.data_path, "all_item_image_paths.npy"), allow_pickle=True)
     img_folder_path = "/data/path/xxx"
@@ -15,6 +15,8 @@ from sklearn.metrics import roc_auc_score
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 
+import eval_utils
+
 try:
     from tqdm import tqdm
 except ImportError:
@@ -132,17 +134,25 @@ def main():
     img_paths = np.load(os.path.join(args.data_path, "all_item_image_paths.npy"), allow_pickle=True)
     max_iid = len(img_paths)
 
-    # extract clip embeddings of all images
+    # extract clip embeddings of all images, or only of the unique images if the catalog was deduplicated
+    # with datasets/dedup_catalog.py
     cnn_feat_path = os.path.join(args.data_path, "cnn_features_clip.npy")
-    if not os.path.exists(cnn_feat_path):
+    dedup_path = os.path.join(args.data_path, "item_to_unique.npy")
+    if os.path.exists(dedup_path):
+        unique_item_ids = np.load(os.path.join(args.data_path, "unique_item_ids.npy"))
+        unique_feat_path = os.path.join(args.data_path, "cnn_features_clip_unique.npy")
+        if not os.path.exists(unique_feat_path):
+            print(f"Extract cnn features of {len(unique_item_ids)} unique fashion images out of {max_iid}...")
+            unique_feats = extract_cnn_features(args, img_paths[unique_item_ids], device, num_workers)
+            np.save(unique_feat_path, unique_feats)
+            print(f"Successfully save cnn features of unique fashion images to {unique_feat_path}!")
+    elif not os.path.exists(cnn_feat_path):
         print("Extract cnn features of fashion images...")
         cnn_feats = extract_cnn_features(args, img_paths, device, num_workers)
         np.save(cnn_feat_path, cnn_feats)
         print(f"Successfully save cnn features of fashion images to {cnn_feat_path}!")
-    else:
-        cnn_feats = np.load(cnn_feat_path, allow_pickle=True)  # [img_num, 2048]
-        print(f"Successfully load cnn features of fashion images from {cnn_feat_path}")
-    cnn_feats = torch.tensor(cnn_feats)
+    cnn_feats = eval_utils.load_cnn_features(cnn_feat_path)
+    print(f"Successfully load cnn features of fashion images from {args.data_path}")
     print(f"cnn features shape: {cnn_feats.shape}")
 
     train_history = np.load(os.path.join(data_path, "train_history.npy"), allow_pickle=True).item()
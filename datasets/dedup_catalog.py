@@ -0,0 +1,164 @@
+import os
+import hashlib
+import argparse
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+def hash_image(job):
+    """
+    Returns `(iid, sha256 of the decoded RGB pixels, 64-bit difference hash)`. Hashing the decoded pixels (instead
+    of the file bytes) also catches identical images saved with a different encoding or metadata.
+    """
+    iid, path, use_phash = job
+    try:
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            content = hashlib.sha256(str(image.size).encode() + image.tobytes()).hexdigest()
+            phash = dhash(image) if use_phash else None
+        return iid, content, phash
+    except Exception as e:
+        print(f"{path}: {e}")
+        return iid, None, None
+
+def dhash(image, hash_size=8):
+    # difference hash: sign of the horizontal gradients of a (hash_size+1) x hash_size grayscale thumbnail
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # the smallest item id represents the group
+            self.parent[max(x, y)] = min(x, y)
+
+# number of set bits of every byte value, for the Hamming distances of uint64 hashes
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hamming(h, others):
+    # Hamming distances between the hash `h` and the array of hashes `others` (uint64)
+    return POPCOUNT[(others ^ h).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def near_duplicate_pairs(phashes, threshold, hash_bits=64):
+    """
+    Candidate pairs within `threshold` Hamming distance. By the pigeonhole principle, two hashes within distance
+    `threshold` agree on at least one of `threshold + 1` disjoint bands, so only hashes sharing a band are compared.
+
+    Bands that are all zeros or all ones are not used as bucket keys: they are flat image regions, e.g. the white
+    padding above and below every wide item, which would put most of the catalog into one bucket. Two images that
+    agree only on flat bands are missed.
+    """
+    num_bands = threshold + 1
+    band_bits = hash_bits // num_bands
+    iids = np.array([iid for iid, h in phashes.items() if h is not None], dtype=np.int64)
+    hashes = np.array([h for h in phashes.values() if h is not None], dtype=np.uint64)
+    for band in range(num_bands):
+        shift = band * band_bits
+        bits = band_bits if band < num_bands - 1 else hash_bits - shift
+        mask = np.uint64((1 << bits) - 1)
+        keys = (hashes >> np.uint64(shift)) & mask
+        informative = np.nonzero((keys != 0) & (keys != mask))[0]
+        order = informative[np.argsort(keys[informative], kind="stable")]
+        # the buckets are the runs of equal keys in `order`
+        starts = np.flatnonzero(np.diff(keys[order], prepend=mask, append=mask) != 0)
+        for first, last in zip(starts[:-1], starts[1:]):
+            bucket = order[first:last]
+            for i in range(len(bucket) - 1):
+                close = np.nonzero(hamming(hashes[bucket[i]], hashes[bucket[i + 1:]]) <= threshold)[0]
+                for j in close:
+                    yield int(iids[bucket[i]]), int(iids[bucket[i + 1 + j]])
+
+def merge_near_duplicates(groups, phashes, pairs, threshold):
+    """
+    Merge the groups of the near-duplicate `pairs`, but only if every item of the merged group stays within
+    `threshold` of its representative (the smallest item id): near duplicates do not chain, so A ~ B ~ C does not put
+    A and C in one group if they are further apart.
+    """
+    members = defaultdict(list)
+    for iid in phashes:
+        members[groups.find(iid)].append(iid)
+
+    for x, y in pairs:
+        x, y = groups.find(x), groups.find(y)
+        if x == y:
+            continue
+        representative = min(x, y)
+        merged = members[x] + members[y]
+        hashes = np.array([phashes[iid] for iid in merged], dtype=np.uint64)
+        if (hamming(np.uint64(phashes[representative]), hashes) <= threshold).all():
+            groups.union(x, y)
+            members[representative] = merged
+            del members[max(x, y)]
+
+def dedup_catalog(data_path, img_folder_path, phash_threshold=None, num_workers=None):
+    all_image_paths = np.load(os.path.join(data_path, "all_item_image_paths.npy"), allow_pickle=True)
+    num_items = len(all_image_paths)
+    use_phash = phash_threshold is not None
+
+    jobs = [(iid, os.path.join(img_folder_path, path), use_phash) for iid, path in enumerate(all_image_paths)]
+    contents, phashes = {}, {}
+    with Pool(num_workers) as pool:
+        for iid, content, phash in tqdm(pool.imap_unordered(hash_image, jobs, chunksize=64), total=num_items):
+            contents[iid] = content
+            phashes[iid] = phash
+
+    groups = UnionFind(num_items)
+    first_by_content = {}
+    for iid in range(num_items):
+        content = contents[iid]
+        if content is None:
+            # unreadable images are kept as their own unique image
+            continue
+        if content in first_by_content:
+            groups.union(first_by_content[content], iid)
+        else:
+            first_by_content[content] = iid
+    num_exact = num_items - len({groups.find(iid) for iid in range(num_items)})
+
+    if use_phash:
+        readable = {iid: phash for iid, phash in phashes.items() if phash is not None}
+        merge_near_duplicates(groups, readable, near_duplicate_pairs(readable, phash_threshold), phash_threshold)
+
+    representatives = np.array([groups.find(iid) for iid in range(num_items)], dtype=np.int64)
+    unique_item_ids = np.unique(representatives)
+    item_to_unique = np.searchsorted(unique_item_ids, representatives).astype(np.int64)
+
+    np.save(os.path.join(data_path, "item_to_unique.npy"), item_to_unique)
+    np.save(os.path.join(data_path, "unique_item_ids.npy"), unique_item_ids)
+
+    print(f"{num_items} items, {len(unique_item_ids)} unique images "
+          f"({num_exact} exact duplicates, {num_items - len(unique_item_ids) - num_exact} near duplicates).")
+    print(f"Saved item_to_unique.npy and unique_item_ids.npy to {data_path}.")
+
+    return item_to_unique, unique_item_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Find duplicated catalog images, so that only the unique images are encoded into the latent and feature banks'
+    )
+    parser.add_argument('--data_path', type=str, required=True, help='Dataset folder with all_item_image_paths.npy')
+    parser.add_argument('--img_folder_path', type=str, required=True, help='Folder of the item images')
+    parser.add_argument('--phash_threshold', type=int, default=None,
+                        help='Also merge near-identical images whose 64-bit difference hashes are within this Hamming distance '
+                             'of the representative image of their group')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of processes, defaults to all cores')
+
+    args = parser.parse_args()
+
+    dedup_catalog(args.data_path, args.img_folder_path, args.phash_threshold, args.num_workers)
@@ -1,75 +1,255 @@
 import os
+import json
+import shutil
 import subprocess
 import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from huggingface_hub import login, hf_hub_download
-import time
-
-
-def download_and_process(num_files, hf_token, processes_count=16, thread_count=64):
-    # 启用 Hugging Face 的进度条
-    os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
-
-    # 登录到 Hugging Face
-    login(hf_token)
-
-    for i in range(num_files):
-        # 下载parquet文件
-        filename = f"part-{str(i).zfill(5)}-cad4a140-cebd-46fa-b874-e8968f93e32e-c000.snappy.parquet"
-
-        try:
-            if not os.path.exists(f"laion2B-en-aesthetic/{filename}"):
-                filename = hf_hub_download(
-                    repo_id="laion/laion2B-en-aesthetic",
-                    filename=filename,
-                    repo_type="dataset",
-                    local_dir="",
-                    force_download=True,
-                    resume_download=True,
-                )
-                time.sleep(1)
-                print(f"\nDownloading {filename}...")
-            else:
-                print(f"\n{filename} Existed...")
-
-            # 处理下载的文件
-            print(f"\nProcessing {filename}...")
-            cmd = [
-                "img2dataset",
-                "--url_list", f"laion2B-en-aesthetic/{filename}",
-                "--input_format", "parquet",
-                "--url_col", "URL",
-                "--caption_col", "TEXT",
-                "--output_format", "webdataset",
-                "--output_folder", f"laion2B-en-aesthetic/data",
-                "--processes_count", str(processes_count),
-                "--thread_count", str(thread_count),
-                "--image_size", "512",
-                "--resize_only_if_bigger", "True",
-                "--resize_mode", "keep_ratio",
-                "--skip_reencode", "True",
-                "--save_additional_columns", '["similarity","hash","punsafe","pwatermark","aesthetic"]',
-                # "--enable_wandb", "True"
-            ]
-
-            subprocess.run(cmd, check=True)
-
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            continue
+import pyarrow.parquet as pq
+
+
+PART_TEMPLATE = "part-{}-cad4a140-cebd-46fa-b874-e8968f93e32e-c000.snappy.parquet"
+COLUMNS = ["URL", "TEXT", "WIDTH", "HEIGHT", "similarity", "hash", "punsafe", "pwatermark", "aesthetic"]
+FILTERS_KEY = b"difashion_filters"
+
+
+class Manifest:
+    """
+    Records which parquet parts are done and which output shards each part produced, so that reruns skip
+    finished work. Shards of all the parts share one global numbering in `data/`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {"next_shard": 0, "parts": {}}
+
+    def is_done(self, part, filters=None):
+        # a part filtered with other settings is not done: its shards have to be rebuilt
+        entry = self.state["parts"].get(part, {})
+        return entry.get("status") == "done" and entry.get("filters") == filters
+
+    def shards(self, part):
+        return self.state["parts"].get(part, {}).get("shards")
+
+    def next_shard(self):
+        return self.state["next_shard"]
+
+    def mark_done(self, part, first_shard, num_shards, num_urls, filters=None):
+        self.state["parts"][part] = {
+            "status": "done",
+            "shards": [first_shard, first_shard + num_shards],  # [start, end)
+            "num_urls": num_urls,
+            "filters": filters,
+        }
+        self.state["next_shard"] = first_shard + num_shards
+        self.save()
+
+    def save(self):
+        # write-then-rename, so that an interrupted run never leaves a truncated manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def fetch_part(filename, root, source_url=None):
+    """
+    Download one parquet part, from the Hugging Face Hub or from `source_url` (any HTTP file server, e.g.
+    `python -m http.server` over a local mirror). Existing files are not downloaded again.
+    """
+    local_path = os.path.join(root, filename)
+    if os.path.exists(local_path):
+        print(f"\n{filename} Existed...")
+        return local_path
+
+    print(f"\nDownloading {filename}...")
+    if source_url is None:
+        return hf_hub_download(
+            repo_id="laion/laion2B-en-aesthetic",
+            filename=filename,
+            repo_type="dataset",
+            local_dir=root,
+        )
+
+    tmp_path = local_path + ".incomplete"
+    with urllib.request.urlopen(f"{source_url.rstrip('/')}/{filename}") as response, open(tmp_path, "wb") as f:
+        shutil.copyfileobj(response, f)
+    os.replace(tmp_path, local_path)
+    return local_path
+
+
+def filter_settings(min_aesthetic=None, max_punsafe=None):
+    return {"min_aesthetic": min_aesthetic, "max_punsafe": max_punsafe}
+
+
+def filter_part(parquet_path, filtered_path, min_aesthetic=None, max_punsafe=None):
+    """
+    Push the metadata filters down to the parquet read, so that img2dataset only fetches the kept URLs. The
+    filter settings are stored in the metadata of the filtered file, which is reused only if they match.
+    """
+    settings = json.dumps(filter_settings(min_aesthetic, max_punsafe), sort_keys=True).encode()
+    if os.path.exists(filtered_path):
+        filtered = pq.ParquetFile(filtered_path)
+        if (filtered.schema_arrow.metadata or {}).get(FILTERS_KEY) == settings:
+            return filtered.metadata.num_rows
+        print(f"\n{os.path.basename(filtered_path)} was filtered with other settings, filtering again...")
+
+    filters = []
+    if min_aesthetic is not None:
+        filters.append(("aesthetic", ">=", min_aesthetic))
+    if max_punsafe is not None:
+        filters.append(("punsafe", "<=", max_punsafe))
+    columns = [c for c in COLUMNS if c in pq.ParquetFile(parquet_path).schema_arrow.names]
+    table = pq.read_table(parquet_path, columns=columns, filters=filters or None)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), FILTERS_KEY: settings})
+
+    tmp_path = filtered_path + ".incomplete"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, filtered_path)
+    return table.num_rows
+
+
+def prepare_part(part, root, source_url, min_aesthetic, max_punsafe):
+    filename = PART_TEMPLATE.format(part)
+    parquet_path = fetch_part(filename, root, source_url)
+    filtered_path = os.path.join(root, "filtered", filename)
+    num_urls = filter_part(parquet_path, filtered_path, min_aesthetic, max_punsafe)
+    return filtered_path, num_urls
+
+
+def process_part(part, filtered_path, output_folder, first_shard, processes_count, thread_count):
+    """
+    Run img2dataset on one filtered part in a scratch folder, then move its shards into `output_folder` with the
+    global shard numbering starting at `first_shard`. Returns the number of shards produced.
+    """
+    scratch_folder = os.path.join(output_folder, f"_tmp_part-{part}")
+    if os.path.exists(scratch_folder):
+        # leftover of an interrupted run
+        shutil.rmtree(scratch_folder)
+
+    print(f"\nProcessing {os.path.basename(filtered_path)}...")
+    cmd = [
+        "img2dataset",
+        "--url_list", filtered_path,
+        "--input_format", "parquet",
+        "--url_col", "URL",
+        "--caption_col", "TEXT",
+        "--output_format", "webdataset",
+        "--output_folder", scratch_folder,
+        "--processes_count", str(processes_count),
+        "--thread_count", str(thread_count),
+        "--image_size", "512",
+        "--resize_only_if_bigger", "True",
+        "--resize_mode", "keep_ratio",
+        "--skip_reencode", "True",
+        "--save_additional_columns", '["similarity","hash","punsafe","pwatermark","aesthetic"]',
+        # "--enable_wandb", "True"
+    ]
+    subprocess.run(cmd, check=True)
+
+    # img2dataset names the files of shard k `{k:05d}.tar`, `{k:05d}.parquet`, `{k:05d}_stats.json`
+    local_shards = sorted({name[:5] for name in os.listdir(scratch_folder) if name[:5].isdigit()})
+    for i, local_shard in enumerate(local_shards):
+        for name in os.listdir(scratch_folder):
+            if name.startswith(local_shard):
+                new_name = f"{first_shard + i:05d}" + name[len(local_shard):]
+                os.replace(os.path.join(scratch_folder, name), os.path.join(output_folder, new_name))
+    shutil.rmtree(scratch_folder)
+
+    return len(local_shards)
+
+
+def remove_shards(output_folder, shards):
+    """
+    Delete the files of the shards in [start, end), e.g. the stale shards of a part that is processed again.
+    """
+    start, end = shards
+    prefixes = tuple(f"{k:05d}" for k in range(start, end))
+    for name in os.listdir(output_folder):
+        if name.startswith(prefixes):
+            os.remove(os.path.join(output_folder, name))
+
+
+def download_and_process(num_files, hf_token, processes_count=16, thread_count=64, root="laion2B-en-aesthetic",
+                         source_url=None, prefetch=2, min_aesthetic=None, max_punsafe=None, start_file=0):
+    if source_url is None:
+        # 启用 Hugging Face 的进度条
+        os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+
+        # 登录到 Hugging Face
+        login(hf_token)
+
+    output_folder = os.path.join(root, "data")
+    os.makedirs(os.path.join(root, "filtered"), exist_ok=True)
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = Manifest(os.path.join(root, "manifest.json"))
+
+    filters = filter_settings(min_aesthetic, max_punsafe)
+    parts = [str(i).zfill(5) for i in range(start_file, start_file + num_files)]
+    todo = [part for part in parts if not manifest.is_done(part, filters)]
+    print(f"{len(parts) - len(todo)} of {len(parts)} parts are already done.")
+
+    # fetch and filter up to `prefetch` parts ahead while img2dataset processes the current one
+    prefetch = max(1, prefetch)
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        futures = {}
+
+        def submit(idx):
+            if idx < len(todo):
+                futures[idx] = executor.submit(prepare_part, todo[idx], root, source_url, min_aesthetic, max_punsafe)
+
+        for idx in range(prefetch):
+            submit(idx)
+
+        for idx, part in enumerate(todo):
+            future = futures.pop(idx)
+            submit(idx + prefetch)
+            try:
+                filtered_path, num_urls = future.result()
+                if manifest.shards(part) is not None:
+                    # done before with other filter settings
+                    remove_shards(output_folder, manifest.shards(part))
+                first_shard = manifest.next_shard()
+                num_shards = process_part(part, filtered_path, output_folder, first_shard, processes_count, thread_count)
+                manifest.mark_done(part, first_shard, num_shards, num_urls, filters)
+                print(f"\nPart {part}: {num_urls} urls, shards [{first_shard}, {first_shard + num_shards}).")
+            except Exception as e:
+                print(f"Error processing part {part}: {e}")
+                continue
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Download and process LAION dataset files')
     parser.add_argument('--num_files', type=int, default=1, help='Number of parquet files to download and process')
-    parser.add_argument('--hf_token', type=str, required=True, help='Hugging Face API token')
+    parser.add_argument('--start_file', type=int, default=0, help='Index of the first parquet file')
+    parser.add_argument('--hf_token', type=str, default=None, help='Hugging Face API token, required without --source_url')
+    parser.add_argument('--source_url', type=str, default=None,
+                        help='Fetch the parquet files from this HTTP server instead of the Hugging Face Hub')
+    parser.add_argument('--root', type=str, default='laion2B-en-aesthetic', help='Folder of parquet files, shards and manifest')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of parquet files fetched ahead of processing')
+    parser.add_argument('--min_aesthetic', type=float, default=None, help='Keep rows with aesthetic score >= this value')
+    parser.add_argument('--max_punsafe', type=float, default=None, help='Keep rows with punsafe <= this value')
     parser.add_argument('--processes_count', type=int, default=16, help='Number of processes for img2dataset')
     parser.add_argument('--thread_count', type=int, default=64, help='Number of threads for img2dataset')
 
     args = parser.parse_args()
+    if args.source_url is None and args.hf_token is None:
+        parser.error("--hf_token is required to download from the Hugging Face Hub")
 
     download_and_process(
         num_files=args.num_files,
         hf_token=args.hf_token,
         processes_count=args.processes_count,
-        thread_count=args.thread_count
-    )
\ No newline at end of file
+        thread_count=args.thread_count,
+        root=args.root,
+        source_url=args.source_url,
+        prefetch=args.prefetch,
+        min_aesthetic=args.min_aesthetic,
+        max_punsafe=args.max_punsafe,
+        start_file=args.start_file,
+    )
@@ -0,0 +1,260 @@
+import os
+import io
+import json
+import hashlib
+import tarfile
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif")
+EMPTY_IMAGE = "empty_image.png"
+MANIFEST = "checksums.sha256"
+# the processing settings of the outputs, next to the manifest: a change makes every output out of date
+SETTINGS = "prepare_settings.json"
+
+
+# --------------------------------------------------------------------------- #
+#            The `process_image` pipeline described in the README            #
+# --------------------------------------------------------------------------- #
+def process_image(image, target_size=(512, 512)):
+    image = convert_to_rgb(image)
+    image = pad_to_square(image)
+    image = resize_image(image, target_size)
+
+    return image
+
+def convert_to_rgb(image):
+    if image.mode != 'RGB':
+        if image.mode != "RGBA":
+            image = image.convert('RGBA')
+        background = Image.new("RGBA", image.size, (255,255,255))
+        result_image = Image.alpha_composite(background, image)
+        result_image = result_image.convert("RGB")
+
+        return result_image
+    else:
+        return image
+
+def pad_to_square(image):
+    # Transform the image into a square format, ensuring a uniform white background.
+    width, height = image.size
+    padding = abs(width - height) // 2
+
+    if width < height:
+        padding_mode = (padding, 0)
+    else:
+        padding_mode = (0, padding)
+
+    squared_image = Image.new('RGB', (max(width, height), max(width, height)), (255, 255, 255))
+    squared_image.paste(image, padding_mode)
+
+    return squared_image
+
+def resize_image(image, target_size):
+    resized_image = image.resize(target_size, Image.LANCZOS)
+
+    return resized_image
+
+
+# --------------------------------------------------------------------------- #
+#                           Catalog preparation                               #
+# --------------------------------------------------------------------------- #
+def output_rel_path(rel_path, output_ext):
+    return os.path.splitext(rel_path)[0] + output_ext
+
+def is_up_to_date(src_path, dst_path):
+    return os.path.exists(dst_path) and os.path.getmtime(dst_path) >= os.path.getmtime(src_path)
+
+def read_manifest(manifest_path):
+    # {rel_path: sha256} of a `sha256sum`-format manifest
+    checksums = {}
+    with open(manifest_path) as f:
+        for line in f:
+            checksum, rel_path = line.rstrip("\n").split("  ", 1)
+            checksums[rel_path] = checksum
+    return checksums
+
+def process_one(job):
+    """
+    Process one image. Returns `(rel_path, sha256 of the output file, status)`, where status is one of
+    "processed", "skipped" (output already up to date) or "failed: ...". With `refresh` (the processing settings
+    changed), the output is out of date. The checksum of a skipped output is taken from the previous manifest
+    (`previous_checksum`) if the output has not changed since it was written.
+    """
+    src_path, dst_path, rel_path, size, refresh, previous_checksum, manifest_mtime = job
+    try:
+        if refresh or not is_up_to_date(src_path, dst_path):
+            with Image.open(src_path) as image:
+                image = process_image(image, (size, size))
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            tmp_path = dst_path + ".tmp"
+            image.save(tmp_path, format=Image.registered_extensions()[os.path.splitext(dst_path)[1].lower()])
+            os.replace(tmp_path, dst_path)
+            status = "processed"
+        else:
+            status = "skipped"
+            if previous_checksum is not None and os.path.getmtime(dst_path) <= manifest_mtime:
+                return rel_path, previous_checksum, status
+        with open(dst_path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        return rel_path, checksum, status
+    except Exception as e:
+        return rel_path, None, f"failed: {e}"
+
+def list_images(input_dir):
+    rel_paths = []
+    for dirpath, _, filenames in os.walk(input_dir):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTS):
+                rel_paths.append(os.path.relpath(os.path.join(dirpath, filename), input_dir))
+    return sorted(rel_paths)
+
+def item_rel_paths(item_info, output_ext):
+    """
+    Image paths ordered by item id from `item_info.npy` ({iid: {'original iid', 'category', 'url'}}), following
+    the '/img_folder_path/semantic_category/ori_iid.png' layout. Item 0 is the empty image.
+    """
+    num_items = max(item_info.keys()) + 1
+    paths = [EMPTY_IMAGE] * num_items
+    for iid, info in item_info.items():
+        if iid == 0:
+            continue
+        paths[iid] = os.path.join(info['category'], str(info['original iid']) + output_ext)
+    return paths
+
+def write_shards(output_dir, item_paths, shard_dir, shard_size):
+    """
+    Write the processed images as webdataset tar shards, keyed by item id: `{iid:09d}.png`, `.txt` (the semantic
+    category folder) and `.json` (item id and image path).
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    num_shards = 0
+    for start in tqdm(range(0, len(item_paths), shard_size), desc="shards"):
+        shard_path = os.path.join(shard_dir, f"{num_shards:05d}.tar")
+        with tarfile.open(shard_path + ".tmp", "w") as tar:
+            for iid in range(start, min(start + shard_size, len(item_paths))):
+                path = os.path.join(output_dir, item_paths[iid])
+                if not os.path.exists(path):
+                    continue
+                key = f"{iid:09d}"
+                with open(path, "rb") as f:
+                    image_bytes = f.read()
+                meta = {"iid": iid, "path": item_paths[iid]}
+                members = [
+                    (key + os.path.splitext(path)[1].lower(), image_bytes),
+                    (key + ".txt", os.path.dirname(item_paths[iid]).encode("utf-8")),
+                    (key + ".json", json.dumps(meta).encode("utf-8")),
+                ]
+                for name, content in members:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+        os.replace(shard_path + ".tmp", shard_path)
+        num_shards += 1
+    return num_shards
+
+def prepare_catalog(input_dir, output_dir, data_path, item_info_path=None, size=512, output_ext=".png",
+                    num_workers=None, shard_dir=None, shard_size=10000):
+    os.makedirs(output_dir, exist_ok=True)
+
+    if item_info_path is not None:
+        item_info = np.load(item_info_path, allow_pickle=True).item()
+        item_paths = item_rel_paths(item_info, output_ext)
+        # map the output paths back to the downloaded images, whatever their extension
+        src_by_out = {output_rel_path(p, output_ext): p for p in list_images(input_dir)}
+        rel_paths = [src_by_out[p] for p in item_paths if p in src_by_out and p != EMPTY_IMAGE]
+        missing = [p for p in item_paths[1:] if p not in src_by_out and p != EMPTY_IMAGE]
+        if missing:
+            print(f"{len(missing)} item images are missing in {input_dir}, e.g. {missing[:3]}")
+    else:
+        rel_paths = [p for p in list_images(input_dir) if p != EMPTY_IMAGE]
+        item_paths = [EMPTY_IMAGE] + [output_rel_path(p, output_ext) for p in rel_paths]
+
+    settings = {"size": size, "output_ext": output_ext}
+    settings_path = os.path.join(output_dir, SETTINGS)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    previous_settings = None
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            previous_settings = json.load(f)
+    refresh = previous_settings is not None and previous_settings != settings
+    if refresh:
+        print(f"The processing settings changed from {previous_settings} to {settings}, all the images are processed again.")
+    previous_checksums, manifest_mtime = {}, None
+    if previous_settings == settings and os.path.exists(manifest_path):
+        previous_checksums, manifest_mtime = read_manifest(manifest_path), os.path.getmtime(manifest_path)
+
+    jobs = []
+    for p in rel_paths:
+        out_path = output_rel_path(p, output_ext)
+        jobs.append((os.path.join(input_dir, p), os.path.join(output_dir, out_path), out_path, size, refresh,
+                     previous_checksums.get(out_path), manifest_mtime))
+
+    checksums = {}
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+    with Pool(num_workers) as pool:
+        for rel_path, checksum, status in tqdm(pool.imap_unordered(process_one, jobs, chunksize=64), total=len(jobs)):
+            if checksum is None:
+                counts["failed"] += 1
+                print(f"{rel_path}: {status}")
+                continue
+            counts[status] += 1
+            checksums[rel_path] = checksum
+
+    # a pure white image, used as the null condition (item 0)
+    empty_path = os.path.join(output_dir, EMPTY_IMAGE)
+    if refresh or not os.path.exists(empty_path):
+        Image.new('RGB', (size, size), (255,255,255)).save(empty_path)
+    with open(empty_path, "rb") as f:
+        checksums[EMPTY_IMAGE] = hashlib.sha256(f.read()).hexdigest()
+
+    os.makedirs(data_path, exist_ok=True)
+    np.save(os.path.join(data_path, "all_item_image_paths.npy"), np.array(item_paths))
+
+    # same format as `sha256sum`, can be checked with `sha256sum -c` from the output folder
+    with open(manifest_path, "w") as f:
+        for rel_path in sorted(checksums):
+            f.write(f"{checksums[rel_path]}  {rel_path}\n")
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+
+    print(f"processed: {counts['processed']}, up to date: {counts['skipped']}, failed: {counts['failed']}")
+    print(f"Saved {len(item_paths)} item image paths to {os.path.join(data_path, 'all_item_image_paths.npy')}")
+
+    if shard_dir is not None:
+        num_shards = write_shards(output_dir, item_paths, shard_dir, shard_size)
+        print(f"Wrote {num_shards} shards to {shard_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prepare catalog item images with the README process_image pipeline')
+    parser.add_argument('--input_dir', type=str, required=True, help='Folder tree of the downloaded item images')
+    parser.add_argument('--output_dir', type=str, required=True, help='The img_folder_path of the processed images')
+    parser.add_argument('--data_path', type=str, required=True, help='Dataset folder to write all_item_image_paths.npy to')
+    parser.add_argument('--item_info', type=str, default=None,
+                        help='item_info.npy to order the image paths by item id; otherwise items follow the sorted paths')
+    parser.add_argument('--size', type=int, default=512, help='Output image size')
+    parser.add_argument('--output_ext', type=str, default='.png', help='Extension (format) of the processed images')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of processes, defaults to all cores')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='Also write the processed images as webdataset tar shards into this folder')
+    parser.add_argument('--shard_size', type=int, default=10000, help='Number of items per shard')
+
+    args = parser.parse_args()
+
+    prepare_catalog(
+        input_dir=args.input_dir,
+        output_dir=args.output_dir,
+        data_path=args.data_path,
+        item_info_path=args.item_info,
+        size=args.size,
+        output_ext=args.output_ext,
+        num_workers=args.num_workers,
+        shard_dir=args.shard_dir,
+        shard_size=args.shard_size,
+    )
@@ -0,0 +1,116 @@
+"""
+Runs download_laion2B-en-aesthetic.py against a local file server instead of the Hugging Face Hub, with a stand-in
+for img2dataset that writes one shard per part.
+
+    python -m unittest datasets/test_download_laion2B.py
+"""
+import os
+import sys
+import json
+import stat
+import shutil
+import tempfile
+import threading
+import unittest
+import functools
+import importlib.util
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location("download_laion", os.path.join(HERE, "download_laion2B-en-aesthetic.py"))
+download_laion = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(download_laion)
+
+FAKE_IMG2DATASET = f"""#!{sys.executable}
+import os, sys
+import pyarrow.parquet as pq
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+os.makedirs(args["--output_folder"], exist_ok=True)
+num_rows = pq.ParquetFile(args["--url_list"]).metadata.num_rows
+with open(os.path.join(args["--output_folder"], "00000.tar"), "w") as f:
+    f.write(str(num_rows))
+"""
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class DownloadLaionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.mirror = os.path.join(self.tmp, "mirror")
+        self.root = os.path.join(self.tmp, "laion")
+        os.makedirs(self.mirror)
+        table = pa.table({
+            "URL": [f"http://example.com/{i}.jpg" for i in range(10)],
+            "TEXT": [f"caption {i}" for i in range(10)],
+            "aesthetic": [float(i) for i in range(10)],
+            "punsafe": [i / 10 for i in range(10)],
+        })
+        for part in ["00000", "00001"]:
+            pq.write_table(table, os.path.join(self.mirror, download_laion.PART_TEMPLATE.format(part)))
+
+        handler = functools.partial(QuietHandler, directory=self.mirror)
+        self.server = HTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.source_url = f"http://127.0.0.1:{self.server.server_port}"
+
+        bin_dir = os.path.join(self.tmp, "bin")
+        os.makedirs(bin_dir)
+        img2dataset = os.path.join(bin_dir, "img2dataset")
+        with open(img2dataset, "w") as f:
+            f.write(FAKE_IMG2DATASET)
+        os.chmod(img2dataset, os.stat(img2dataset).st_mode | stat.S_IEXEC)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def run_download(self, **kwargs):
+        download_laion.download_and_process(
+            num_files=2, hf_token=None, root=self.root, source_url=self.source_url, **kwargs
+        )
+        with open(os.path.join(self.root, "manifest.json")) as f:
+            return json.load(f)
+
+    def shard_rows(self):
+        data = os.path.join(self.root, "data")
+        rows = {}
+        for name in sorted(os.listdir(data)):
+            with open(os.path.join(data, name)) as f:
+                rows[name] = int(f.read())
+        return rows
+
+    def test_download_and_resume(self):
+        manifest = self.run_download(min_aesthetic=5.0)
+        self.assertEqual(manifest["next_shard"], 2)
+        self.assertEqual(manifest["parts"]["00001"]["shards"], [1, 2])
+        self.assertEqual(manifest["parts"]["00000"]["num_urls"], 5)
+        self.assertEqual(self.shard_rows(), {"00000.tar": 5, "00001.tar": 5})
+
+        # a rerun with the same settings skips the finished parts
+        manifest = self.run_download(min_aesthetic=5.0)
+        self.assertEqual(manifest["next_shard"], 2)
+
+    def test_refilter_on_new_settings(self):
+        self.run_download(min_aesthetic=5.0)
+        manifest = self.run_download(min_aesthetic=5.0, max_punsafe=0.7)
+
+        # both parts are filtered again, and their stale shards are replaced
+        self.assertEqual(manifest["parts"]["00000"]["num_urls"], 3)
+        self.assertEqual(manifest["parts"]["00001"]["filters"], {"min_aesthetic": 5.0, "max_punsafe": 0.7})
+        self.assertEqual(self.shard_rows(), {"00002.tar": 3, "00003.tar": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()